@@ -7,24 +7,349 @@ import re
 import hashlib
 import os
 import errno
-import zipfile
+import fcntl
+import time
+import random
+import gzip
 import cStringIO
+import glob
+import tempfile
+import threading
+import Queue
 import cgi
+import csv
+import json
+import urllib
 import flask
-
-
-def open_db(path):
+import werkzeug.wsgi
+import werkzeug.datastructures
+from werkzeug.exceptions import NotFound
+import zipstream
+import replay_store
+import sql_trace
+import ahgl_migrate
+import bulk_import
+import change_notifier
+import job_queue
+import league_stats
+import week_versions
+
+
+def open_db(path, **kwds):
   import sqlite3
   driver = sqlite3
   if driver.paramstyle != "qmark":
     raise Exception("Require qmark paramstyle")
-  conn = driver.connect(path)
+  conn = driver.connect(path, **kwds)
   return conn
 
 
+# Bounded set of long-lived connections to one database file.  Connections
+# are opened on demand, configured once, and handed back out
+# most-recently-used first so requests get one with a warm page cache.
+class ConnectionPool(object):
+
+  def __init__(self, path, size, pragmas, busy_timeout=5.0, factory=None, read_only=False):
+    self.path = path
+    self.pragmas = pragmas
+    self.busy_timeout = busy_timeout
+    self.factory = factory
+    self.read_only = read_only
+    self.closed = False
+    self._idle = Queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+
+  def _connect(self):
+    # Connections move between request threads, but only one request
+    # holds a given connection at a time.
+    kwds = dict(check_same_thread=False, timeout=self.busy_timeout)
+    if self.factory is not None:
+      kwds["factory"] = self.factory
+    path = self.path
+    if self.read_only:
+      # Nothing writes to an archived season, so SQLite can skip locking
+      # and change detection entirely.
+      path = "file:%s?mode=ro&immutable=1" % urllib.quote(os.path.abspath(path))
+    conn = open_db(path, **kwds)
+    for name, value in self.pragmas:
+      if value is not None:
+        conn.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+    return conn
+
+  def acquire(self):
+    self._slots.acquire()
+    try:
+      try:
+        return self._idle.get_nowait()
+      except Queue.Empty:
+        return self._connect()
+    except:
+      self._slots.release()
+      raise
+
+  def release(self, conn):
+    try:
+      # Never hand out a connection with a transaction left open.
+      conn.rollback()
+    except Exception:
+      conn.close()
+    else:
+      if self.closed:
+        conn.close()
+      else:
+        self._idle.put(conn)
+    self._slots.release()
+
+  # Close the idle connections now; ones still in use are closed as they
+  # are released.
+  def close(self):
+    self.closed = True
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except Queue.Empty:
+        break
+
+
+# Dict-like cache holding at most `size` entries, dropping the least
+# recently used (and passing it to on_evict) to make room.
+class LRUCache(object):
+
+  def __init__(self, size, on_evict=None):
+    self.size = size
+    self.on_evict = on_evict
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._items.pop(key)
+      except KeyError:
+        return default
+      self._items[key] = value
+      return value
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      evicted = []
+      while len(self._items) > max(1, self.size):
+        evicted.append(self._items.popitem(last=False)[1])
+    if self.on_evict is not None:
+      for old in evicted:
+        self.on_evict(old)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+  def __len__(self):
+    return len(self._items)
+
+
+_pools = LRUCache(1, lambda pool: pool.close())
+_pools_lock = threading.Lock()
+_pools_pid = [None]
+# Databases found up to date by this process, so a pool rebuilt after an
+# eviction does not check (or lock) them again.
+_migrated_paths = set()
+
+
+def get_connection_factory():
+  factory = app.config["DB_CONNECTION_FACTORY"]
+  if factory is None and app.config["SQL_TRACE"]:
+    factory = sql_trace.TracingConnection
+  return factory
+
+
+def get_pool(path, read_only=False):
+  with _pools_lock:
+    # Pools must not be shared across a fork; each worker builds its own.
+    if _pools_pid[0] != os.getpid():
+      _pools.clear()
+      _pools_pid[0] = os.getpid()
+    _pools.size = app.config["DB_OPEN_SEASONS"]
+    pool = _pools.get(path)
+    if pool is None:
+      if path not in _migrated_paths:
+        with contextlib.closing(open_db(path)) as conn:
+          if app.config["AUTO_MIGRATE"] and not read_only:
+            ahgl_migrate.upgrade(conn, log=app.logger.info)
+          elif ahgl_migrate.pending_migrations(conn):
+            # The queries here rely on the migrated schema (e.g. week_versions).
+            raise Exception("%s needs ahgl_migrate.py before it can be served" % path)
+        _migrated_paths.add(path)
+      pool = ConnectionPool(path, app.config["DB_POOL_SIZE"], [
+        # An immutable database has no journal to configure.
+        ("journal_mode", None if read_only else app.config["DB_JOURNAL_MODE"]),
+        ("synchronous", app.config["DB_SYNCHRONOUS"]),
+        ("cache_size", app.config["DB_CACHE_SIZE"]),
+        ("mmap_size", app.config["DB_MMAP_SIZE"]),
+        ], app.config["DB_BUSY_TIMEOUT"], get_connection_factory(), read_only)
+      _pools[path] = pool
+    return pool
+
+
 app = flask.Flask(__name__)
 g = flask.g
 
+app.config.update(
+    # Apply pending migrations/ when a worker first opens a database.  A
+    # database that is not up to date (or, being closed, cannot be
+    # migrated) is refused.
+    AUTO_MIGRATE = True,
+    DB_POOL_SIZE = 8,
+    DB_JOURNAL_MODE = "WAL",
+    DB_SYNCHRONOUS = "NORMAL",
+    DB_CACHE_SIZE = -16384,
+    DB_MMAP_SIZE = 64 * 1024 * 1024,
+    # SQLite's own busy wait, then up to DB_WRITE_RETRIES further attempts
+    # to take the write lock with exponential backoff from
+    # DB_WRITE_RETRY_DELAY seconds.
+    DB_BUSY_TIMEOUT = 0.5,
+    DB_WRITE_RETRIES = 5,
+    DB_WRITE_RETRY_DELAY = 0.05,
+    # Connection subclass for pooled connections, e.g. to instrument queries.
+    DB_CONNECTION_FACTORY = None,
+    # Record every statement each request runs (see sql_trace).  Requests
+    # get an X-SQL-Summary header, statements slower than
+    # SQL_SLOW_QUERY_MS and shapes repeated SQL_REPEAT_THRESHOLD times are
+    # logged, and the last SQL_TRACE_HISTORY traces are shown to admins on
+    # /_debug/sql.
+    SQL_TRACE = False,
+    SQL_SLOW_QUERY_MS = 100,
+    SQL_REPEAT_THRESHOLD = 3,
+    SQL_TRACE_HISTORY = 50,
+    PACK_CACHE_DIR = None,
+    # How long a download waits for another request or worker building the
+    # same pack before sending an uncached copy of its own.
+    PACK_LOCK_WAIT = 10,
+    # Replay archive compression, per route: "stored", "deflate[:LEVEL]" or
+    # "adaptive[:LEVEL]" (see zipstream.parse_compression and
+    # bench_zip_compression.py).
+    REPLAY_PACK_COMPRESSION = "deflate",
+    PLAYER_REPLAYS_COMPRESSION = "deflate",
+    PAGE_CACHE_GZIP = True,
+    MAX_REPLAY_SIZE = 16 * 1024 * 1024,
+    # Larger request bodies are refused with a 413 before any of them is
+    # read: room for a result's five replays and the rest of its form.
+    # Raise it along with MAX_REPLAY_SIZE.
+    MAX_CONTENT_LENGTH = 5 * 16 * 1024 * 1024 + 1024 * 1024,
+    # How long an account's team may be trusted from the session before it
+    # is re-read, and a stamp to bump to revoke all cached copies.  With the
+    # default of 0 it is read on every request, so deleting an account or
+    # moving it to another team takes effect at once; with a TTL, only
+    # after the TTL or a bump of the stamp.
+    ACCOUNT_SESSION_TTL = 0,
+    ACCOUNT_SESSION_VERSION = 1,
+    # Sharded replay store; replays still in the old flat layout directly
+    # in DATA_DIR are found there until replay_store.py migrates them.
+    REPLAY_DIR = None,
+    # Archived seasons, served under /s/<season>/ from
+    # SEASONS_DIR/<season>/ahgl.sq3 alongside the current season in
+    # DATA_DIR.  CLOSED_SEASONS are opened read-only and immutable.  At
+    # most DB_OPEN_SEASONS databases have connections open at once, and
+    # WEEK_CACHE_SIZE bounds the cached week snapshots and pages across all
+    # seasons.  Season databases share the replay store in REPLAY_DIR
+    # (default SEASONS_DIR/replays).
+    SEASONS_DIR = None,
+    CLOSED_SEASONS = (),
+    DB_OPEN_SEASONS = 4,
+    WEEK_CACHE_SIZE = 256,
+    # /events/<week> streams, which lineup and result pages listen on to
+    # reload when the week changes: how often to look for changes made by
+    # other processes, how often to send a keepalive comment, and how long
+    # to hold a stream open before the client is asked to reconnect.  Each
+    # open stream occupies a thread (or greenlet) of the server while it
+    # waits, so only enable them under a threaded or asynchronous server;
+    # with a few pre-forked workers, a few open pages would take them all.
+    EVENTS_ENABLED = False,
+    EVENTS_POLL_INTERVAL = 1.0,
+    EVENTS_KEEPALIVE = 15,
+    EVENTS_MAX_SECONDS = 300,
+    # Background jobs (see job_queue and ahgl_worker.py): attempts before a
+    # job is marked failed, the delay before the first retry (doubling
+    # after each further failure), how long a job's lease lasts without
+    # being renewed before its worker is presumed dead (a running job's
+    # worker renews it every third of that), and how many jobs the admin
+    # page lists.
+    JOB_MAX_ATTEMPTS = 5,
+    JOB_RETRY_DELAY = 30,
+    JOB_LEASE_SECONDS = 600,
+    JOB_HISTORY = 50,
+    # Processes a close_week job builds packs with.
+    PACK_BUILD_PROCESSES = 4,
+    # None, "x-sendfile", or "x-accel-redirect" (with SENDFILE_ACCEL_PREFIX
+    # being the internal location that maps to SENDFILE_ACCEL_ROOT, by
+    # default DATA_DIR).  With archived seasons, set SENDFILE_ACCEL_ROOT to
+    # a directory holding both DATA_DIR and SEASONS_DIR; files outside it
+    # are sent by the app itself.
+    SENDFILE_MODE = None,
+    SENDFILE_ACCEL_PREFIX = "/_ahgl_data/",
+    SENDFILE_ACCEL_ROOT = None,
+    # Season exports (see season_export.py) are written by the worker to
+    # EXPORT_DIR (default DATA_DIR/exports, per season like PACK_CACHE_DIR).
+    EXPORT_DIR = None,
+    EXPORT_COMPRESSION = "stored",
+    )
+
+
+_SEASON_PATH_RE = re.compile(r"^/s/([A-Za-z0-9_-]+)(/.*)?$")
+
+
+# Serve /s/<season>/... as the app mounted at that prefix, so routes and
+# url_for work unchanged and links stay within the season.
+class SeasonDispatcher(object):
+
+  def __init__(self, wsgi_app):
+    self.wsgi_app = wsgi_app
+
+  def __call__(self, environ, start_response):
+    match = _SEASON_PATH_RE.match(environ.get("PATH_INFO", ""))
+    if match:
+      season, rest = match.groups()
+      environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/s/" + season
+      environ["PATH_INFO"] = rest or "/"
+      environ["ahgl.season"] = season
+    return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = SeasonDispatcher(app.wsgi_app)
+
+
+# The archived season this request is for, or None for the current one.
+def get_season():
+  return flask.request.environ.get("ahgl.season")
+
+
+def get_season_name():
+  return get_season() or app.config["SEASON"]
+
+
+def get_data_dir():
+  season = get_season()
+  if season is None:
+    return app.config["DATA_DIR"]
+  return os.path.join(app.config["SEASONS_DIR"], season)
+
+
+# A request context for the season outside of a request, for scripts.
+def season_context(season):
+  environ = {}
+  if season is not None:
+    environ["ahgl.season"] = season
+    environ["SCRIPT_NAME"] = "/s/" + season
+  return app.test_request_context(environ_base=environ)
+
+
+@app.before_request
+def check_season():
+  season = get_season()
+  if season is not None and not (app.config["SEASONS_DIR"]
+      and os.path.exists(os.path.join(get_data_dir(), "ahgl.sq3"))):
+    flask.abort(404)
+
 
 def content_type(ctype):
   def decorator(func):
@@ -38,13 +363,23 @@ def content_type(ctype):
   return decorator
 
 
+# Every season shares the session cookie, but account ids are only
+# meaningful in the database they came from, so a login counts only in its
+# own season and only while the account still has the same email.
 def require_auth(func):
   @functools.wraps(func)
   def wrapper(*args, **kwds):
     account = flask.session.get("account")
-    if not account:
+    if not account or flask.session.get("account_season") != get_season_name():
+      return flask.render_template("no_account.html")
+    team = lookup_account_team(account, flask.session.get("account_email"))
+    if team is None:
+      # The account was deleted (or its id reused) since this session
+      # logged in.
+      clear_login()
       return flask.render_template("no_account.html")
     g.account = account
+    g.user_team = team
     return func(*args, **kwds)
   return wrapper
 
@@ -58,20 +393,275 @@ def require_admin(func):
   return wrapper
 
 
-def get_user_team():
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT team FROM accounts WHERE id = ?", (g.account,))
-    return list(cursor)[0][0]
+# The account's team, or None if the account is gone.  With
+# ACCOUNT_SESSION_TTL set, a copy cached in the signed session is used
+# while it is valid: it expires after that many seconds, and bumping
+# ACCOUNT_SESSION_VERSION invalidates every cached copy at once.
+def lookup_account_team(account, email):
+  ttl = app.config["ACCOUNT_SESSION_TTL"]
+  version = app.config["ACCOUNT_SESSION_VERSION"]
+  now = int(time.time())
+  cached = flask.session.get("account_team")
+  if (ttl and cached and cached.get("account") == account
+      and cached.get("season") == get_season()
+      and cached.get("version") == version and cached.get("expires", 0) > now):
+    return cached["team"]
+
+  with contextlib.closing(get_db().cursor()) as cursor:
+    cursor.execute("SELECT team, email FROM accounts WHERE id = ?", (account,))
+    rows = list(cursor)
+  if not rows or rows[0][1] != email:
+    return None
+  team = rows[0][0]
+  if ttl:
+    flask.session["account_team"] = dict(account = account, season = get_season(),
+        team = team, version = version, expires = now + ttl)
+  return team
 
 
-@app.before_request
-def before_request():
-  g.db = open_db(os.path.join(app.config["DATA_DIR"], "ahgl.sq3"))
+def get_user_team():
+  return g.user_team
+
+
+def get_db():
+  db = getattr(g, "db", None)
+  if db is None:
+    g.db_pool = get_pool(os.path.join(get_data_dir(), "ahgl.sq3"),
+        get_season() in app.config["CLOSED_SEASONS"])
+    db = g.db = g.db_pool.acquire()
+    if isinstance(db, sql_trace.TracingConnection):
+      request = flask.request
+      db.trace = sql_trace.RequestTrace("%s %s" % (request.method, request.path))
+  return db
+
+@app.after_request
+def after_request(response):
+  trace = getattr(getattr(g, "db", None), "trace", None)
+  if trace is not None:
+    response.headers["X-SQL-Summary"] = trace.summary(app.config["SQL_REPEAT_THRESHOLD"])
+  return response
 
 @app.teardown_request
 def teardown_request(exception):
-  if hasattr(g, "db"):
-    g.db.close()
+  release_db()
+
+
+# Hand this request's connection back to its pool early, before a long
+# wait that needs no database; get_db() takes another if needed.
+def release_db():
+  if getattr(g, "db", None) is not None:
+    trace = getattr(g.db, "trace", None)
+    if trace is not None:
+      g.db.trace = None
+      finish_trace(trace)
+    g.db_pool.release(g.db)
+    g.db = None
+
+
+_sql_traces = collections.deque()
+
+
+def finish_trace(trace):
+  history = app.config["SQL_TRACE_HISTORY"]
+  _sql_traces.appendleft(trace)
+  while len(_sql_traces) > history:
+    _sql_traces.pop()
+  for query in trace.slow(app.config["SQL_SLOW_QUERY_MS"] / 1000.0):
+    app.logger.warning("Slow query (%.1fms, %d rows) in %s: %s", query.seconds * 1000,
+        query.rows, trace.label, sql_trace.statement_shape(query.sql))
+  for count, shape in trace.repeated(app.config["SQL_REPEAT_THRESHOLD"]):
+    app.logger.warning("Query repeated %d times in %s: %s", count, trace.label, shape)
+
+
+# Run func(cursor) in a BEGIN IMMEDIATE transaction and commit.  Callers
+# validate everything first, so the write lock is only held for the writes.
+def run_write_transaction(func):
+  db = get_db()
+  retries = app.config["DB_WRITE_RETRIES"]
+  delay = app.config["DB_WRITE_RETRY_DELAY"]
+  for attempt in range(retries + 1):
+    try:
+      db.execute("BEGIN IMMEDIATE")
+      break
+    except db.OperationalError as err:
+      if attempt == retries or "locked" not in str(err):
+        raise
+    time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+  try:
+    with contextlib.closing(db.cursor()) as cursor:
+      result = func(cursor)
+    db.commit()
+  except:
+    db.rollback()
+    raise
+  return result
+
+
+_notifiers = {}
+_notifiers_lock = threading.Lock()
+
+
+def get_notifier(path):
+  # The poller thread does not survive a fork, so each worker has its own.
+  key = (os.getpid(), path)
+  with _notifiers_lock:
+    notifier = _notifiers.get(key)
+    if notifier is None:
+      notifier = _notifiers[key] = change_notifier.WeekNotifier(
+          path, app.config["EVENTS_POLL_INTERVAL"])
+    return notifier
+
+
+def publish_week_change(week, version, kind):
+  get_notifier(g.db_pool.path).publish(week, version, kind)
+
+
+# Everything the week pages need, loaded together.
+#   teams: {team: name}
+#   captains: {team: captain_info}
+#   matches: {match_number: (home, away, main_ref_team, backup_ref_team)}
+#   maps: {set_number: mapname}
+#   refs: {team: referee_name}
+#   players: {player: (name, "name.char_code")} for everyone in a lineup or ace match
+#   lineups: {team: {set_number: (player, race)}}
+#   results: {match_number: {set_number: (home_winner, away_winner, forfeit, replay_hash)}}
+#   aces: {match_number: (home_player, away_player, home_race, away_race)}
+WeekSnapshot = collections.namedtuple("WeekSnapshot", [
+  "week", "version", "teams", "captains", "matches", "maps", "refs",
+  "players", "lineups", "results", "aces",
+  ])
+
+_week_snapshots = LRUCache(256)
+
+
+def current_week_version(week):
+  with contextlib.closing(get_db().cursor()) as cursor:
+    return week_versions.get(cursor, week)
+
+
+# The week's snapshot, given its current version if the caller has read it
+# already.
+def get_week_snapshot(week, version=None):
+  if version is None:
+    version = current_week_version(week)
+  key = (g.db_pool.path, week)
+  _week_snapshots.size = app.config["WEEK_CACHE_SIZE"]
+  cached = _week_snapshots.get(key)
+  if cached is not None and cached.version == version:
+    return cached
+  snapshot = _week_snapshots[key] = load_week_snapshot(get_db(), week, version)
+  return snapshot
+
+
+# The version is read before the data, so a write in between can only make
+# the data newer than its version says, which costs a reload next time.
+def load_week_snapshot(db, week, version):
+  # One read transaction, so the tables agree with each other.
+  with contextlib.closing(db.cursor()) as cursor:
+    cursor.execute("BEGIN")
+    try:
+      teams = {}
+      captains = {}
+      cursor.execute("SELECT id, name, captain_info FROM teams")
+      for tid, name, captain in cursor:
+        teams[tid] = name
+        captains[tid] = captain
+
+      cursor.execute(
+          "SELECT match_number, home_team, away_team, "
+          "main_ref_team, backup_ref_team "
+          "FROM matches WHERE week = ?", (week,))
+      matches = dict((row[0], tuple(row[1:])) for row in cursor)
+
+      cursor.execute(
+          "SELECT set_number, mapname "
+          "FROM maps JOIN mapnames ON mapid = mapnames.id "
+          "WHERE week = ?", (week,))
+      maps = dict(cursor)
+
+      cursor.execute("SELECT team, referee_name FROM referees WHERE week = ?", (week,))
+      refs = dict(cursor)
+
+      lineups = {}
+      cursor.execute("SELECT team, set_number, player, race FROM lineup WHERE week = ?", (week,))
+      for (team, set_number, player, race) in cursor:
+        lineups.setdefault(team, {})[set_number] = (player, race)
+
+      results = {}
+      cursor.execute(
+          "SELECT match_number, set_number, home_winner, away_winner, forfeit, replay_hash "
+          "FROM set_results WHERE week = ?", (week,))
+      for (match_number, set_number, home_winner, away_winner, forfeit, replay_hash) in cursor:
+        results.setdefault(match_number, {})[set_number] = (home_winner, away_winner, forfeit, replay_hash)
+
+      cursor.execute(
+          "SELECT match_number, home_player, away_player, home_race, away_race "
+          "FROM ace_matches WHERE week = ?", (week,))
+      aces = dict((row[0], tuple(row[1:])) for row in cursor)
+
+      cursor.execute(
+          "SELECT id, name, name || '.' || IFNULL(char_code, 'COWARD') "
+          "FROM players WHERE id IN ("
+            "SELECT player FROM lineup WHERE week = ? "
+            "UNION SELECT home_player FROM ace_matches WHERE week = ? "
+            "UNION SELECT away_player FROM ace_matches WHERE week = ?)"
+          , (week, week, week))
+      players = dict((row[0], tuple(row[1:])) for row in cursor)
+    finally:
+      db.rollback()
+
+  return WeekSnapshot(week, version, teams, captains, matches, maps, refs,
+      players, lineups, results, aces)
+
+
+CachedPage = collections.namedtuple("CachedPage", ["version", "etag", "body", "gzip_body"])
+
+_page_cache = LRUCache(256)
+
+
+def _gzip(data):
+  buf = cStringIO.StringIO()
+  # A fixed mtime keeps the compressed bytes (and so their ETag) stable.
+  with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as handle:
+    handle.write(data)
+  return buf.getvalue()
+
+
+# Cache the rendered page for a week until the week's version changes, and
+# answer revalidation requests from the cache with 304s.  func renders the
+# page from the week's snapshot.
+def cached_week_page(func):
+  @functools.wraps(func)
+  def wrapper(week):
+    version = current_week_version(week)
+    key = (func.__name__, g.db_pool.path, week)
+    _page_cache.size = app.config["WEEK_CACHE_SIZE"]
+    page = _page_cache.get(key)
+    if page is None or page.version != version:
+      body = func(get_week_snapshot(week, version))
+      page = _page_cache[key] = CachedPage(
+          version,
+          hashlib.sha1(body).hexdigest(),
+          body,
+          _gzip(body) if app.config["PAGE_CACHE_GZIP"] else None)
+
+    request = flask.request
+    if page.gzip_body is not None and request.accept_encodings["gzip"]:
+      etag, body, encoding = page.etag + "-gz", page.gzip_body, "gzip"
+    else:
+      etag, body, encoding = page.etag, page.body, None
+    resp = not_modified_response(etag, "no-cache")
+    if not resp:
+      resp = app.make_response(body)
+      resp.headers["ETag"] = quote_etag(etag)
+      resp.headers["Cache-Control"] = "no-cache"
+      if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+  # The page body on its own, bypassing the cache (e.g. for exports).
+  wrapper.render = lambda week, **kwds: func(get_week_snapshot(week), **kwds)
+  return wrapper
 
 
 @app.route("/_debug")
@@ -81,6 +671,169 @@ def debug_page():
          for key, value in flask.request.environ.iteritems()])
 
 
+@app.route("/_debug/sql")
+@require_auth
+@require_admin
+@content_type("text/plain")
+def debug_sql_page():
+  if not app.config["SQL_TRACE"]:
+    return "SQL tracing is disabled (set SQL_TRACE).\n"
+  repeat_threshold = app.config["SQL_REPEAT_THRESHOLD"]
+  return "".join([ trace.report(repeat_threshold) + "\n\n" for trace in list(_sql_traces) ])
+
+
+_season_games = LRUCache(8)
+
+
+# This database's games loaded for season_analytics, reloaded only when a
+# week version has changed since.  NumPy is only needed if this is called.
+def get_season_games():
+  import season_analytics
+  with contextlib.closing(get_db().cursor()) as cursor:
+    cursor.execute("SELECT COUNT(*), TOTAL(version) FROM week_versions")
+    version = tuple(list(cursor)[0])
+  key = g.db_pool.path
+  cached = _season_games.get(key)
+  if cached is not None and cached[0] == version:
+    return cached[1]
+  games = season_analytics.load_games(get_db())
+  _season_games[key] = (version, games)
+  return games
+
+
+@app.route("/_analytics")
+@require_auth
+@require_admin
+def analytics_page():
+  try:
+    import season_analytics
+  except ImportError:
+    return "Season analytics needs NumPy."
+  games = get_season_games()
+  reports = []
+  for name, rows in season_analytics.run_reports(games):
+    columns = sorted(rows[0]) if rows else []
+    reports.append((name, columns, [ [ row[column] for column in columns ] for row in rows ]))
+  return flask.render_template("analytics.html",
+      num_games = len(games),
+      reports = reports,
+      )
+
+
+@app.route("/_jobs")
+@require_auth
+@require_admin
+def jobs_page():
+  with contextlib.closing(get_db().cursor()) as cursor:
+    counts = job_queue.counts(cursor)
+    failed = job_queue.recent(cursor, app.config["JOB_HISTORY"], job_queue.FAILED)
+    recent = job_queue.recent(cursor, app.config["JOB_HISTORY"])
+  statuses = [job_queue.PENDING, job_queue.RUNNING, job_queue.DONE, job_queue.FAILED]
+  kinds = sorted(set(kind for (kind, _) in counts))
+  return flask.render_template("jobs.html",
+      statuses = statuses,
+      counts = [ (kind, [ counts.get((kind, status), 0) for status in statuses ]) for kind in kinds ],
+      failed = failed,
+      recent = recent,
+      format_time = lambda t: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) if t else "",
+      )
+
+
+@app.route("/_jobs/<int:job_id>/retry", methods=["POST"])
+@require_auth
+@require_admin
+def retry_job(job_id):
+  def write(cursor):
+    return job_queue.retry(cursor, job_id)
+  if not run_write_transaction(write):
+    return "Job %d has not failed" % job_id
+  return flask.redirect(flask.url_for(jobs_page.__name__))
+
+
+def get_export_dir():
+  if app.config["EXPORT_DIR"] is None:
+    return os.path.join(get_data_dir(), "exports")
+  if get_season() is None:
+    return app.config["EXPORT_DIR"]
+  return os.path.join(app.config["EXPORT_DIR"], "s", get_season())
+
+
+_EXPORT_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+\.zip$")
+
+
+@app.route("/_exports")
+@require_auth
+@require_admin
+def exports_page():
+  import season_export
+  export_dir = get_export_dir()
+  finished = []
+  running = []
+  names = sorted(os.listdir(export_dir)) if os.path.isdir(export_dir) else []
+  for name in names:
+    path = os.path.join(export_dir, name)
+    if _EXPORT_NAME_RE.match(name):
+      stat = os.stat(path)
+      finished.append((name, stat.st_size, stat.st_mtime))
+    elif name.endswith(".zip.lock"):
+      progress = season_export.export_progress(path[:-len(".lock")])
+      if progress is not None:
+        running.append((name[:-len(".lock")],) + progress)
+  with contextlib.closing(get_db().cursor()) as cursor:
+    jobs = [ job for job in job_queue.recent(cursor, app.config["JOB_HISTORY"])
+      if job[1] == "export_season" and job[3] in (job_queue.PENDING, job_queue.RUNNING) ]
+  return flask.render_template("exports.html",
+      finished = finished,
+      running = running,
+      queued = [ (json.loads(job[2])["name"], job[3]) for job in jobs ],
+      format_time = lambda t: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)),
+      )
+
+
+@app.route("/_exports", methods=["POST"])
+@require_auth
+@require_admin
+def start_export():
+  name = "AHGL_S%s_%s.zip" % (re.sub("[^a-zA-Z0-9]", "", get_season_name()),
+      time.strftime("%Y%m%d-%H%M%S"))
+  def write(cursor):
+    job_queue.enqueue(cursor, "export_season",
+        dict(name=name, compression=app.config["EXPORT_COMPRESSION"]))
+  run_write_transaction(write)
+  return flask.redirect(flask.url_for(exports_page.__name__))
+
+
+@app.route("/_exports/<name>")
+@require_auth
+@require_admin
+@content_type("application/zip")
+def get_export(name):
+  if not _EXPORT_NAME_RE.match(name):
+    flask.abort(404)
+  path = os.path.join(get_export_dir(), name)
+  try:
+    mtime = os.path.getmtime(path)
+  except OSError:
+    flask.abort(404)
+  return send_file_response(path, "%s-%d" % (name, mtime), "private, no-cache")
+
+
+# Build every pack the week touches in the background, so its download
+# links are all served from disk (see ahgl_worker.close_week).
+@app.route("/_close-week", methods=["POST"])
+@require_auth
+@require_admin
+def close_week():
+  try:
+    week = int(flask.request.form["week"])
+  except (KeyError, ValueError):
+    return "Invalid week"
+  def write(cursor):
+    job_queue.enqueue(cursor, "close_week", dict(week=week), unique=True)
+  run_write_transaction(write)
+  return flask.redirect(flask.url_for(jobs_page.__name__))
+
+
 @app.route("/")
 def home_page():
   return flask.render_template("home.html", links=dict(
@@ -90,26 +843,35 @@ def home_page():
       show_result = flask.url_for(show_result_select.__name__),
       enter_result = flask.url_for(enter_result.__name__),
       view_rosters = flask.url_for(view_rosters.__name__),
+      standings = flask.url_for(standings_page.__name__),
+      bulk_import = flask.url_for(enter_import.__name__),
     ))
 
 
 @app.route("/login/<auth_key>")
 def login(auth_key):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id FROM accounts WHERE auth_key = ?", (auth_key,))
+  with contextlib.closing(get_db().cursor()) as cursor:
+    cursor.execute("SELECT id, email FROM accounts WHERE auth_key = ?", (auth_key,))
     results = list(cursor)
 
   if not results:
     return flask.render_template("no_account.html")
 
-  flask.session["account"] = results[0][0]
+  clear_login()
+  flask.session["account"], flask.session["account_email"] = results[0]
+  flask.session["account_season"] = get_season_name()
 
   return flask.redirect(flask.url_for(home_page.__name__))
 
 
+def clear_login():
+  for key in ("account", "account_email", "account_season", "account_team"):
+    flask.session.pop(key, None)
+
+
 @app.route("/logout")
 def logout():
-  del flask.session["account"]
+  clear_login()
   return flask.redirect(flask.url_for(home_page.__name__))
 
 
@@ -117,10 +879,10 @@ def logout():
 @require_auth
 @require_admin
 def enter_maps():
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT MAX(week) FROM maps")
     week_number = (list(cursor)[0][0] or 0) + 1
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT id, mapname FROM mapnames")
     map_pool = list(cursor)
   return flask.render_template("enter_maps.html",
@@ -146,11 +908,12 @@ def submit_maps():
   except ValueError:
     return "Invalid week"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM maps WHERE week = ?", (week_number,))
     if list(cursor) != [(0,)]:
       return "Maps already submitted"
 
+  map_rows = []
   for setnum in range(1,5+1):
     mapid = postdata.get("map_%d" % setnum)
     if not mapid:
@@ -159,20 +922,76 @@ def submit_maps():
       mapid = int(mapid)
     except ValueError:
       return "Invalid map"
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "INSERT INTO maps(week, set_number, mapid) "
-          "VALUES (?,?,?) "
-          , (week_number, setnum, mapid))
+    map_rows.append((week_number, setnum, mapid))
 
-  g.db.commit()
+  def write(cursor):
+    cursor.executemany(
+        "INSERT INTO maps(week, set_number, mapid) "
+        "VALUES (?,?,?) "
+        , map_rows)
+    return week_versions.bump(cursor, week_number)
+  try:
+    version = run_write_transaction(write)
+  except get_db().IntegrityError:
+    return "Maps already submitted"
+
+  publish_week_change(week_number, version, "maps")
 
   return flask.render_template("success.html", item_type="Maps")
 
 
+@app.route("/import")
+@require_auth
+@require_admin
+def enter_import():
+  return flask.render_template("import.html",
+      kinds = bulk_import.KINDS,
+      columns = bulk_import.COLUMNS,
+      submit_link = flask.url_for(submit_import.__name__),
+      )
+
+
+@app.route("/submit-import", methods=["POST"])
+@require_auth
+@require_admin
+def submit_import():
+  upload = flask.request.files.get("file")
+  if not upload or not upload.filename:
+    return "No file submitted"
+  fmt = flask.request.form.get("format") or bulk_import.guess_format(upload.filename)
+  kind = flask.request.form.get("kind") or bulk_import.guess_kind(upload.filename)
+
+  try:
+    rows = list(bulk_import.read_rows(upload.stream, fmt, kind))
+  except bulk_import.BadImport as err:
+    return "Invalid import: %s" % err
+  except csv.Error as err:
+    return "Invalid CSV: %s" % err
+
+  # Check and write under one lock, so nothing changes in between.
+  def write(cursor):
+    importer = bulk_import.Importer(cursor)
+    for row_kind, num, row in rows:
+      importer.add(row_kind, num, row)
+    if importer.errors:
+      return importer, []
+    return importer, [ (week, week_versions.bump(cursor, week)) for week in importer.apply(cursor) ]
+  importer, versions = run_write_transaction(write)
+  for week, version in versions:
+    publish_week_change(week, version, "change")
+
+  counts = importer.counts()
+  return flask.render_template("import_result.html",
+      errors = importer.errors,
+      counts = [ (name, counts[name]) for name in bulk_import.KINDS ],
+      accounts = [ (email, flask.url_for(login.__name__, auth_key=auth_key, _external=True))
+        for (email, auth_key) in importer.generated_keys ],
+      )
+
+
 @app.route("/show-lineup")
 def show_lineup_select():
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
     weeks = [ int(row[0]) for row in cursor ]
 
@@ -185,47 +1004,23 @@ def show_lineup_select():
 
 
 @app.route("/show-lineup/<int:week>")
-def show_lineup_week(week):
-  teams = {}
-  captains = {}
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name, captain_info FROM teams")
-    for tid, name, captain in cursor:
-      teams[tid] = name
-      captains[tid] = captain
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT match_number, home_team, away_team, "
-        "main_ref_team, backup_ref_team "
-        "FROM matches WHERE week = ?", (week,))
-    matches = dict((row[0], (row[1], row[2], row[3], row[4])) for row in cursor)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week,))
-    maps = dict((row[0], row[1]) for row in cursor)
-
-  refs = collections.defaultdict(lambda: "no ref")
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT team, referee_name FROM referees WHERE week = ?", (week,))
-    refs.update(cursor)
-
+# archived renders the page for a season export (see season_export), with
+# no live updates.
+@cached_week_page
+def show_lineup_week(snap, archived=False):
+  week = snap.week
+  teams = snap.teams
+  captains = snap.captains
+  maps = snap.maps
+  refs = collections.defaultdict(lambda: "no ref", snap.refs)
   lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name || '.' || IFNULL(p.char_code, 'COWARD'), race "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player, race) in cursor:
-      lineups[team][set_number] = (player, race)
+  for team, sets in snap.lineups.items():
+    for setnum, (player, race) in sets.items():
+      lineups[team][setnum] = (snap.players[player][1], race)
 
   # TODO: Jinja-ize this.
   lineup_displays = []
-  for (match, (home, away, ref1t, ref2t)) in sorted(matches.items()):
+  for (match, (home, away, ref1t, ref2t)) in sorted(snap.matches.items()):
     lineup_displays.append("<h2>Match %d: %s vs %s</h2>"
         % (match, cgi.escape(teams[home]), cgi.escape(teams[away])))
     lineup_displays.append("<h3>Suggested channel: ahgl-%d</h3>" % match)
@@ -260,16 +1055,17 @@ def show_lineup_week(week):
       </head>
       <body>
         <h1>AHGL Lineup Week %d</h1>
-        %s
+        %s%s
       </body>
     </html>
-  """ % (week, "".join(lineup_displays))).encode()])
+  """ % (week, "".join(lineup_displays),
+    "" if archived else reload_on_change_script(week, snap.version))).encode()])
 
 
 @app.route("/enter-lineup")
 @require_auth
 def enter_lineup():
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT MAX(week) FROM maps")
     week_number = list(cursor)[0][0]
   try:
@@ -277,23 +1073,18 @@ def enter_lineup():
   except (ValueError, TypeError):
     pass
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week_number,))
-    maps = dict((row[0], row[1]) for row in cursor)
+  maps = get_week_snapshot(week_number).maps
 
   team_number = get_user_team()
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT name FROM teams WHERE id = ?", (team_number,))
     team_name = list(cursor)[0][0]
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT id, name FROM players WHERE team = ? AND active = 1 ORDER BY name", (team_number,))
     players = list(cursor)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM lineup WHERE week = ? AND team = ?", (week_number, team_number,))
     lineup_already_entered = bool(list(cursor)[0][0])
 
@@ -338,32 +1129,27 @@ def submit_lineup():
   if not referee:
     return "No referee submitted"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT name FROM teams WHERE id = ?", (team_number,))
     if len(list(cursor)) != 1:
       return "Invalid team"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps WHERE week = ?", (week_number,))
     if len(list(cursor)) != 1:
       return "Invalid week"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM lineup WHERE team = ? AND week = ?", (team_number, week_number))
     if list(cursor) != [(0,)]:
       return "Lineup already submitted"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT id FROM players WHERE team = ? AND active = 1", (team_number,))
     eligible_players = set([row[0] for row in cursor])
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "INSERT INTO referees(week, team, referee_name) "
-        "VALUES (?,?,?) "
-        , (week_number, team_number, referee))
-
   entered_players = set()
+  lineup_rows = []
 
   for setnum in range(1,5):
     player = postdata.getlist("player_%d" % setnum)
@@ -387,20 +1173,32 @@ def submit_lineup():
     if race not in list("TZPR"):
       return "Invalid race for player %d" % setnum
 
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "INSERT INTO lineup(week, team, set_number, player, race) "
-          "VALUES (?,?,?,?,?) "
-          , (week_number, team_number, setnum, player, race))
+    lineup_rows.append((week_number, team_number, setnum, player, race))
 
-  g.db.commit()
+  def write(cursor):
+    cursor.execute(
+        "INSERT INTO referees(week, team, referee_name) "
+        "VALUES (?,?,?) "
+        , (week_number, team_number, referee))
+    cursor.executemany(
+        "INSERT INTO lineup(week, team, set_number, player, race) "
+        "VALUES (?,?,?,?,?) "
+        , lineup_rows)
+    return week_versions.bump(cursor, week_number)
+  try:
+    version = run_write_transaction(write)
+  except get_db().IntegrityError:
+    # Another submission for this team won the race.
+    return "Lineup already submitted"
+
+  publish_week_change(week_number, version, "lineup")
 
   return flask.render_template("success.html", item_type="Lineup")
 
 
 @app.route("/show-result")
 def show_result_select():
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
     weeks = [ int(row[0]) for row in cursor ]
 
@@ -413,49 +1211,23 @@ def show_result_select():
 
 
 @app.route("/show-result/<int:week>")
-def show_result_week(week):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name FROM teams")
-    teams = dict(cursor)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT match_number, home_team, away_team FROM matches WHERE week = ?", (week,))
-    matches = dict((row[0], (row[1], row[2])) for row in cursor)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week,))
-    maps = dict((row[0], row[1]) for row in cursor)
-
+# archived renders the page for a season export (see season_export): replay
+# links point into the archive's replays/ directory, and there is no pack
+# link or live updates.
+@cached_week_page
+def show_result_week(snap, archived=False):
+  week = snap.week
+  teams = snap.teams
+  matches = dict((match, row[:2]) for (match, row) in snap.matches.items())
+  maps = snap.maps
   lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name || '.' || IFNULL(p.char_code, 'COWARD'), race "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player, race) in cursor:
-      lineups[team][set_number] = (player, race)
-
-  results = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT match_number, set_number, home_winner, away_winner, forfeit, replay_hash FROM set_results WHERE week = ?", (week,))
-    for (match_number, set_number, home_winner, away_winner, forfeit, replay_hash) in cursor:
-      results[match_number][set_number] = (home_winner, away_winner, forfeit, replay_hash)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT match_number, "
-        "hp.name || '.' || IFNULL(hp.char_code, 'COWARD'), "
-        "ap.name || '.' || IFNULL(ap.char_code, 'COWARD'), "
-        "home_race, away_race "
-        "FROM ace_matches "
-        "JOIN players hp ON ace_matches.home_player = hp.id "
-        "JOIN players ap ON ace_matches.away_player = ap.id "
-        "WHERE week = ?", (week,))
-    aces = dict((row[0], row[1:]) for row in cursor)
+  for team, sets in snap.lineups.items():
+    for setnum, (player, race) in sets.items():
+      lineups[team][setnum] = (snap.players[player][1], race)
+  results = collections.defaultdict(dict, snap.results)
+  aces = dict(
+      (match, (snap.players[hp][1], snap.players[ap][1], hrace, arace))
+      for (match, (hp, ap, hrace, arace)) in snap.aces.items())
 
   # TODO: Jinja-ize this.
   result_displays = []
@@ -495,8 +1267,12 @@ def show_result_week(week):
         replayhash = results[match][setnum][3]
         def cleanit(word):
           return re.sub("[^a-zA-Z0-9]", "", word)
-        replaylink = "/replay/%s/%s-%s_%d_%s-%s.SC2Replay" % (
-            replayhash, cleanit(teams[home]), cleanit(teams[away]), setnum, cleanit(homeplayer[0]), cleanit(awayplayer[0]))
+        if archived:
+          replaylink = "../replays/%s.SC2Replay" % replayhash
+        else:
+          replaylink = flask.url_for(get_replay.__name__, rephash=replayhash,
+              fakepath="%s-%s_%d_%s-%s.SC2Replay" % (
+                cleanit(teams[home]), cleanit(teams[away]), setnum, cleanit(homeplayer[0]), cleanit(awayplayer[0])))
         result_displays.append(" -- <a href=\"%s\">replay</a>" % cgi.escape(replaylink, True))
 
       result_displays.append("<br>")
@@ -508,20 +1284,23 @@ def show_result_week(week):
       </head>
       <body>
         <h1>AHGL Result Week %(week)d</h1>
-        <p><a href="/replay-pack/%(week)d/ahgl_replays_season_%(season)s_week_%(week)d.zip">Replay Pack</a></p>
-        %(display)s
+        %(pack)s
+        %(display)s%(script)s
       </body>
     </html>
   """ % dict(
     week = week,
-    season = app.config["SEASON"],
+    pack = "" if archived else '<p><a href="%s">Replay Pack</a></p>' % cgi.escape(
+      flask.url_for(get_replay_pack.__name__, week=week,
+        fakepath="ahgl_replays_season_%s_week_%d.zip" % (get_season_name(), week)), True),
     display = "".join(result_displays),
+    script = "" if archived else reload_on_change_script(week, snap.version),
     )).encode()])
 
 
 @app.route("/enter-result")
 def enter_result():
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT MAX(week) FROM maps")
     week_number = max(1, list(cursor)[0][0]-1)
   try:
@@ -529,20 +1308,13 @@ def enter_result():
   except (ValueError, TypeError):
     pass
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT match_number, ht.name, at.name FROM matches, teams ht, teams at WHERE week = ? AND ht.id = home_team AND at.id = away_team", (week_number,))
-    matches = list(cursor)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week_number,))
-    maps = dict((row[0], row[1]) for row in cursor)
+  snap = get_week_snapshot(week_number)
+  matches = [ (match, snap.teams[home], snap.teams[away])
+      for (match, (home, away, _, _)) in sorted(snap.matches.items()) ]
 
   extra_params = {}
   for role in ["home", "away"]:
-    with contextlib.closing(g.db.cursor()) as cursor:
+    with contextlib.closing(get_db().cursor()) as cursor:
       cursor.execute(
           "SELECT players.id, teams.name, players.name "
           "FROM matches "
@@ -564,6 +1336,14 @@ def enter_result():
       **extra_params)
 
 
+def get_replay_store():
+  root = app.config["REPLAY_DIR"]
+  if root is None:
+    parent = app.config["DATA_DIR"] if get_season() is None else app.config["SEASONS_DIR"]
+    root = os.path.join(parent, "replays")
+  return replay_store.ReplayStore(root, get_data_dir())
+
+
 @app.route("/submit-result", methods=["POST"])
 def submit_result():
   postdata = flask.request.form
@@ -636,14 +1416,14 @@ def submit_result():
       return "Invalid home ace race specified."
     if away_ace_race not in list("TZPR"):
       return "Invalid home ace race specified."
-    with contextlib.closing(g.db.cursor()) as cursor:
+    with contextlib.closing(get_db().cursor()) as cursor:
       cursor.execute(
           "SELECT home_team, away_team "
           "FROM matches "
           "WHERE week = ? AND match_number = ?"
           , (week_number, match))
       (home_team, away_team) = list(cursor)[0]
-    with contextlib.closing(g.db.cursor()) as cursor:
+    with contextlib.closing(get_db().cursor()) as cursor:
       cursor.execute("SELECT id, team FROM players WHERE id IN (?,?)", (home_ace, away_ace,))
       membership = dict(cursor)
     if membership[home_ace] != home_team:
@@ -651,17 +1431,17 @@ def submit_result():
     if membership[away_ace] != away_team:
       return "Away ace is on the wrong team."
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps WHERE week = ?", (week_number,))
     if len(list(cursor)) != 1:
       return "Invalid week"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM matches WHERE week = ? AND match_number = ?", (week_number, match))
     if list(cursor) != [(1,)]:
       return "Invalid match"
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM set_results WHERE week = ? AND match_number = ?", (week_number, match))
     if list(cursor) != [(0,)]:
       return "Result already submitted"
@@ -672,37 +1452,82 @@ def submit_result():
     repfield = flask.request.files.get("replay_%d" % setnum)
     if not repfield:
       continue
-    rep = repfield.read()
-    rephash = hashlib.sha1(rep).hexdigest()
-    repfile = os.path.join(app.config["DATA_DIR"], rephash + ".SC2Replay")
-    if not os.path.exists(repfile):
-      with open(repfile, "wb") as handle:
-        handle.write(rep)
-    rephashes[setnum] = rephash
+    try:
+      rephashes[setnum] = get_replay_store().add_stream(
+          repfield.stream, app.config["MAX_REPLAY_SIZE"])
+    except replay_store.ReplayTooLarge:
+      return "Replay %d is too large" % setnum
 
+  result_rows = []
   for setnum in range(1, 5+1):
     forfeit = 1 if postdata.get("forfeit_%d" % setnum) == "on" else 0
     wins = winners[setnum]
-    g.db.cursor().execute(
+    result_rows.append(
+        (week_number, match, setnum, wins[0], wins[1], forfeit, rephashes.get(setnum)))
+
+  def write(cursor):
+    cursor.executemany(
         "INSERT INTO set_results(week, match_number, set_number, home_winner, away_winner, forfeit, replay_hash) "
         "VALUES (?,?,?,?,?,?,?) "
-        , (week_number, match, setnum, wins[0], wins[1], forfeit, rephashes.get(setnum)))
-
-  if sum(winners[5]):
-    g.db.cursor().execute(
-        "INSERT INTO ace_matches(week, match_number, home_player, away_player, home_race, away_race) "
-        "VALUES (?,?,?,?,?,?) "
-        , (week_number, match, home_ace, away_ace, home_ace_race, away_ace_race))
+        , result_rows)
+    if sum(winners[5]):
+      cursor.execute(
+          "INSERT INTO ace_matches(week, match_number, home_player, away_player, home_race, away_race) "
+          "VALUES (?,?,?,?,?,?) "
+          , (week_number, match, home_ace, away_ace, home_ace_race, away_ace_race))
+    league_stats.apply_match(cursor, week_number, match)
+    players = enqueue_result_jobs(cursor, week_number, match, rephashes)
+    return week_versions.bump(cursor, week_number), players
+  try:
+    version, players = run_write_transaction(write)
+  except get_db().IntegrityError:
+    return "Result already submitted"
 
-  g.db.commit()
+  if rephashes:
+    remove_result_packs(week_number, players)
+  publish_week_change(week_number, version, "result")
 
   return flask.render_template("success.html", item_type="Result")
 
 
+# Follow-up work for a submitted result, for ahgl_worker.py: check the
+# stored replays, then rebuild the week's pack and the packs of the players
+# whose replays were added.  Returns those players.
+def enqueue_result_jobs(cursor, week, match, rephashes):
+  for rephash in sorted(set(rephashes.values())):
+    job_queue.enqueue(cursor, "verify_replay", dict(hash=rephash), unique=True)
+  if not rephashes:
+    return []
+  job_queue.enqueue(cursor, "build_week_pack", dict(week=week), unique=True)
+  cursor.execute(
+      "SELECT l.set_number, l.player "
+      "FROM matches m JOIN lineup l ON l.week = m.week "
+        "AND (l.team = m.home_team OR l.team = m.away_team) "
+      "WHERE m.week = ? AND m.match_number = ? "
+      "UNION ALL "
+      "SELECT 5, home_player FROM ace_matches WHERE week = ? AND match_number = ? "
+      "UNION ALL "
+      "SELECT 5, away_player FROM ace_matches WHERE week = ? AND match_number = ? "
+      , (week, match, week, match, week, match))
+  players = set(player for (setnum, player) in cursor if setnum in rephashes)
+  for player in sorted(players):
+    job_queue.enqueue(cursor, "build_player_pack", dict(player=player), unique=True)
+  return sorted(players)
+
+
+# Remove the cached packs a result's replays have made stale.  That much is
+# cheap and done at once, so old packs do not pile up when no worker is
+# running; only building the new ones is left to the jobs.
+def remove_result_packs(week, players):
+  remove_cached_packs("week-%d-*.zip" % week)
+  for player in players:
+    remove_cached_packs("player-%d-*.zip" % player)
+
+
 @app.route("/view-rosters")
 def view_rosters():
   players = []
-  with contextlib.closing(g.db.cursor()) as cursor:
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute(
         "SELECT t.name, p.id, p.name, IFNULL(p.char_code, 'COWARD'), p.active "
         "FROM players p JOIN teams t ON p.team = t.id "
@@ -718,127 +1543,658 @@ def view_rosters():
       )
 
 
-@app.route("/replay/<rephash>/<fakepath>")
-@content_type("application/octet-stream")
-def get_replay(rephash, fakepath):
-  match = re.search(r'^[0-9a-f]{40}$', rephash)
-  if not match:
+@app.route("/standings")
+def standings_page():
+  with contextlib.closing(get_db().cursor()) as cursor:
+    cursor.execute(
+        "SELECT t.id, t.name, "
+        "IFNULL(s.matches_won, 0) AS matches_won, IFNULL(s.matches_lost, 0) AS matches_lost, "
+        "IFNULL(s.sets_won, 0), IFNULL(s.sets_lost, 0), "
+        "IFNULL(s.sets_won, 0) - IFNULL(s.sets_lost, 0) AS set_difference, "
+        "IFNULL(s.aces_won, 0), IFNULL(s.aces_lost, 0) "
+        "FROM teams t LEFT JOIN team_standings s ON s.team = t.id "
+        "ORDER BY matches_won DESC, set_difference DESC, matches_lost, t.name "
+        )
+    standings = list(cursor)
+  return flask.render_template("standings.html",
+      standings = standings,
+      )
+
+
+@app.route("/player-stats/<int:player>")
+def player_stats_page(player):
+  with contextlib.closing(get_db().cursor()) as cursor:
+    cursor.execute(
+        "SELECT p.name || '.' || IFNULL(p.char_code, 'COWARD'), "
+        "s.category, s.key, s.wins, s.losses "
+        "FROM players p LEFT JOIN player_stats s ON s.player = p.id "
+        "WHERE p.id = ? "
+        "ORDER BY s.category, s.key "
+        , (player,))
+    rows = list(cursor)
+  if not rows:
     flask.abort(404)
+  stats = collections.defaultdict(list)
+  for (_, category, key, wins, losses) in rows:
+    if category is not None:
+      stats[category].append((key, wins, losses))
+  return flask.render_template("player_stats.html",
+      player_name = rows[0][0],
+      stats = stats,
+      )
+
+
+def quote_etag(etag):
+  return '"%s"' % etag
+
+
+def not_modified_response(etag, cache_control):
+  if not flask.request.if_none_match.contains_weak(etag):
+    return None
+  resp = flask.Response(status=304)
+  resp.headers["ETag"] = quote_etag(etag)
+  resp.headers["Cache-Control"] = cache_control
+  return resp
+
+
+def send_file_response(path, etag, cache_control):
+  not_modified = not_modified_response(etag, cache_control)
+  if not_modified:
+    return not_modified
 
   try:
-    handle = open(os.path.join(app.config["DATA_DIR"], rephash + ".SC2Replay"), "rb")
+    handle = open(path, "rb")
   except IOError as err:
     if err.errno != errno.ENOENT:
       raise
     flask.abort(404)
 
+  size = os.fstat(handle.fileno()).st_size
+  headers = {
+    "ETag": quote_etag(etag),
+    "Cache-Control": cache_control,
+    "Accept-Ranges": "bytes",
+    }
+
+  mode = app.config["SENDFILE_MODE"]
+  if mode not in (None, "x-sendfile", "x-accel-redirect"):
+    raise Exception("Unknown SENDFILE_MODE %r" % mode)
+  location = accel_redirect_location(path) if mode == "x-accel-redirect" else None
+  if mode == "x-sendfile" or location:
+    # Let the fronting server copy the bytes; it also handles Range.
+    handle.close()
+    if mode == "x-sendfile":
+      headers["X-Sendfile"] = os.path.abspath(path)
+    else:
+      headers["X-Accel-Redirect"] = location
+    return flask.Response("", headers=headers)
+
+  request = flask.request
+  byte_range = request.range
+  if_range = request.if_range
+  if byte_range and (if_range.date is not None or if_range.etag not in (None, etag)):
+    # The client's partial copy is of different content, or, going by a
+    # date when no Last-Modified is sent, may be; send it all.
+    byte_range = None
+  if byte_range and len(byte_range.ranges) > 1:
+    # Rather than a multipart response, send it all if any of it is wanted.
+    parts = [ werkzeug.datastructures.Range(byte_range.units, [bounds])
+        for bounds in byte_range.ranges ]
+    if any(part.range_for_length(size) for part in parts):
+      byte_range = None
+  if byte_range:
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+      handle.close()
+      headers["Content-Range"] = "bytes */%d" % size
+      return flask.Response("", status=416, headers=headers)
+    start, stop = bounds
+    headers["Content-Range"] = byte_range.to_content_range_header(size)
+    headers["Content-Length"] = str(stop - start)
+    handle.seek(start)
+    return flask.Response(_iter_file_range(handle, stop - start),
+        status=206, headers=headers)
+
+  headers["Content-Length"] = str(size)
+  return flask.Response(
+      werkzeug.wsgi.wrap_file(request.environ, handle, zipstream.CHUNK_SIZE),
+      headers=headers, direct_passthrough=True)
+
+
+# The internal location of path for X-Accel-Redirect, or None if it is
+# outside SENDFILE_ACCEL_ROOT and has to be sent by the app.
+def accel_redirect_location(path):
+  root = os.path.abspath(app.config["SENDFILE_ACCEL_ROOT"] or app.config["DATA_DIR"])
+  relpath = os.path.relpath(os.path.abspath(path), root)
+  if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+    return None
+  return app.config["SENDFILE_ACCEL_PREFIX"] + relpath
+
+
+def _iter_file_range(handle, length):
   with handle:
-    return handle.read()
+    while length > 0:
+      data = handle.read(min(length, zipstream.CHUNK_SIZE))
+      if not data:
+        break
+      length -= len(data)
+      yield data
+
+
+def get_pack_cache_dir():
+  if app.config["PACK_CACHE_DIR"] is None:
+    return os.path.join(get_data_dir(), "packs")
+  if get_season() is None:
+    return app.config["PACK_CACHE_DIR"]
+  return os.path.join(app.config["PACK_CACHE_DIR"], "s", get_season())
+
+
+def pack_fingerprint(members, compression):
+  # Replay file names are content hashes, so the names in and out of the
+  # archive and the compression policy determine its bytes.
+  digest = hashlib.sha1("%s\0%s" % (get_season_name(), compression))
+  for path, arcname in members:
+    digest.update("\0%s\0%s" % (os.path.basename(path), arcname))
+  return digest.hexdigest()
+
+
+# Remove the packs matching pattern, and their lock files, except keep.
+def remove_cached_packs(pattern, keep=None):
+  pattern = os.path.join(get_pack_cache_dir(), pattern)
+  for fname in glob.glob(pattern) + glob.glob(pattern + ".lock"):
+    if fname in (keep, "%s.lock" % keep):
+      continue
+    try:
+      os.unlink(fname)
+    except OSError as err:
+      if err.errno != errno.ENOENT:
+        raise
+
+
+def send_cached_zip(cache_path, fingerprint, members, compression):
+  cache_control = "no-cache"
+  not_modified = not_modified_response(fingerprint, cache_control)
+  if not_modified:
+    return not_modified
+  if not os.path.exists(cache_path):
+    # Building or waiting for a build may take a while, and needs nothing
+    # from the database.
+    release_db()
+    build_pack(cache_path, members, compression, app.config["PACK_LOCK_WAIT"])
+  try:
+    return send_file_response(cache_path, fingerprint, cache_control)
+  except NotFound:
+    pass
+  # Someone else is still building it, or it was invalidated since: send a
+  # copy of our own.
+  resp = flask.Response(zipstream.iter_zip(members, compression=compression))
+  resp.headers["ETag"] = quote_etag(fingerprint)
+  resp.headers["Cache-Control"] = cache_control
+  return resp
 
 
-@app.route("/player-replays/<int:player>/<fakepath>")
+def _makedirs(path):
+  try:
+    os.makedirs(path)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+
+
+# Build the pack at cache_path unless it is there already.  When a week
+# closes and everyone asks for its pack at once it is built only once: the
+# rest wait, up to `wait` seconds (None to wait as long as it takes), for
+# whoever holds its lock.  Returns whether the pack is there.
+def build_pack(cache_path, members, compression, wait=None):
+  _makedirs(os.path.dirname(cache_path))
+  deadline = None if wait is None else time.time() + wait
+  while not os.path.exists(cache_path):
+    lock = _lock_pack(cache_path, deadline)
+    if lock is None:
+      return False
+    with lock:
+      if not os.path.exists(cache_path):
+        _write_pack(cache_path, zipstream.iter_zip(members, compression=compression))
+  return True
+
+
+# The locked handle of cache_path's lock file, or None if it could not be
+# had by the deadline.  The lock goes with the process, so a builder that
+# dies does not block the rest.  Lock files are left in place, except by
+# remove_cached_packs, so a lock taken on a file that has since been
+# removed is dropped and taken again on the current one.
+def _lock_pack(cache_path, deadline=None):
+  lock_path = cache_path + ".lock"
+  while True:
+    handle = open(lock_path, "a")
+    try:
+      if deadline is None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+      else:
+        while True:
+          try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+          except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+              raise
+          if time.time() >= deadline:
+            handle.close()
+            return None
+          time.sleep(0.05)
+      try:
+        current = os.stat(lock_path).st_ino
+      except OSError as err:
+        if err.errno != errno.ENOENT:
+          raise
+        current = None
+      if current == os.fstat(handle.fileno()).st_ino:
+        return handle
+    except:
+      handle.close()
+      raise
+    handle.close()
+
+
+def _write_pack(cache_path, chunks):
+  # Build into a private temporary file and rename it into place only once
+  # the archive is complete, so readers never see a partial pack.
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+  complete = False
+  try:
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "wb") as handle:
+      for chunk in chunks:
+        handle.write(chunk)
+    os.rename(tmp_path, cache_path)
+    complete = True
+  finally:
+    if not complete:
+      os.unlink(tmp_path)
+
+
+@app.route("/replay/<rephash>/<fakepath>")
 @content_type("application/octet-stream")
-def get_player_replays(player, fakepath):
-  with contextlib.closing(g.db.cursor()) as cursor:
+def get_replay(rephash, fakepath):
+  if not replay_store.is_replay_hash(rephash):
+    flask.abort(404)
+  path = get_replay_store().lookup(rephash)
+  if not path:
+    flask.abort(404)
+
+  # Replay URLs are addressed by content hash, so they never change.
+  return send_file_response(
+      path, rephash, "public, max-age=31536000, immutable")
+
+
+# The (path, arcname) pairs in a player's replay archive.
+def player_pack_members(player):
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute("SELECT name FROM players WHERE id = ?", (player,))
-    pname = list(cursor)[0][0]
+    rows = list(cursor)
+  if not rows:
+    flask.abort(404)
+  pname = rows[0][0]
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT m.week, m.match_number, l.set_number "
-        "FROM matches m JOIN lineup l ON m.week = l.week "
-          "AND (m.home_team = l.team OR m.away_team = l.team) "
-        "WHERE player = ? "
-        , (player,))
-    non_ace_wms = list(cursor)
+  prefix = "AHGL_S%s_%s" % (get_season_name(), re.sub("[^a-zA-Z0-9]", "", pname))
 
-  with contextlib.closing(g.db.cursor()) as cursor:
+  # Each branch is an indexed lookup on the player, joined to set_results
+  # by primary key.  Sets that were not played or have no replay drop out.
+  members = []
+  with contextlib.closing(get_db().cursor()) as cursor:
     cursor.execute(
-        "SELECT week, match_number, 5 "
-        "FROM ace_matches "
-        "WHERE home_player = ? OR away_player = ?"
-        , (player, player))
-    ace_wms = list(cursor)
+        "SELECT s.week, s.match_number, s.set_number, s.replay_hash "
+        "FROM lineup l "
+        "JOIN matches m ON m.week = l.week AND m.home_team = l.team "
+        "JOIN set_results s ON s.week = l.week "
+          "AND s.match_number = m.match_number AND s.set_number = l.set_number "
+        "WHERE l.player = ? AND s.replay_hash IS NOT NULL "
+        "UNION ALL "
+        "SELECT s.week, s.match_number, s.set_number, s.replay_hash "
+        "FROM lineup l "
+        "JOIN matches m ON m.week = l.week AND m.away_team = l.team "
+        "JOIN set_results s ON s.week = l.week "
+          "AND s.match_number = m.match_number AND s.set_number = l.set_number "
+        "WHERE l.player = ? AND s.replay_hash IS NOT NULL "
+        "UNION ALL "
+        "SELECT s.week, s.match_number, s.set_number, s.replay_hash "
+        "FROM ace_matches a "
+        "JOIN set_results s ON s.week = a.week "
+          "AND s.match_number = a.match_number AND s.set_number = 5 "
+        "WHERE a.home_player = ? AND s.replay_hash IS NOT NULL "
+        "UNION ALL "
+        "SELECT s.week, s.match_number, s.set_number, s.replay_hash "
+        "FROM ace_matches a "
+        "JOIN set_results s ON s.week = a.week "
+          "AND s.match_number = a.match_number AND s.set_number = 5 "
+        "WHERE a.away_player = ? AND s.replay_hash IS NOT NULL "
+        "ORDER BY 1, 2, 3 "
+        , (player, player, player, player))
+    rows = list(cursor)
+
+  store = get_replay_store()
+  for (w, m, s, replayhash) in rows:
+    path = store.lookup(replayhash)
+    if not path:
+      app.logger.warning("Missing replay %s", replayhash)
+      continue
+    members.append((path, prefix + "/Week%d-Set%d.SC2Replay" % (w, s)))
+  return members
 
-  prefix = "AHGL_S%s_%s" % (app.config["SEASON"], re.sub("[^a-zA-Z0-9]", "", pname))
 
-  buf = cStringIO.StringIO()
-  zfile = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
+def player_pack_path(player, fingerprint):
+  return os.path.join(get_pack_cache_dir(), "player-%d-%s.zip" % (player, fingerprint))
 
-  for w,m,s in sorted(non_ace_wms + ace_wms):
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "SELECT replay_hash "
-          "FROM set_results "
-          "WHERE week = ? AND match_number = ? AND set_number = ? "
-          , (w,m,s))
-      hashlist = list(cursor)
-      if not hashlist:
-        # Player was in a lineup, but game was not played.
+
+@app.route("/player-replays/<int:player>/<fakepath>")
+@content_type("application/octet-stream")
+def get_player_replays(player, fakepath):
+  members = player_pack_members(player)
+  compression = app.config["PLAYER_REPLAYS_COMPRESSION"]
+  fingerprint = pack_fingerprint(members, compression)
+  return send_cached_zip(player_pack_path(player, fingerprint), fingerprint, members, compression)
+
+
+# The (path, arcname) pairs in a week's replay pack.
+def week_pack_members(week):
+  snap = get_week_snapshot(week)
+  teams = snap.teams
+
+  def cleanit(word):
+    return re.sub("[^a-zA-Z0-9]", "", word)
+
+  store = get_replay_store()
+  members = []
+  for (match, sets) in sorted(snap.results.items()):
+    if match not in snap.matches:
+      continue
+    hteam, ateam = snap.matches[match][:2]
+    for (setnum, (_, _, _, replayhash)) in sorted(sets.items()):
+      if not replayhash:
         continue
-      replayhash = hashlist[0][0]
-      zfile.write(
-        os.path.join(app.config["DATA_DIR"], replayhash + ".SC2Replay"),
-        prefix + "/Week%d-Set%d.SC2Replay" % (w, s))
+      if setnum < 5:
+        hplayer = snap.lineups[hteam][setnum][0]
+        aplayer = snap.lineups[ateam][setnum][0]
+      else:
+        hplayer, aplayer = snap.aces[match][:2]
+      hplayer = snap.players[hplayer][0]
+      aplayer = snap.players[aplayer][0]
+      path = store.lookup(replayhash)
+      if not path:
+        app.logger.warning("Missing replay %s", replayhash)
+        continue
+      members.append((
+        path,
+        "AHGL_S%s_Week-%d/Match-%d_%s-%s/%s-%s_%d_%s-%s.SC2Replay" % (
+          get_season_name(), week, match, cleanit(teams[hteam]), cleanit(teams[ateam]), cleanit(teams[hteam]), cleanit(teams[ateam]), setnum, cleanit(hplayer), cleanit(aplayer))))
+  return members
 
-  zfile.close()
 
-  return buf.getvalue()
+def week_pack_path(week, fingerprint):
+  return os.path.join(get_pack_cache_dir(), "week-%d-%s.zip" % (week, fingerprint))
 
 
 @app.route("/replay-pack/<int:week>/<fakepath>")
 @content_type("application/zip")
 def get_replay_pack(week, fakepath):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name FROM teams")
-    teams = dict(cursor)
+  # The archive is built after this request's database connection has been
+  # released, so everything it needs is gathered first.
+  members = week_pack_members(week)
+  compression = app.config["REPLAY_PACK_COMPRESSION"]
+  fingerprint = pack_fingerprint(members, compression)
+  return send_cached_zip(week_pack_path(week, fingerprint), fingerprint, members, compression)
 
-  lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player) in cursor:
-      lineups[team][set_number] = player
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT match_number, hp.name, ap.name "
-        "FROM ace_matches "
-        "JOIN players hp ON ace_matches.home_player = hp.id "
-        "JOIN players ap ON ace_matches.away_player = ap.id "
-        "WHERE week = ?", (week,))
-    aces = dict((row[0], row[1:]) for row in cursor)
 
-  buf = cStringIO.StringIO()
-  zfile = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
+# Build a pack into the cache unless it is there already, and remove older
+# versions of it.  Used by background jobs so the first download after a
+# change is served from disk.
+def build_cached_zip(pattern, cache_path, members, compression):
+  build_pack(cache_path, members, compression)
+  remove_cached_packs(pattern, keep=cache_path)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT m.match_number, m.home_team, m.away_team, s.set_number, s.replay_hash "
-        "FROM matches m JOIN set_results s "
-        "  ON m.match_number = s.match_number "
-        "  AND m.week = ? AND s.week = ? "
-        , (week, week))
-    for row in cursor:
-      match, hteam, ateam, setnum, replayhash = row
+
+def build_week_pack(week):
+  members = week_pack_members(week)
+  compression = app.config["REPLAY_PACK_COMPRESSION"]
+  build_cached_zip("week-%d-*.zip" % week,
+      week_pack_path(week, pack_fingerprint(members, compression)), members, compression)
+
+
+def build_player_pack(player):
+  members = player_pack_members(player)
+  compression = app.config["PLAYER_REPLAYS_COMPRESSION"]
+  build_cached_zip("player-%d-*.zip" % player,
+      player_pack_path(player, pack_fingerprint(members, compression)), members, compression)
+
+
+PACK_BUILDERS = {
+  "week": build_week_pack,
+  "player": build_player_pack,
+  }
+
+
+# The packs with replays from the week, as (kind, key) for PACK_BUILDERS:
+# the week's pack and the pack of everyone who played a set with a replay.
+def week_pack_builds(week):
+  snap = get_week_snapshot(week)
+  players = set()
+  for (match, sets) in snap.results.items():
+    if match not in snap.matches:
+      continue
+    hteam, ateam = snap.matches[match][:2]
+    for (setnum, (_, _, _, replayhash)) in sets.items():
       if not replayhash:
         continue
       if setnum < 5:
-        hplayer = lineups[hteam][setnum]
-        aplayer = lineups[ateam][setnum]
-      else:
-        hplayer = aces[match][0]
-        aplayer = aces[match][1]
-      def cleanit(word):
-        return re.sub("[^a-zA-Z0-9]", "", word)
-      zfile.write(
-        os.path.join(app.config["DATA_DIR"], replayhash + ".SC2Replay"),
-        "AHGL_S%s_Week-%d/Match-%d_%s-%s/%s-%s_%d_%s-%s.SC2Replay" % (
-          app.config["SEASON"], week, match, cleanit(teams[hteam]), cleanit(teams[ateam]), cleanit(teams[hteam]), cleanit(teams[ateam]), setnum, cleanit(hplayer), cleanit(aplayer)))
+        for team in (hteam, ateam):
+          if setnum in snap.lineups.get(team, {}):
+            players.add(snap.lineups[team][setnum][0])
+      elif match in snap.aces:
+        players.update(snap.aces[match][:2])
+  return [("week", week)] + [ ("player", player) for player in sorted(players) ]
+
+API_FIELDS = ("maps", "matches", "lineups", "aces", "results")
+
+
+def get_api_fields():
+  fields = flask.request.args.get("fields")
+  if not fields:
+    return API_FIELDS
+  fields = fields.split(",")
+  if not set(fields) <= set(API_FIELDS):
+    flask.abort(400)
+  return tuple(field for field in API_FIELDS if field in fields)
+
+
+# Season data for the API, for one week or (with week=None) every week, in
+# one read transaction with one query per requested kind of data.  Lineups
+# are only included for matches where both teams have entered theirs, the
+# same as on the lineup page.
+def load_api_data(db, week, fields):
+  params = () if week is None else (week,)
+  def where(alias=""):
+    return "" if week is None else " WHERE %sweek = ?" % alias
+
+  with contextlib.closing(db.cursor()) as cursor:
+    cursor.execute("BEGIN")
+    try:
+      cursor.execute("SELECT week, version FROM week_versions" + where(), params)
+      weeks = dict((num, dict(week=num, version=version)) for (num, version) in cursor)
+
+      def week_data(num):
+        if num not in weeks:
+          weeks[num] = dict(week=num, version=0)
+        return weeks[num]
+
+      if "maps" in fields:
+        cursor.execute(
+            "SELECT week, set_number, mapname "
+            "FROM maps JOIN mapnames ON mapid = mapnames.id" + where()
+            + " ORDER BY week, set_number", params)
+        for (num, setnum, mapname) in cursor:
+          week_data(num).setdefault("maps", []).append(dict(set=setnum, map=mapname))
+
+      matches = {}
+      if set(fields) - set(["maps"]):
+        cursor.execute(
+            "SELECT m.week, m.match_number, "
+            "m.home_team, ht.name, m.away_team, at.name, "
+            "m.main_ref_team, rt1.name, m.backup_ref_team, rt2.name "
+            "FROM matches m "
+            "JOIN teams ht ON ht.id = m.home_team "
+            "JOIN teams at ON at.id = m.away_team "
+            "LEFT JOIN teams rt1 ON rt1.id = m.main_ref_team "
+            "LEFT JOIN teams rt2 ON rt2.id = m.backup_ref_team" + where("m.")
+            + " ORDER BY m.week, m.match_number", params)
+        for (num, match, home, hname, away, aname, ref1, r1name, ref2, r2name) in cursor:
+          info = matches[num, match] = dict(match=match,
+              home_team=dict(id=home, name=hname),
+              away_team=dict(id=away, name=aname))
+          if "matches" in fields:
+            info["referee_teams"] = [ dict(id=ref1, name=r1name), dict(id=ref2, name=r2name) ]
+          week_data(num).setdefault("matches", []).append(info)
+
+      if "lineups" in fields:
+        lineups = {}
+        cursor.execute(
+            "SELECT l.week, l.team, l.set_number, l.player, p.name, p.char_code, l.race "
+            "FROM lineup l JOIN players p ON p.id = l.player" + where("l.")
+            + " ORDER BY l.week, l.team, l.set_number", params)
+        for (num, team, setnum, pid, name, char_code, race) in cursor:
+          lineups.setdefault((num, team), []).append(dict(set=setnum,
+              player=dict(id=pid, name=name, char_code=char_code), race=race))
+        for (num, match), info in matches.items():
+          home = lineups.get((num, info["home_team"]["id"]))
+          away = lineups.get((num, info["away_team"]["id"]))
+          info["lineup_entered"] = dict(home=bool(home), away=bool(away))
+          if home and away:
+            info["lineups"] = dict(home=home, away=away)
+
+      if "aces" in fields:
+        cursor.execute(
+            "SELECT a.week, a.match_number, a.home_player, hp.name, hp.char_code, "
+            "a.away_player, ap.name, ap.char_code, a.home_race, a.away_race "
+            "FROM ace_matches a "
+            "JOIN players hp ON hp.id = a.home_player "
+            "JOIN players ap ON ap.id = a.away_player" + where("a."), params)
+        for (num, match, hpid, hname, hcode, apid, aname, acode, hrace, arace) in cursor:
+          if (num, match) in matches:
+            matches[num, match]["ace"] = dict(
+                home_player=dict(id=hpid, name=hname, char_code=hcode), home_race=hrace,
+                away_player=dict(id=apid, name=aname, char_code=acode), away_race=arace)
+
+      if "results" in fields:
+        cursor.execute(
+            "SELECT week, match_number, set_number, home_winner, away_winner, forfeit, replay_hash "
+            "FROM set_results" + where() + " ORDER BY week, match_number, set_number", params)
+        for (num, match, setnum, hwin, awin, forfeit, rephash) in cursor:
+          if (num, match) not in matches:
+            continue
+          winner = "home" if hwin else "away" if awin else None
+          matches[num, match].setdefault("results", []).append(dict(set=setnum,
+              winner=winner, forfeit=bool(forfeit), replay_hash=rephash))
+    finally:
+      db.rollback()
+
+  return [ weeks[num] for num in sorted(weeks) ]
+
+
+# The week versions change with every write, so they stand in for the data.
+def api_etag(week, fields):
+  with contextlib.closing(get_db().cursor()) as cursor:
+    if week is None:
+      cursor.execute("SELECT week, version FROM week_versions ORDER BY week")
+    else:
+      cursor.execute("SELECT week, version FROM week_versions WHERE week = ?", (week,))
+    versions = list(cursor)
+  digest = hashlib.sha1("%s\0%s\0%s\0%r" % (g.db_pool.path, week, ",".join(fields), versions))
+  return digest.hexdigest()
+
+
+def api_response(week):
+  fields = get_api_fields()
+  etag = api_etag(week, fields)
+  resp = not_modified_response(etag, "no-cache")
+  if resp:
+    return resp
+  weeks = load_api_data(get_db(), week, fields)
+  if week is None:
+    data = dict(season=get_season_name(), weeks=weeks)
+  elif weeks:
+    data = dict(season=get_season_name(), **weeks[0])
+  else:
+    flask.abort(404)
+  resp = flask.Response(json.dumps(data, sort_keys=True, separators=(",", ":")),
+      mimetype="application/json")
+  resp.headers["ETag"] = quote_etag(etag)
+  resp.headers["Cache-Control"] = "no-cache"
+  return resp
 
-  zfile.close()
 
-  return buf.getvalue()
+@app.route("/api/season.json")
+def api_season():
+  return api_response(None)
+
+
+@app.route("/api/week/<int:week>.json")
+def api_week(week):
+  return api_response(week)
+
+
+# Server-sent events for one week: an event named "maps", "lineup" or
+# "result" (or "change", for writes seen from another process) each time
+# the week's data changes, with the new week version as its id.
+@app.route("/events/<int:week>")
+def week_events(week):
+  if not app.config["EVENTS_ENABLED"]:
+    flask.abort(404)
+  with contextlib.closing(get_db().cursor()) as cursor:
+    version = week_versions.get(cursor, week)
+  notifier = get_notifier(g.db_pool.path)
+  notifier.publish(week, version, "change")
+  try:
+    # A reconnecting client catches up on anything it missed.
+    seen = int(flask.request.headers["Last-Event-ID"])
+  except (KeyError, ValueError):
+    # So does one whose page was rendered before the stream connected.
+    seen = flask.request.args.get("since", version, type=int)
+
+  keepalive = app.config["EVENTS_KEEPALIVE"]
+  deadline = time.time() + app.config["EVENTS_MAX_SECONDS"]
+
+  # This runs after the request's database connection has been released;
+  # waiting streams only hold a thread.
+  def stream(seen):
+    yield "retry: 2000\n\n"
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      current, kind = notifier.wait(week, seen, min(keepalive, remaining))
+      if current > seen:
+        seen = current
+        yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+            current, kind, json.dumps(dict(week=week, version=current, kind=kind)))
+      else:
+        yield ": keepalive\n\n"
+
+  resp = flask.Response(stream(seen), mimetype="text/event-stream")
+  resp.headers["Cache-Control"] = "no-cache"
+  # Keep a buffering proxy from holding events back.
+  resp.headers["X-Accel-Buffering"] = "no"
+  return resp
+
+
+# Reload the page on any change after the version it was rendered from,
+# if event streams are enabled.
+def reload_on_change_script(week, version):
+  if not app.config["EVENTS_ENABLED"]:
+    return ""
+  return """
+        <script>
+          var events = new EventSource("%s");
+          ["maps", "lineup", "result", "change"].forEach(function(kind) {
+            events.addEventListener(kind, function() { location.reload(); });
+          });
+        </script>""" % cgi.escape(
+            flask.url_for(week_events.__name__, week=week, since=version), True)
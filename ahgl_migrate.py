@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Bring an existing database up to date with the scripts in migrations/.
+#
+# Migrations are named NNN_description.sql and applied in order, each in its
+# own transaction together with the schema_version update, so a failed
+# migration leaves the database at the previous version.  Databases created
+# from schema.sql start at the version recorded there; ones created before
+# schema_version existed are version 0.
+#
+#   ./ahgl_migrate.py data/ahgl.sq3           # upgrade
+#   ./ahgl_migrate.py --status data/ahgl.sq3  # report pending migrations
+import sys
+import os
+import re
+import sqlite3
+import optparse
+
+import league_stats
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Data a migration's tables need filled in from existing rows, run with a
+# cursor in the migration's transaction.
+BACKFILLS = {
+  3: league_stats.rebuild,
+  }
+
+
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+  migrations = []
+  for fname in os.listdir(migrations_dir):
+    match = re.match(r"^(\d+)_.*\.sql$", fname)
+    if match:
+      migrations.append((int(match.group(1)), os.path.join(migrations_dir, fname)))
+  migrations.sort()
+  versions = [ version for version, _ in migrations ]
+  if len(set(versions)) != len(versions):
+    raise Exception("Duplicate migration version in %s" % migrations_dir)
+  return migrations
+
+
+def get_schema_version(conn):
+  cursor = conn.execute(
+      "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+  if not list(cursor)[0][0]:
+    return 0
+  rows = list(conn.execute("SELECT MAX(version) FROM schema_version"))
+  return rows[0][0] or 0
+
+
+def pending_migrations(conn, migrations_dir=MIGRATIONS_DIR):
+  current = get_schema_version(conn)
+  return [ (version, path) for (version, path) in list_migrations(migrations_dir)
+      if version > current ]
+
+
+def split_statements(script):
+  statements = []
+  pending = ""
+  for line in script.splitlines(True):
+    pending += line
+    if sqlite3.complete_statement(pending):
+      statements.append(pending.strip())
+      pending = ""
+  if pending.strip() and not re.match(r"^(\s*--[^\n]*\n?)*\s*$", pending):
+    raise Exception("Incomplete SQL statement: %r" % pending)
+  return statements
+
+
+def upgrade(conn, migrations_dir=MIGRATIONS_DIR, log=None):
+  # The sqlite3 module commits implicitly before DDL statements, so manage
+  # the transactions explicitly in autocommit mode instead.
+  isolation_level = conn.isolation_level
+  conn.isolation_level = None
+  try:
+    return _upgrade(conn, migrations_dir, log)
+  finally:
+    conn.isolation_level = isolation_level
+
+
+def _upgrade(conn, migrations_dir, log):
+  applied = []
+  for version, path in list_migrations(migrations_dir):
+    with open(path) as handle:
+      statements = split_statements(handle.read())
+    # Take the write lock before checking the version, so concurrent
+    # upgraders (e.g. several workers starting at once) apply each
+    # migration exactly once.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      if get_schema_version(conn) >= version:
+        conn.execute("ROLLBACK")
+        continue
+      for statement in statements:
+        conn.execute(statement)
+      if migrations_dir == MIGRATIONS_DIR and version in BACKFILLS:
+        BACKFILLS[version](conn.cursor())
+      conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+      conn.execute("DELETE FROM schema_version")
+      conn.execute("INSERT INTO schema_version VALUES (?)", (version,))
+      conn.execute("COMMIT")
+    except:
+      conn.execute("ROLLBACK")
+      raise
+    if log:
+      log("Applied migration %s" % os.path.basename(path))
+    applied.append(version)
+  return applied
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [--status] DATABASE")
+  parser.add_option("--status", action="store_true",
+      help="only list the migrations that would be applied")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 1:
+    parser.error("expected one database path")
+  if not os.path.exists(args[0]):
+    parser.error("no such database: %s" % args[0])
+
+  def log(msg):
+    sys.stdout.write(msg + "\n")
+
+  conn = sqlite3.connect(args[0])
+  try:
+    log("Schema version %d" % get_schema_version(conn))
+    if options.status:
+      for version, path in pending_migrations(conn):
+        log("Pending migration %s" % os.path.basename(path))
+    else:
+      upgrade(conn, log=log)
+      log("Schema version %d" % get_schema_version(conn))
+  finally:
+    conn.close()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# Run the background jobs queued in the league databases (see job_queue).
+#
+# CONFIG is a Python config file like debug_server.py.  Jobs are taken from
+# DATA_DIR/ahgl.sq3 and from every season under SEASONS_DIR that is not in
+# CLOSED_SEASONS.
+#
+#   ./ahgl_worker.py work CONFIG [--processes N]   # run until stopped
+#   ./ahgl_worker.py work CONFIG --once            # drain the queues and exit
+#   ./ahgl_worker.py status CONFIG
+#   ./ahgl_worker.py close-week CONFIG WEEK [--season SEASON]
+import sys
+import os
+import time
+import signal
+import socket
+import sqlite3
+import threading
+import optparse
+import traceback
+import contextlib
+import multiprocessing
+
+import ahgl_admin
+import job_queue
+import replay_store
+import season_export
+
+
+app = ahgl_admin.app
+
+HANDLERS = {}
+
+
+def handler(kind):
+  def decorator(func):
+    HANDLERS[kind] = func
+    return func
+  return decorator
+
+
+class JobError(Exception):
+  pass
+
+
+@handler("verify_replay")
+def verify_replay(args):
+  rephash = args["hash"]
+  path = ahgl_admin.get_replay_store().lookup(rephash)
+  if not path:
+    raise JobError("Replay %s is missing" % rephash)
+  actual = replay_store.hash_file(path)
+  if actual != rephash:
+    raise JobError("Replay %s is corrupt (contents hash to %s)" % (rephash, actual))
+
+
+@handler("build_week_pack")
+def build_week_pack(args):
+  ahgl_admin.build_week_pack(args["week"])
+
+
+@handler("build_player_pack")
+def build_player_pack(args):
+  ahgl_admin.build_player_pack(args["player"])
+
+
+@handler("export_season")
+def export_season(args):
+  export_dir = os.path.abspath(ahgl_admin.get_export_dir())
+  try:
+    os.makedirs(export_dir)
+  except OSError:
+    if not os.path.isdir(export_dir):
+      raise
+  try:
+    season_export.export_season(os.path.join(export_dir, args["name"]),
+        args["compression"], app.logger.info)
+  except season_export.ExportBusy as err:
+    raise JobError(str(err))
+
+
+def _reset_signals():
+  # Let Pool.terminate() stop builders forked from a worker.
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def _build_pack(task):
+  season, kind, key = task
+  # A fresh app context, so nothing (such as g.db) is used from the parent.
+  with app.app_context(), ahgl_admin.season_context(season):
+    ahgl_admin.PACK_BUILDERS[kind](key)
+  return kind, key
+
+
+# Build every pack with replays from the week at once, each in its own
+# process.  Packs are written to a temporary file and renamed into place,
+# so downloads never see a partial one.
+def build_week_packs(week, processes):
+  builds = ahgl_admin.week_pack_builds(week)
+  tasks = [ (ahgl_admin.get_season(), kind, key) for (kind, key) in builds ]
+  if not tasks:
+    return 0
+  pool = multiprocessing.Pool(min(processes, len(tasks)), _reset_signals)
+  try:
+    for kind, key in pool.imap_unordered(_build_pack, tasks):
+      app.logger.info("Built %s pack %s for week %d", kind, key, week)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return len(tasks)
+
+
+@handler("close_week")
+def close_week(args):
+  build_week_packs(args["week"], app.config["PACK_BUILD_PROCESSES"])
+
+
+# None for DATA_DIR, then the open seasons under SEASONS_DIR.
+def list_seasons():
+  seasons = [None]
+  seasons_dir = app.config["SEASONS_DIR"]
+  if seasons_dir and os.path.isdir(seasons_dir):
+    for season in sorted(os.listdir(seasons_dir)):
+      if (season not in app.config["CLOSED_SEASONS"]
+          and os.path.exists(os.path.join(seasons_dir, season, "ahgl.sq3"))):
+        seasons.append(season)
+  return seasons
+
+
+# Renew the job's lease every third of JOB_LEASE_SECONDS while the block
+# runs, from a thread with its own connection, so a long job (such as an
+# export) is not presumed dead and claimed again while it is still running.
+@contextlib.contextmanager
+def heartbeat(job):
+  path = os.path.join(ahgl_admin.get_data_dir(), "ahgl.sq3")
+  lease = app.config["JOB_LEASE_SECONDS"]
+  stopped = threading.Event()
+
+  def beat():
+    with contextlib.closing(ahgl_admin.open_db(path)) as conn:
+      while not stopped.wait(lease / 3.0):
+        try:
+          with conn:
+            held = job_queue.renew(conn.cursor(), job, lease)
+        except sqlite3.OperationalError as err:
+          app.logger.warning("Could not renew the lease on job %d: %s", job.id, err)
+          continue
+        if not held:
+          app.logger.warning("Job %d is no longer held by %s", job.id, job.worker)
+          return
+
+  thread = threading.Thread(target=beat, name="job-heartbeat")
+  thread.daemon = True
+  thread.start()
+  try:
+    yield
+  finally:
+    stopped.set()
+    thread.join()
+
+
+# Claim and run one job for the season.  Returns False if there was none.
+def run_one(season, worker):
+  with ahgl_admin.season_context(season):
+    job = ahgl_admin.run_write_transaction(
+        lambda cursor: job_queue.claim(cursor, worker, app.config["JOB_LEASE_SECONDS"]))
+    if job is None:
+      return False
+    try:
+      func = HANDLERS.get(job.kind)
+      if func is None:
+        raise JobError("Unknown job kind %r" % job.kind)
+      with heartbeat(job):
+        func(job.args)
+    except Exception as err:
+      if isinstance(err, JobError):
+        error = str(err)
+      else:
+        error = traceback.format_exc()
+      app.logger.warning("Job %d (%s %r, attempt %d) failed: %s",
+          job.id, job.kind, job.args, job.attempts, error)
+      held = ahgl_admin.run_write_transaction(lambda cursor: job_queue.fail(cursor, job, error,
+          app.config["JOB_MAX_ATTEMPTS"], app.config["JOB_RETRY_DELAY"]))
+    else:
+      held = ahgl_admin.run_write_transaction(lambda cursor: job_queue.complete(cursor, job))
+    if not held:
+      app.logger.warning("Job %d was taken over by another worker; outcome not recorded", job.id)
+    return True
+
+
+def work(config, poll_interval, batch, once):
+  app.config.from_pyfile(os.path.abspath(config))
+  worker = "%s:%d" % (socket.gethostname(), os.getpid())
+  stopping = []
+  # Finish the job in hand before stopping.
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+  signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+  while not stopping:
+    ran = 0
+    # Take a few jobs from each season in turn so none is starved.
+    for season in list_seasons():
+      for _ in range(batch):
+        if stopping or not run_one(season, worker):
+          break
+        ran += 1
+    if not ran:
+      if once:
+        break
+      time.sleep(poll_interval)
+
+
+def status(config):
+  app.config.from_pyfile(os.path.abspath(config))
+  for season in list_seasons():
+    with ahgl_admin.season_context(season):
+      with contextlib.closing(ahgl_admin.get_db().cursor()) as cursor:
+        counts = job_queue.counts(cursor)
+    sys.stdout.write("%s:\n" % (season or "current"))
+    for (kind, job_status), count in sorted(counts.items()):
+      sys.stdout.write("  %-20s %-8s %d\n" % (kind, job_status, count))
+
+
+def close_week_now(config, season, week, processes):
+  app.config.from_pyfile(os.path.abspath(config))
+  with ahgl_admin.season_context(season):
+    count = build_week_packs(week, processes or app.config["PACK_BUILD_PROCESSES"])
+  sys.stdout.write("Built %d packs for week %d\n" % (count, week))
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage="%prog work|status CONFIG [options]\n       %prog close-week CONFIG WEEK [options]")
+  parser.add_option("--processes", type="int",
+      help="number of worker processes (default 2), or for close-week of "
+        "processes building packs (default PACK_BUILD_PROCESSES)")
+  parser.add_option("--poll", type="float", default=1.0,
+      help="seconds to wait when there is no work (default 1)")
+  parser.add_option("--batch", type="int", default=10,
+      help="jobs to take from one season before moving to the next (default 10)")
+  parser.add_option("--once", action="store_true",
+      help="exit when the queues are empty (runs a single process)")
+  parser.add_option("--season", help="season to close the week of (default: the current one)")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) == 3 and args[0] == "close-week":
+    try:
+      week = int(args[2])
+    except ValueError:
+      parser.error("invalid week: %s" % args[2])
+    close_week_now(args[1], options.season, week, options.processes)
+    return 0
+  if len(args) != 2 or args[0] not in ("work", "status"):
+    parser.error("expected 'work CONFIG' or 'status CONFIG'")
+  command, config = args
+
+  if command == "status":
+    status(config)
+    return 0
+  nprocesses = 2 if options.processes is None else options.processes
+  if options.once or nprocesses <= 1:
+    work(config, options.poll, options.batch, options.once)
+    return 0
+
+  processes = [ multiprocessing.Process(target=work,
+      args=(config, options.poll, options.batch, False)) for _ in range(nprocesses) ]
+  for process in processes:
+    process.start()
+  def stop(signum, frame):
+    for process in processes:
+      process.terminate()
+  signal.signal(signal.SIGTERM, stop)
+  # Ctrl-C reaches the workers directly.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  for process in processes:
+    while process.is_alive():
+      process.join(1)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# Route tests through Flask's test client, against a database built from
+# the same SQL files as webdriver_tests.py.
+import os
+import re
+import glob
+import time
+import posixpath
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import zipfile
+import contextlib
+import cStringIO
+import json
+
+import ahgl_admin
+import ahgl_worker
+import bulk_import
+import job_queue
+import zipstream
+
+
+TEST_REPLAY_SHA1 = '4e1243bd22c66e76c2ba9eddc1f91394e57f9f83'
+
+WEEK_1_MAPS = [7, 5, 1, 2, 4]
+
+
+class AppTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    self.saved_config = dict(ahgl_admin.app.config)
+    ahgl_admin.app.config.update(DATA_DIR=self.data_dir, SEASON='2', TESTING=True)
+    ahgl_admin.app.secret_key = 'AHGL'
+    self.db_path = os.path.join(self.data_dir, 'ahgl.sq3')
+    self.db = ahgl_admin.open_db(self.db_path)
+    for fname in ['./schema.sql', './test_data.sql', './test_lineup.sql']:
+      with open(fname) as handle:
+        self.db.executescript(handle.read())
+    self.db.executemany('INSERT INTO maps(week, set_number, mapid) VALUES (1,?,?)',
+        list(enumerate(WEEK_1_MAPS, 1)))
+    self.db.commit()
+    self.client = ahgl_admin.app.test_client()
+
+  def tearDown(self):
+    self.db.close()
+    ahgl_admin._pools.clear()
+    ahgl_admin._migrated_paths.clear()
+    ahgl_admin.app.config.clear()
+    ahgl_admin.app.config.update(self.saved_config)
+    shutil.rmtree(self.data_dir)
+
+  def query(self, sql, params=()):
+    with contextlib.closing(self.db.cursor()) as cursor:
+      cursor.execute(sql, params)
+      return list(cursor)
+
+  def login(self, team_id, client=None):
+    auth_key = self.query('SELECT auth_key FROM accounts WHERE team = ?', (team_id,))[0][0]
+    (client or self.client).get('/login/' + auth_key)
+
+  # Twitter beats Zynga 3-1, with a replay for the first set.
+  def submit_result(self):
+    with open('./test_fake_replay.dat', 'rb') as handle:
+      resp = self.client.post('/submit-result', data=dict(
+        week='1', match='1',
+        winner_1='home', winner_2='away', winner_3='home', winner_4='home',
+        replay_1=(handle, 'replay.SC2Replay'),
+        ))
+    self.assertIn('Success', resp.data)
+
+
+class UploadTest(AppTestCase):
+
+  def test_room_for_five_replays(self):
+    config = ahgl_admin.app.config
+    self.assertGreater(config['MAX_CONTENT_LENGTH'], 5 * config['MAX_REPLAY_SIZE'])
+
+  def test_oversized_body_refused(self):
+    ahgl_admin.app.config['MAX_CONTENT_LENGTH'] = 1000
+    resp = self.client.post('/submit-result', data=dict(
+      week='1', match='1', winner_1='home', winner_2='away', winner_3='home', winner_4='home',
+      replay_1=(cStringIO.StringIO('x' * 2000), 'replay.SC2Replay'),
+      ))
+    self.assertEqual(resp.status_code, 413)
+    self.assertFalse(os.path.exists(os.path.join(self.data_dir, 'replays')))
+    self.assertEqual(self.query('SELECT COUNT(*) FROM set_results'), [(0,)])
+
+
+class ReplayPackTest(AppTestCase):
+
+  def test_pack(self):
+    self.submit_result()
+    resp = self.client.get('/replay-pack/1/pack.zip', buffered=True)
+    self.assertEqual(resp.status_code, 200)
+    zfile = zipfile.ZipFile(cStringIO.StringIO(resp.data))
+    name = 'AHGL_S2_Week-1/Match-1_Twitter-Zynga/Twitter-Zynga_1_implausible-ShamWOW.SC2Replay'
+    self.assertEqual(hashlib.sha1(zfile.read(name)).hexdigest(), TEST_REPLAY_SHA1)
+
+    resp = self.client.get('/replay-pack/1/pack.zip', buffered=True,
+        headers={'If-None-Match': resp.headers['ETag']})
+    self.assertEqual(resp.status_code, 304)
+
+  # Fetch the week 1 pack from `count` threads, the first starting alone
+  # and its build held up until during() returns.  Returns the bodies and
+  # the number of archives built.
+  def fetch_during_build(self, count, during):
+    builds = []
+    started = threading.Event()
+    release = threading.Event()
+    iter_zip = zipstream.iter_zip
+    def slow_iter_zip(members, **kwds):
+      builds.append(members)
+      if len(builds) == 1:
+        started.set()
+        release.wait(5)
+      for chunk in iter_zip(members, **kwds):
+        yield chunk
+
+    bodies = []
+    def fetch():
+      client = ahgl_admin.app.test_client()
+      bodies.append(client.get('/replay-pack/1/pack.zip', buffered=True).data)
+    zipstream.iter_zip = slow_iter_zip
+    try:
+      threads = [ threading.Thread(target=fetch) for _ in range(count) ]
+      threads[0].start()
+      self.assertTrue(started.wait(5))
+      for thread in threads[1:]:
+        thread.start()
+      try:
+        during()
+      finally:
+        release.set()
+        for thread in threads:
+          thread.join(10)
+    finally:
+      zipstream.iter_zip = iter_zip
+    self.assertEqual(len(bodies), count)
+    return bodies, len(builds)
+
+  def test_concurrent_misses_build_once(self):
+    self.submit_result()
+    # Let the other requests reach the cache while the pack is building.
+    bodies, builds = self.fetch_during_build(4, lambda: time.sleep(0.2))
+    self.assertEqual(builds, 1)
+    self.assertEqual(len(set(bodies)), 1)
+    pack_dir = os.path.join(self.data_dir, 'packs')
+    self.assertEqual([ name for name in os.listdir(pack_dir) if name.endswith('.tmp') ], [])
+
+  def test_waiting_holds_no_connection(self):
+    ahgl_admin.app.config.update(DB_POOL_SIZE=1)
+    self.submit_result()
+    statuses = []
+    def show_lineup():
+      client = ahgl_admin.app.test_client()
+      thread = threading.Thread(
+          target=lambda: statuses.append(client.get('/show-lineup/1').status_code))
+      thread.start()
+      thread.join(2)
+      self.assertEqual(statuses, [200])
+    self.fetch_during_build(3, show_lineup)
+
+  def test_wait_is_bounded(self):
+    ahgl_admin.app.config.update(PACK_LOCK_WAIT=0.1)
+    self.submit_result()
+    # The second request gives up on the first and streams its own copy.
+    bodies, builds = self.fetch_during_build(2, lambda: time.sleep(0.5))
+    self.assertEqual(builds, 2)
+    self.assertEqual(len(set(bodies)), 1)
+
+  def test_lock_on_removed_file(self):
+    cache_path = os.path.join(self.data_dir, 'pack.zip')
+    held = ahgl_admin._lock_pack(cache_path)
+    got = []
+    waiter = threading.Thread(
+        target=lambda: got.append(ahgl_admin._lock_pack(cache_path, time.time() + 5)))
+    waiter.start()
+    time.sleep(0.2)
+    # The waiter has the old file open; it must not settle for a lock on it.
+    os.unlink(cache_path + '.lock')
+    held.close()
+    waiter.join(10)
+    self.assertEqual(os.fstat(got[0].fileno()).st_ino, os.stat(cache_path + '.lock').st_ino)
+    got[0].close()
+
+
+class AuthTest(AppTestCase):
+
+  def test_deleted_account_is_logged_out(self):
+    self.login(6)
+    self.assertIn('AHGL Lineup Entry', self.client.get('/enter-lineup').data)
+    self.db.execute('DELETE FROM accounts WHERE team = 6')
+    self.db.commit()
+    self.assertIn('No Account', self.client.get('/enter-lineup').data)
+    self.assertIn('No Account', self.client.get('/enter-lineup').data)
+
+  def test_cached_team(self):
+    ahgl_admin.app.config['ACCOUNT_SESSION_TTL'] = 300
+    self.login(6)
+    self.client.get('/enter-lineup')
+    self.db.execute('DELETE FROM accounts WHERE team = 6')
+    self.db.commit()
+    self.assertIn('AHGL Lineup Entry', self.client.get('/enter-lineup').data)
+    ahgl_admin.app.config['ACCOUNT_SESSION_VERSION'] += 1
+    self.assertIn('No Account', self.client.get('/enter-lineup').data)
+
+  def test_login_is_per_season(self):
+    # In archived season 1, account 5 is someone else, and an admin.
+    seasons_dir = os.path.join(self.data_dir, 'seasons')
+    os.makedirs(os.path.join(seasons_dir, '1'))
+    shutil.copy(self.db_path, os.path.join(seasons_dir, '1', 'ahgl.sq3'))
+    season_db = ahgl_admin.open_db(os.path.join(seasons_dir, '1', 'ahgl.sq3'))
+    season_db.execute(
+        "UPDATE accounts SET team = -1, email = 'old@day9.tv', auth_key = 'old' WHERE id = 5")
+    season_db.commit()
+    season_db.close()
+    ahgl_admin.app.config['SEASONS_DIR'] = seasons_dir
+
+    self.login(1)
+    self.assertIn('AHGL Lineup Entry', self.client.get('/enter-lineup').data)
+    self.assertIn('No Account', self.client.get('/s/1/enter-maps').data)
+    self.assertIn('No Account', self.client.get('/s/1/enter-lineup').data)
+
+    self.client.get('/s/1/login/old')
+    self.assertIn('AHGL Map Entry', self.client.get('/s/1/enter-maps').data)
+    self.assertIn('No Account', self.client.get('/enter-lineup').data)
+
+
+class WeekPageTest(AppTestCase):
+
+  def test_page_follows_writes(self):
+    resp = self.client.get('/show-result/1')
+    self.assertIn('No result entered', resp.data)
+    etag = resp.headers['ETag']
+    resp = self.client.get('/show-result/1', headers={'If-None-Match': etag})
+    self.assertEqual(resp.status_code, 304)
+    self.submit_result()
+    resp = self.client.get('/show-result/1', headers={'If-None-Match': etag})
+    self.assertEqual(resp.status_code, 200)
+    self.assertIn('implausible.931 (P) &gt; (Z) ShamWOW.657', resp.data)
+
+  def test_version_read_once(self):
+    ahgl_admin.app.config['SQL_TRACE'] = True
+    self.client.get('/show-lineup/1')
+    trace = ahgl_admin._sql_traces[0]
+    self.assertEqual(trace.label, 'GET /show-lineup/1')
+    self.assertEqual(len([ query for query in trace.queries if 'week_versions' in query.sql ]), 1)
+
+  def test_unmigrated_database(self):
+    self.db.executescript(
+        'DROP TABLE week_versions; DROP TABLE jobs; DROP TABLE schema_version;')
+    resp = self.client.get('/show-lineup/1')
+    self.assertIn("implausible.931 (P) &lt; Xel'Naga Caverns", resp.data)
+
+  def test_migration_checked_once(self):
+    seasons_dir = os.path.join(self.data_dir, 'seasons')
+    for season in ['1', '3']:
+      os.makedirs(os.path.join(seasons_dir, season))
+      shutil.copy(self.db_path, os.path.join(seasons_dir, season, 'ahgl.sq3'))
+    ahgl_admin.app.config.update(SEASONS_DIR=seasons_dir, CLOSED_SEASONS=('1',),
+        DB_OPEN_SEASONS=1)
+    upgraded = []
+    upgrade = ahgl_admin.ahgl_migrate.upgrade
+    def counting_upgrade(conn, **kwds):
+      upgraded.append(conn)
+      return upgrade(conn, **kwds)
+    ahgl_admin.ahgl_migrate.upgrade = counting_upgrade
+    try:
+      # Each request evicts the other seasons' pools.
+      for _ in range(2):
+        for prefix in ['', '/s/1', '/s/3']:
+          self.assertEqual(self.client.get(prefix + '/show-lineup/1').status_code, 200)
+    finally:
+      ahgl_admin.ahgl_migrate.upgrade = upgrade
+    # Once each for the open databases, never for the closed season.
+    self.assertEqual(len(upgraded), 2)
+
+  def test_unmigrated_database_without_auto_migrate(self):
+    ahgl_admin.app.config['AUTO_MIGRATE'] = False
+    self.db.executescript('DROP TABLE week_versions; DROP TABLE schema_version;')
+    self.assertRaises(Exception, self.client.get, '/show-lineup/1')
+
+
+class EventsTest(AppTestCase):
+
+  def test_disabled(self):
+    self.assertNotIn('EventSource', self.client.get('/show-lineup/1').data)
+    self.assertNotIn('EventSource', self.client.get('/show-result/1').data)
+    self.assertEqual(self.client.get('/events/1').status_code, 404)
+
+  def test_stream_starts_from_rendered_version(self):
+    ahgl_admin.app.config.update(EVENTS_ENABLED=True, EVENTS_MAX_SECONDS=0.5)
+    self.assertIn('new EventSource("/events/1?since=0")',
+        self.client.get('/show-lineup/1').data)
+    # The result lands before the page's stream connects.
+    self.submit_result()
+    data = self.client.get('/events/1?since=0', buffered=True).data
+    self.assertIn('id: 1\nevent: result\n', data)
+    data = self.client.get('/events/1', buffered=True).data
+    self.assertNotIn('event:', data)
+
+
+class ApiTest(AppTestCase):
+
+  def test_week(self):
+    self.submit_result()
+    resp = self.client.get('/api/week/1.json')
+    data = json.loads(resp.data)
+    self.assertEqual((data['season'], data['week'], data['version']), ('2', 1, 1))
+    self.assertEqual(data['maps'][0], dict(set=1, map="Xel'Naga Caverns"))
+    match = data['matches'][0]
+    self.assertEqual(match['home_team'], dict(id=6, name='Twitter'))
+    self.assertEqual(match['lineups']['home'][0],
+        dict(set=1, player=dict(id=1, name='implausible', char_code='931'), race='P'))
+    self.assertEqual(match['results'][0],
+        dict(set=1, winner='home', forfeit=False, replay_hash=TEST_REPLAY_SHA1))
+    # Lineups are only shown once both teams have entered theirs.
+    self.assertEqual(data['matches'][1]['lineup_entered'], dict(home=True, away=False))
+    self.assertNotIn('lineups', data['matches'][1])
+
+    resp = self.client.get('/api/week/1.json', headers={'If-None-Match': resp.headers['ETag']})
+    self.assertEqual(resp.status_code, 304)
+    self.assertEqual(self.client.get('/api/week/9.json').status_code, 404)
+
+  def test_season_fields(self):
+    data = json.loads(self.client.get('/api/season.json?fields=maps').data)
+    self.assertEqual([ week['week'] for week in data['weeks'] ], [1])
+    self.assertEqual(sorted(data['weeks'][0]), ['maps', 'version', 'week'])
+    self.assertEqual(self.client.get('/api/season.json?fields=bogus').status_code, 400)
+
+  def test_etag_follows_writes(self):
+    etag = self.client.get('/api/season.json').headers['ETag']
+    self.submit_result()
+    resp = self.client.get('/api/season.json', headers={'If-None-Match': etag})
+    self.assertEqual(resp.status_code, 200)
+
+
+class StandingsTest(AppTestCase):
+
+  def test_standings_follow_results(self):
+    self.submit_result()
+    page = self.client.get('/standings').data
+    self.assertIn('<td>Twitter</td>\n          <td>1-0</td>\n          <td>3-1</td>\n'
+        '          <td>+2</td>', page)
+    self.assertIn('<td>Zynga</td>\n          <td>0-1</td>\n          <td>1-3</td>', page)
+    self.assertLess(page.index('Twitter'), page.index('Amazon'))
+    self.assertLess(page.index('Amazon'), page.index('Zynga'))
+
+  def test_player_stats(self):
+    self.submit_result()
+    page = self.client.get('/player-stats/1').data
+    self.assertIn('implausible.931', page)
+    self.assertIn("Xel'Naga Caverns", page.replace('&#39;', "'"))
+    self.assertEqual(self.client.get('/player-stats/999').status_code, 404)
+
+
+class ImportTest(AppTestCase):
+
+  def submit(self, name, data, **form):
+    form['file'] = (cStringIO.StringIO(data), name)
+    return self.client.post('/submit-import', data=form).data
+
+  def test_import(self):
+    self.login(-1)
+    self.assertIn('AHGL Import', self.client.get('/import').data)
+    page = self.submit('season.json', json.dumps(dict(
+      teams=[dict(name='Apple')],
+      accounts=[dict(email='tim@apple.com', team='Apple')],
+      matches=[dict(week=3, match_number=1, home_team='Apple', away_team='Twitter',
+        main_ref_team='Zynga', backup_ref_team='Yelp')],
+      )))
+    self.assertIn('tim@apple.com', page)
+    auth_key = self.query("SELECT auth_key FROM accounts WHERE email = 'tim@apple.com'")[0][0]
+    self.assertIn('/login/' + auth_key, page)
+    self.assertEqual(self.query('SELECT version FROM week_versions WHERE week = 3'), [(1,)])
+
+  def test_errors_import_nothing(self):
+    self.login(-1)
+    page = self.submit('x.csv', 'name\nTwitter\nApple\n', kind='teams')
+    self.assertIn('A team named &#34;Twitter&#34; already exists', page)
+    self.assertEqual(self.query("SELECT COUNT(*) FROM teams WHERE name = 'Apple'"), [(0,)])
+    self.assertIn('Invalid import', self.submit('x.txt', 'whatever'))
+
+  def test_checked_against_concurrent_change(self):
+    self.login(-1)
+    read_rows = bulk_import.read_rows
+    def read_rows_racing(*args):
+      for item in read_rows(*args):
+        yield item
+      # Another admin adds the same team meanwhile.
+      self.db.execute("INSERT INTO teams(name) VALUES ('Apple')")
+      self.db.commit()
+    bulk_import.read_rows = read_rows_racing
+    try:
+      page = self.submit('teams.csv', 'name\nApple\n')
+    finally:
+      bulk_import.read_rows = read_rows
+    self.assertIn('A team named &#34;Apple&#34; already exists', page)
+    self.assertEqual(self.query("SELECT COUNT(*) FROM teams WHERE name = 'Apple'"), [(1,)])
+
+  def test_admins_only(self):
+    self.login(6)
+    self.assertIn('Admins only', self.submit('teams.csv', 'name\nApple\n'))
+
+
+class JobsTest(AppTestCase):
+
+  def run_jobs(self):
+    while ahgl_worker.run_one(None, 'w1'):
+      pass
+
+  def test_result_jobs(self):
+    self.submit_result()
+    self.assertEqual(sorted(self.query('SELECT kind, status FROM jobs')), [
+      ('build_player_pack', 'pending'),
+      ('build_player_pack', 'pending'),
+      ('build_week_pack', 'pending'),
+      ('verify_replay', 'pending'),
+      ])
+    self.run_jobs()
+    self.assertEqual(self.query("SELECT COUNT(*) FROM jobs WHERE status != 'done'"), [(0,)])
+    packs = glob.glob(os.path.join(self.data_dir, 'packs', '*.zip'))
+    self.assertEqual(sorted(os.path.basename(name).split('-')[0] for name in packs),
+        ['player', 'player', 'week'])
+
+  def test_stale_packs_removed_without_worker(self):
+    for url in ['/replay-pack/1/pack.zip', '/player-replays/1/x.zip', '/player-replays/2/x.zip']:
+      self.assertEqual(self.client.get(url, buffered=True).status_code, 200)
+    self.submit_result()
+    # Only player 1 and their opponent played a set with a replay.
+    packs = glob.glob(os.path.join(self.data_dir, 'packs', '*.zip'))
+    self.assertEqual([ os.path.basename(name).split('-')[:2] for name in packs ],
+        [['player', '2']])
+
+  def test_build_no_packs(self):
+    builds = ahgl_admin.week_pack_builds
+    ahgl_admin.week_pack_builds = lambda week: []
+    try:
+      with ahgl_admin.season_context(None):
+        self.assertEqual(ahgl_worker.build_week_packs(1, 4), 0)
+    finally:
+      ahgl_admin.week_pack_builds = builds
+
+  def test_lease_renewed_while_running(self):
+    ahgl_admin.app.config['JOB_LEASE_SECONDS'] = 0.3
+    stolen = []
+    def slow(args):
+      time.sleep(1)
+      with contextlib.closing(ahgl_admin.open_db(self.db_path)) as conn:
+        with conn:
+          stolen.append(job_queue.claim(conn.cursor(), 'w2', 0.3))
+    ahgl_worker.HANDLERS['slow'] = slow
+    try:
+      with ahgl_admin.season_context(None):
+        ahgl_admin.run_write_transaction(
+            lambda cursor: job_queue.enqueue(cursor, 'slow', {}))
+      self.run_jobs()
+    finally:
+      del ahgl_worker.HANDLERS['slow']
+    self.assertEqual(stolen, [None])
+    self.assertEqual(self.query('SELECT status, attempts, worker FROM jobs'),
+        [('done', 1, 'w1')])
+
+  def test_jobs_page_and_retry(self):
+    with ahgl_admin.season_context(None):
+      ahgl_admin.run_write_transaction(
+          lambda cursor: job_queue.enqueue(cursor, 'no_such_kind', {}))
+    ahgl_admin.app.config['JOB_MAX_ATTEMPTS'] = 1
+    self.run_jobs()
+    self.assertEqual(self.query('SELECT status, error FROM jobs'),
+        [('failed', "Unknown job kind u'no_such_kind'")])
+
+    self.login(6)
+    self.assertIn('Admins only', self.client.get('/_jobs').data)
+    self.login(-1)
+    page = self.client.get('/_jobs').data
+    self.assertIn('no_such_kind', page)
+    resp = self.client.post('/_jobs/1/retry')
+    self.assertEqual(resp.status_code, 302)
+    self.assertEqual(self.query('SELECT status, attempts FROM jobs'), [('pending', 0)])
+    self.assertIn('has not failed', self.client.post('/_jobs/1/retry').data)
+
+
+class ExportTest(AppTestCase):
+
+  def test_export(self):
+    self.submit_result()
+    self.login(-1)
+    self.assertEqual(self.client.post('/_exports').status_code, 302)
+    self.assertIn('pending', self.client.get('/_exports').data)
+    while ahgl_worker.run_one(None, 'w1'):
+      pass
+    name, = os.listdir(os.path.join(self.data_dir, 'exports'))
+    self.assertIn(name, self.client.get('/_exports').data)
+
+    resp = self.client.get('/_exports/' + name, buffered=True)
+    zfile = zipfile.ZipFile(cStringIO.StringIO(resp.data))
+    names = set(zfile.namelist())
+    self.assertEqual(hashlib.sha1(zfile.read('AHGL_S2/replays/%s.SC2Replay' % TEST_REPLAY_SHA1))
+        .hexdigest(), TEST_REPLAY_SHA1)
+    self.assertIn('AHGL_S2/ahgl.sq3', names)
+    self.assertIn('AHGL_S2/pages/standings.html', names)
+
+    # The pages work offline: links resolve to archive members, and
+    # nothing refers back to the live site.
+    for page in ('result-week-1.html', 'lineup-week-1.html'):
+      body = zfile.read('AHGL_S2/pages/' + page)
+      self.assertNotIn('EventSource', body)
+      self.assertNotIn('/replay-pack/', body)
+      for link in re.findall(r'href="([^"]*)"', body):
+        self.assertIn(posixpath.normpath(posixpath.join('AHGL_S2/pages', link)), names)
+    self.assertEqual(len(re.findall('href=', zfile.read('AHGL_S2/pages/result-week-1.html'))), 1)
+
+  def test_export_names(self):
+    self.login(-1)
+    self.assertEqual(self.client.get('/_exports/../ahgl.sq3').status_code, 404)
+    self.assertEqual(self.client.get('/_exports/missing.zip').status_code, 404)
+
+
+class RangeTest(AppTestCase):
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    self.submit_result()
+    with open('./test_fake_replay.dat', 'rb') as handle:
+      self.replay = handle.read()
+
+  def get(self, **headers):
+    return self.client.get('/replay/%s/replay.SC2Replay' % TEST_REPLAY_SHA1,
+        buffered=True, headers=headers)
+
+  def test_single_range(self):
+    resp = self.get(Range='bytes=1-2')
+    self.assertEqual((resp.status_code, resp.data), (206, self.replay[1:3]))
+    self.assertEqual(resp.headers['Content-Range'], 'bytes 1-2/%d' % len(self.replay))
+
+  def test_unsatisfiable(self):
+    resp = self.get(Range='bytes=%d-' % (len(self.replay) + 10))
+    self.assertEqual(resp.status_code, 416)
+    size = len(self.replay)
+    resp = self.get(Range='bytes=%d-%d,%d-%d' % (size, size + 1, size + 5, size + 9))
+    self.assertEqual(resp.status_code, 416)
+
+  def test_multiple_ranges_get_everything(self):
+    resp = self.get(Range='bytes=0-1,5-9')
+    self.assertEqual((resp.status_code, resp.data), (200, self.replay))
+
+  def test_if_range(self):
+    resp = self.get(Range='bytes=1-2', **{'If-Range': '"%s"' % TEST_REPLAY_SHA1})
+    self.assertEqual(resp.status_code, 206)
+    for if_range in ['"other"', 'Wed, 21 Oct 2015 07:28:00 GMT']:
+      resp = self.get(Range='bytes=1-2', **{'If-Range': if_range})
+      self.assertEqual((resp.status_code, resp.data), (200, self.replay))
+
+
+class SendfileTest(AppTestCase):
+
+  def test_accel_redirect(self):
+    self.submit_result()
+    ahgl_admin.app.config['SENDFILE_MODE'] = 'x-accel-redirect'
+    replay_url = '/replay/%s/replay.SC2Replay' % TEST_REPLAY_SHA1
+    resp = self.client.get(replay_url)
+    self.assertEqual(resp.headers['X-Accel-Redirect'],
+        '/_ahgl_data/replays/4e/12/%s.SC2Replay' % TEST_REPLAY_SHA1)
+    self.assertEqual(resp.data, '')
+
+  def test_outside_accel_root_is_streamed(self):
+    self.submit_result()
+    ahgl_admin.app.config.update(SENDFILE_MODE='x-accel-redirect',
+        SENDFILE_ACCEL_ROOT=os.path.join(self.data_dir, 'packs'))
+    resp = self.client.get('/replay/%s/replay.SC2Replay' % TEST_REPLAY_SHA1, buffered=True)
+    self.assertNotIn('X-Accel-Redirect', resp.headers)
+    self.assertEqual(hashlib.sha1(resp.data).hexdigest(), TEST_REPLAY_SHA1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# Load-test the public routes against a synthetic league.
+#
+# Generates a league (see gen_league.py) in a temporary DATA_DIR, then
+# drives each route through the WSGI app from several threads at once and
+# reports throughput, p50/p95/p99 latency (including reading the whole
+# response body), SQL statements per request and the process's peak RSS.
+# Results can be saved as JSON to compare commits:
+#
+#   ./bench_routes.py --json bench-before.json
+#   ./bench_routes.py --teams 32 --weeks 10 --concurrency 16 --json bench-after.json
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import resource
+import optparse
+import subprocess
+import cStringIO
+
+import ahgl_admin
+import gen_league
+
+
+ROUTES = ["show-lineup", "show-result", "replay-pack", "player-replays", "submit-result"]
+
+
+class _Counter(threading.local):
+  queries = 0
+
+_counter = _Counter()
+
+
+class CountingCursor(sqlite3.Cursor):
+  def execute(self, *args):
+    _counter.queries += 1
+    return sqlite3.Cursor.execute(self, *args)
+
+  def executemany(self, *args):
+    _counter.queries += 1
+    return sqlite3.Cursor.executemany(self, *args)
+
+
+class CountingConnection(sqlite3.Connection):
+  def cursor(self, factory=CountingCursor):
+    return sqlite3.Connection.cursor(self, factory)
+
+
+def percentile(sorted_values, pct):
+  if not sorted_values:
+    return None
+  return sorted_values[int(round(pct / 100.0 * (len(sorted_values) - 1)))]
+
+
+def make_requests(route, count, league, rand):
+  weeks = league["closed_weeks"] or [1]
+  if route == "show-lineup":
+    return [ ("GET", "/show-lineup/%d" % rand.choice(league["weeks"]), None) for _ in range(count) ]
+  if route == "show-result":
+    return [ ("GET", "/show-result/%d" % rand.choice(weeks), None) for _ in range(count) ]
+  if route == "replay-pack":
+    return [ ("GET", "/replay-pack/%d/pack.zip" % rand.choice(weeks), None) for _ in range(count) ]
+  if route == "player-replays":
+    return [ ("GET", "/player-replays/%d/replays.zip" % rand.choice(league["players"]), None)
+        for _ in range(count) ]
+  if route == "submit-result":
+    requests = []
+    for week, match in league["open_matches"][:count]:
+      data = dict(week=str(week), match=str(match),
+          winner_1="home", winner_2="home", winner_3="home",
+          winner_4="none", winner_5="none")
+      for setnum in range(1, 4):
+        data["replay_%d" % setnum] = (
+            cStringIO.StringIO(os.urandom(league["replay_size"])), "set%d.SC2Replay" % setnum)
+      requests.append(("POST", "/submit-result", data))
+    return requests
+  raise ValueError(route)
+
+
+def run_route(app, requests, concurrency):
+  latencies = []
+  queries = []
+  errors = [0]
+  lock = threading.Lock()
+  queue = list(reversed(requests))
+
+  def worker():
+    client = app.test_client()
+    while True:
+      with lock:
+        if not queue:
+          return
+        method, url, data = queue.pop()
+      _counter.queries = 0
+      start = time.time()
+      resp = client.open(url, method=method, data=data)
+      body_len = len(resp.get_data())
+      elapsed = time.time() - start
+      with lock:
+        latencies.append(elapsed)
+        queries.append(_counter.queries)
+        if resp.status_code >= 400 or not body_len:
+          errors[0] += 1
+
+  threads = [ threading.Thread(target=worker) for _ in range(concurrency) ]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time.time() - start
+
+  latencies.sort()
+  return dict(
+      requests = len(latencies),
+      errors = errors[0],
+      seconds = wall,
+      throughput = len(latencies) / wall if wall else 0.0,
+      p50_ms = percentile(latencies, 50) * 1000 if latencies else None,
+      p95_ms = percentile(latencies, 95) * 1000 if latencies else None,
+      p99_ms = percentile(latencies, 99) * 1000 if latencies else None,
+      queries_per_request = float(sum(queries)) / len(queries) if queries else None,
+      )
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("--teams", type="int", default=16)
+  parser.add_option("--weeks", type="int", default=8)
+  parser.add_option("--players", type="int", default=9, help="players per team")
+  parser.add_option("--replay-size", type="int", default=64 * 1024,
+      help="maximum replay size in bytes")
+  parser.add_option("--requests", type="int", default=200, help="requests per route")
+  parser.add_option("--concurrency", type="int", default=8)
+  parser.add_option("--route", action="append", dest="routes", choices=ROUTES,
+      help="route to measure (repeatable; default all)")
+  parser.add_option("--seed", type="int", default=1)
+  parser.add_option("--json", help="write the results to this file")
+  parser.add_option("--keep", action="store_true", help="keep the generated DATA_DIR")
+  options, args = parser.parse_args(argv[1:])
+  if args:
+    parser.error("unexpected arguments")
+
+  rand = random.Random(options.seed)
+  data_dir = tempfile.mkdtemp(prefix="ahgl-bench-")
+  try:
+    open_weeks = 2
+    info = gen_league.generate_league(data_dir,
+        seed = options.seed,
+        teams = options.teams,
+        weeks = options.weeks,
+        roster_size = options.players,
+        open_weeks = open_weeks,
+        min_replay_size = options.replay_size // 4,
+        max_replay_size = options.replay_size,
+        )["1"]
+    league = dict(
+        weeks = range(1, options.weeks + 1),
+        closed_weeks = range(1, options.weeks - open_weeks + 1),
+        players = range(1, info["players"] + 1),
+        open_matches = info["open_matches"],
+        replay_size = options.replay_size,
+        )
+
+    app = ahgl_admin.app
+    app.config["DATA_DIR"] = data_dir
+    app.config["SEASON"] = "bench"
+    app.config["DB_CONNECTION_FACTORY"] = CountingConnection
+    app.secret_key = "bench"
+
+    results = {}
+    sys.stdout.write("%-16s %8s %7s %9s %9s %9s %9s %8s\n" % (
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries"))
+    for route in options.routes or ROUTES:
+      requests = make_requests(route, options.requests, league, rand)
+      result = results[route] = run_route(app, requests, options.concurrency)
+      sys.stdout.write("%-16s %8d %7d %9.1f %9.2f %9.2f %9.2f %8.1f\n" % (
+          route, result["requests"], result["errors"], result["throughput"],
+          result["p50_ms"] or 0, result["p95_ms"] or 0, result["p99_ms"] or 0,
+          result["queries_per_request"] or 0))
+
+    # ru_maxrss is in kilobytes on Linux.
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.write("peak RSS: %d KB\n" % peak_rss_kb)
+
+    if options.json:
+      with open(options.json, "w") as handle:
+        json.dump(dict(
+            revision = git_revision(),
+            timestamp = time.time(),
+            options = dict(
+                teams = options.teams,
+                weeks = options.weeks,
+                players = options.players,
+                replay_size = options.replay_size,
+                requests = options.requests,
+                concurrency = options.concurrency,
+                seed = options.seed,
+                ),
+            peak_rss_kb = peak_rss_kb,
+            routes = results,
+            ), handle, indent=2, sort_keys=True)
+  finally:
+    if options.keep:
+      sys.stdout.write("data dir: %s\n" % data_dir)
+    else:
+      shutil.rmtree(data_dir)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Compare replay-pack compression policies over a corpus of replays.
+#
+# For each policy, builds one archive of every replay given (files, or
+# directories searched recursively for *.SC2Replay, e.g. a replay store)
+# and reports wall time, CPU time, output size and ratio.  The archive is
+# discarded; only its bytes are counted.
+#
+#   ./bench_zip_compression.py data/replays
+#   ./bench_zip_compression.py --policy stored --policy adaptive:6 --json out.json data/replays
+import sys
+import os
+import time
+import json
+import resource
+import zipfile
+import optparse
+
+import zipstream
+
+
+DEFAULT_POLICIES = ["stored", "deflate:1", "deflate:6", "deflate:9", "adaptive:1", "adaptive:6"]
+
+
+def find_replays(paths):
+  replays = []
+  for path in paths:
+    if os.path.isdir(path):
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for fname in sorted(filenames):
+          if fname.endswith(".SC2Replay"):
+            replays.append(os.path.join(dirpath, fname))
+    else:
+      replays.append(path)
+  return replays
+
+
+def cpu_time():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def run_policy(policy, replays, repeat):
+  members = [ (path, "replays/%d.SC2Replay" % num) for num, path in enumerate(replays) ]
+  walls = []
+  cpus = []
+  size = 0
+  stored = 0
+  for _ in range(repeat):
+    wall_start = time.time()
+    cpu_start = cpu_time()
+    zstream = zipstream.ZipStream(compression=policy)
+    size = 0
+    for path, arcname in members:
+      for chunk in zstream.add_file(path, arcname):
+        size += len(chunk)
+    for chunk in zstream.finish():
+      size += len(chunk)
+    cpus.append(cpu_time() - cpu_start)
+    walls.append(time.time() - wall_start)
+    stored = sum(1 for entry in zstream.entries if entry.method == zipfile.ZIP_STORED)
+  return dict(
+      policy = policy,
+      wall_seconds = min(walls),
+      cpu_seconds = min(cpus),
+      output_bytes = size,
+      members_stored = stored,
+      )
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options] REPLAY_FILE_OR_DIR...")
+  parser.add_option("--policy", action="append", dest="policies",
+      help="policy to measure (repeatable; default: %s)" % ", ".join(DEFAULT_POLICIES))
+  parser.add_option("--repeat", type="int", default=3,
+      help="builds per policy; the fastest is reported (default 3)")
+  parser.add_option("--json", help="also write the results to this file")
+  options, args = parser.parse_args(argv[1:])
+  if not args:
+    parser.error("no replays given")
+
+  policies = options.policies or DEFAULT_POLICIES
+  for policy in policies:
+    try:
+      zipstream.parse_compression(policy)
+    except ValueError as err:
+      parser.error(str(err))
+
+  replays = find_replays(args)
+  if not replays:
+    parser.error("no replays found")
+  input_bytes = sum(os.path.getsize(path) for path in replays)
+
+  results = []
+  sys.stdout.write("%d replays, %d bytes\n" % (len(replays), input_bytes))
+  sys.stdout.write("%-12s %10s %10s %14s %8s %8s\n"
+      % ("policy", "wall (s)", "cpu (s)", "size (bytes)", "ratio", "stored"))
+  for policy in policies:
+    result = run_policy(policy, replays, options.repeat)
+    result["ratio"] = float(result["output_bytes"]) / input_bytes if input_bytes else 0.0
+    results.append(result)
+    sys.stdout.write("%-12s %10.3f %10.3f %14d %8.4f %8d\n" % (
+        policy, result["wall_seconds"], result["cpu_seconds"],
+        result["output_bytes"], result["ratio"], result["members_stored"]))
+
+  if options.json:
+    with open(options.json, "w") as handle:
+      json.dump(dict(
+          replays = len(replays),
+          input_bytes = input_bytes,
+          results = results,
+          ), handle, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# Bulk import of teams, players, accounts and the match schedule.
+#
+# Rows are read from CSV (with a header row; one kind per file), JSON Lines
+# (one object per line, each with a "kind" unless one is given) or a JSON
+# document (a list of rows of one kind, or {"teams": [...], "players":
+# [...], ...}).  Every row is checked against the database and the rest of
+# the import before anything is written, and then all rows are inserted
+# with executemany in one transaction, so an import is applied completely
+# or not at all.  Teams may be referred to by id or by name, including teams
+# added by the same import; accounts on team "admin" (or -1) are admins, and
+# accounts without an auth_key get a random one.
+#
+#   ./bulk_import.py data/ahgl.sq3 teams.csv players.csv
+#   ./bulk_import.py --dry-run data/ahgl.sq3 season.json
+import sys
+import os
+import csv
+import json
+import sqlite3
+import optparse
+
+import week_versions
+
+
+KINDS = ("teams", "players", "accounts", "matches")
+
+COLUMNS = {
+  "teams": ("id", "name", "captain_info"),
+  "players": ("id", "team", "name", "char_code", "active"),
+  "accounts": ("id", "email", "team", "auth_key"),
+  "matches": ("week", "match_number", "home_team", "away_team", "main_ref_team", "backup_ref_team"),
+  }
+
+REQUIRED = {
+  "teams": ("name",),
+  "players": ("team", "name"),
+  "accounts": ("email", "team"),
+  "matches": ("week", "match_number", "home_team", "away_team", "main_ref_team", "backup_ref_team"),
+  }
+
+
+class BadImport(Exception):
+  pass
+
+
+class RowError(Exception):
+  pass
+
+
+def guess_format(filename):
+  ext = os.path.splitext(filename or "")[1].lower()
+  return {".csv": "csv", ".json": "json", ".jsonl": "jsonl"}.get(ext)
+
+
+def guess_kind(filename):
+  base = os.path.splitext(os.path.basename(filename or ""))[0].lower()
+  return base if base in KINDS else None
+
+
+# Yield (kind, row_number, row) from a file object.  CSV and JSON Lines
+# are read a line at a time.
+def read_rows(stream, fmt, kind=None):
+  if fmt == "csv":
+    if kind is None:
+      raise BadImport("CSV imports need a kind")
+    reader = csv.DictReader(stream)
+    for row in reader:
+      yield kind, reader.line_num, dict(
+          (key, value.decode("utf-8") if isinstance(value, str) else value)
+          for (key, value) in row.items() if key is not None)
+  elif fmt == "jsonl":
+    for num, line in enumerate(stream, 1):
+      if not line.strip():
+        continue
+      try:
+        row = json.loads(line)
+      except ValueError as err:
+        raise BadImport("Line %d: %s" % (num, err))
+      if not isinstance(row, dict):
+        raise BadImport("Line %d: expected an object" % num)
+      yield row.pop("kind", kind), num, row
+  elif fmt == "json":
+    try:
+      doc = json.load(stream)
+    except ValueError as err:
+      raise BadImport(str(err))
+    if isinstance(doc, list):
+      if kind is None:
+        raise BadImport("A JSON list of rows needs a kind")
+      doc = {kind: doc}
+    if not isinstance(doc, dict):
+      raise BadImport("Expected a JSON object or list")
+    unknown = set(doc) - set(KINDS)
+    if unknown:
+      raise BadImport("Unknown kinds: %s" % ", ".join(sorted(unknown)))
+    for doc_kind in KINDS:
+      for num, row in enumerate(doc.get(doc_kind) or [], 1):
+        yield doc_kind, num, row
+  else:
+    raise BadImport("Unknown format %r" % fmt)
+
+
+def _text(value):
+  if value is None:
+    return None
+  if not isinstance(value, basestring):
+    value = unicode(value)
+  return value.strip() or None
+
+
+def _int(row, column):
+  value = _text(row.get(column))
+  if value is None:
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    raise RowError("%s must be a number" % column)
+
+
+# Validates rows against the database (as read by the cursor given) and the
+# rows added before them, and collects the rows to insert.
+class Importer(object):
+
+  def __init__(self, cursor):
+    cursor.execute("SELECT id, name FROM teams")
+    self.team_names = dict(cursor)
+    self.team_ids = dict((name.lower(), tid) for (tid, name) in self.team_names.items() if name)
+    cursor.execute("SELECT id, team, name FROM players")
+    players = list(cursor)
+    self.player_ids = set(pid for (pid, _, _) in players)
+    self.player_names = set((team, name.lower()) for (_, team, name) in players if name)
+    cursor.execute("SELECT id, email, auth_key FROM accounts")
+    accounts = list(cursor)
+    self.account_ids = set(aid for (aid, _, _) in accounts)
+    self.emails = set(email.lower() for (_, email, _) in accounts if email)
+    self.auth_keys = set(key for (_, _, key) in accounts if key)
+    cursor.execute("SELECT week, match_number, home_team, away_team FROM matches")
+    self.matches = set()
+    self.playing = set()
+    for (week, match, home, away) in cursor:
+      self.matches.add((week, match))
+      self.playing.update([(week, home), (week, away)])
+
+    self.rows = dict((kind, []) for kind in KINDS)
+    # (kind, row_number, message)
+    self.errors = []
+    # (email, auth_key) for accounts given a generated key
+    self.generated_keys = []
+
+  def add(self, kind, num, row):
+    if kind not in KINDS:
+      self.errors.append((kind, num, "Unknown kind %r" % (kind,)))
+      return
+    if not isinstance(row, dict):
+      self.errors.append((kind, num, "Expected an object"))
+      return
+    unknown = set(row) - set(COLUMNS[kind])
+    if unknown:
+      self.errors.append((kind, num, "Unknown columns: %s" % ", ".join(sorted(unknown))))
+      return
+    for column in REQUIRED[kind]:
+      if _text(row.get(column)) is None:
+        self.errors.append((kind, num, "No value for %s" % column))
+        return
+    try:
+      self.rows[kind].append(getattr(self, "_check_" + kind)(row))
+    except RowError as err:
+      self.errors.append((kind, num, err.args[0]))
+
+  def _next_id(self, used):
+    return max(list(used) + [0]) + 1
+
+  def _team(self, row, column, allow_admin=False):
+    value = _text(row.get(column))
+    if allow_admin and value.lower() in ("admin", "-1"):
+      return -1
+    try:
+      tid = int(value)
+    except ValueError:
+      tid = self.team_ids.get(value.lower())
+    if tid not in self.team_names:
+      raise RowError(u"No such team \"%s\" for %s" % (value, column))
+    return tid
+
+  def _check_teams(self, row):
+    tid = _int(row, "id")
+    name = _text(row["name"])
+    if tid is None:
+      tid = self._next_id(self.team_names)
+    if tid in self.team_names:
+      raise RowError("Team %d already exists" % tid)
+    if name.lower() in self.team_ids:
+      raise RowError(u"A team named \"%s\" already exists" % name)
+    self.team_names[tid] = name
+    self.team_ids[name.lower()] = tid
+    return (tid, name, _text(row.get("captain_info")))
+
+  def _check_players(self, row):
+    pid = _int(row, "id")
+    team = self._team(row, "team")
+    name = _text(row["name"])
+    active = _int(row, "active")
+    if pid is None:
+      pid = self._next_id(self.player_ids)
+    if pid in self.player_ids:
+      raise RowError("Player %d already exists" % pid)
+    if (team, name.lower()) in self.player_names:
+      raise RowError(u"%s already has a player named \"%s\"" % (self.team_names[team], name))
+    if active not in (None, 0, 1):
+      raise RowError("active must be 0 or 1")
+    self.player_ids.add(pid)
+    self.player_names.add((team, name.lower()))
+    return (pid, team, 1 if active is None else active, name, _text(row.get("char_code")))
+
+  def _check_accounts(self, row):
+    aid = _int(row, "id")
+    email = _text(row["email"])
+    team = self._team(row, "team", allow_admin=True)
+    auth_key = _text(row.get("auth_key"))
+    if aid is None:
+      aid = self._next_id(self.account_ids)
+    if aid in self.account_ids:
+      raise RowError("Account %d already exists" % aid)
+    if email.lower() in self.emails:
+      raise RowError(u"An account for %s already exists" % email)
+    if auth_key is None:
+      auth_key = os.urandom(20).encode("hex")
+      self.generated_keys.append((email, auth_key))
+    elif auth_key in self.auth_keys:
+      raise RowError("auth_key is already in use")
+    self.account_ids.add(aid)
+    self.emails.add(email.lower())
+    self.auth_keys.add(auth_key)
+    return (aid, email, team, auth_key)
+
+  def _check_matches(self, row):
+    week = _int(row, "week")
+    match = _int(row, "match_number")
+    teams = [ self._team(row, column) for column in COLUMNS["matches"][2:] ]
+    home, away, ref1, ref2 = teams
+    if week < 1 or match < 1:
+      raise RowError("week and match_number must be positive")
+    if (week, match) in self.matches:
+      raise RowError("Week %d match %d already exists" % (week, match))
+    if home == away:
+      raise RowError("A team cannot play itself")
+    for team in (home, away):
+      if (week, team) in self.playing:
+        raise RowError(u"%s already plays in week %d" % (self.team_names[team], week))
+    if ref1 in (home, away) or ref2 in (home, away):
+      raise RowError("A team cannot referee its own match")
+    self.matches.add((week, match))
+    self.playing.update([(week, home), (week, away)])
+    return (week, match, home, away, ref1, ref2)
+
+  def counts(self):
+    return dict((kind, len(rows)) for (kind, rows) in self.rows.items())
+
+  # Insert everything; call in a write transaction, and only without errors.
+  # Returns the weeks whose schedule changed.
+  def apply(self, cursor):
+    assert not self.errors
+    cursor.executemany("INSERT INTO teams(id, name, captain_info) VALUES (?,?,?)",
+        self.rows["teams"])
+    cursor.executemany("INSERT INTO players(id, team, active, name, char_code) VALUES (?,?,?,?,?)",
+        self.rows["players"])
+    cursor.executemany("INSERT INTO accounts(id, email, team, auth_key) VALUES (?,?,?,?)",
+        self.rows["accounts"])
+    cursor.executemany(
+        "INSERT INTO matches(week, match_number, home_team, away_team, main_ref_team, backup_ref_team) "
+        "VALUES (?,?,?,?,?,?) "
+        , self.rows["matches"])
+    return sorted(set(row[0] for row in self.rows["matches"]))
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options] DATABASE FILE...")
+  parser.add_option("--kind", choices=KINDS,
+      help="kind of row in the files (default: from the file name, e.g. players.csv)")
+  parser.add_option("--format", choices=("csv", "json", "jsonl"),
+      help="file format (default: from the file extension)")
+  parser.add_option("--dry-run", action="store_true", help="only check the rows")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) < 2:
+    parser.error("expected a database and at least one file")
+  path = args[0]
+  if not os.path.exists(path):
+    parser.error("no such database: %s" % path)
+
+  conn = sqlite3.connect(path)
+  conn.isolation_level = None
+  try:
+    # Check and write under one lock, so nothing changes in between.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      cursor = conn.cursor()
+      importer = Importer(cursor)
+      for fname in args[1:]:
+        fmt = options.format or guess_format(fname)
+        kind = options.kind or guess_kind(fname)
+        with open(fname, "rb") as handle:
+          try:
+            for row_kind, num, row in read_rows(handle, fmt, kind):
+              importer.add(row_kind, "%s:%s" % (fname, num), row)
+          except BadImport as err:
+            parser.error("%s: %s" % (fname, err))
+      if not importer.errors and not options.dry_run:
+        for week in importer.apply(cursor):
+          week_versions.bump(cursor, week)
+        conn.execute("COMMIT")
+      else:
+        conn.execute("ROLLBACK")
+    except:
+      conn.execute("ROLLBACK")
+      raise
+  finally:
+    conn.close()
+
+  for kind, num, message in importer.errors:
+    sys.stdout.write(("%s %s: %s\n" % (num, kind, message)).encode("utf-8"))
+  if importer.errors:
+    sys.stdout.write("%d errors; nothing imported\n" % len(importer.errors))
+    return 1
+  for email, auth_key in importer.generated_keys:
+    sys.stdout.write(("auth_key for %s: %s\n" % (email, auth_key)).encode("utf-8"))
+  counts = importer.counts()
+  sys.stdout.write("%s %s\n" % ("Checked" if options.dry_run else "Imported",
+      ", ".join("%d %s" % (counts[kind], kind) for kind in KINDS)))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import cStringIO
+
+import bulk_import
+
+
+class ReadRowsTest(unittest.TestCase):
+
+  def test_csv(self):
+    stream = cStringIO.StringIO("name,captain_info\nApple,Captain Tim\n")
+    self.assertEqual(list(bulk_import.read_rows(stream, "csv", "teams")),
+        [("teams", 2, dict(name=u"Apple", captain_info=u"Captain Tim"))])
+    self.assertRaises(bulk_import.BadImport, list, bulk_import.read_rows(stream, "csv"))
+
+  def test_jsonl(self):
+    stream = cStringIO.StringIO('{"kind": "teams", "name": "Apple"}\n\n{"name": "x", "team": 1}\n')
+    self.assertEqual(list(bulk_import.read_rows(stream, "jsonl", "players")), [
+      ("teams", 1, dict(name="Apple")),
+      ("players", 3, dict(name="x", team=1)),
+      ])
+    stream = cStringIO.StringIO('{"name": \n')
+    self.assertRaises(bulk_import.BadImport, list, bulk_import.read_rows(stream, "jsonl"))
+
+  def test_json(self):
+    stream = cStringIO.StringIO('{"players": [{"name": "x"}], "teams": [{"name": "Apple"}]}')
+    # Teams come first, so players can refer to them.
+    self.assertEqual([ kind for (kind, _, _) in bulk_import.read_rows(stream, "json") ],
+        ["teams", "players"])
+    stream = cStringIO.StringIO('{"coaches": []}')
+    self.assertRaises(bulk_import.BadImport, list, bulk_import.read_rows(stream, "json"))
+
+  def test_guess(self):
+    self.assertEqual(bulk_import.guess_format("dir/Players.CSV"), "csv")
+    self.assertEqual(bulk_import.guess_kind("dir/Players.CSV"), "players")
+    self.assertEqual(bulk_import.guess_kind("season.json"), None)
+
+
+class ImporterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = sqlite3.connect(":memory:")
+    for fname in ["./schema.sql", "./test_data.sql"]:
+      with open(fname) as handle:
+        self.conn.executescript(handle.read())
+    self.cursor = self.conn.cursor()
+    self.importer = bulk_import.Importer(self.cursor)
+
+  def tearDown(self):
+    self.conn.close()
+
+  def add(self, kind, row):
+    self.importer.add(kind, len(self.importer.errors) + 1, row)
+    return self.importer.errors[-1][2] if self.importer.errors else None
+
+  def test_new_team_referred_to_by_name(self):
+    self.assertEqual(self.add("teams", dict(name="Apple")), None)
+    self.assertEqual(self.add("players", dict(team="apple", name="jobs")), None)
+    self.assertEqual(self.add("accounts", dict(email="tim@apple.com", team="Apple")), None)
+    self.assertEqual(self.add("accounts", dict(email="admin@apple.com", team="admin")), None)
+    self.assertEqual(self.add("matches", dict(week=3, match_number=1, home_team="Apple",
+        away_team=6, main_ref_team="Zynga", backup_ref_team=1)), None)
+    self.assertEqual(self.importer.rows["teams"], [(9, u"Apple", None)])
+    self.assertEqual(self.importer.rows["players"][0][:4], (25, 9, 1, u"jobs"))
+    self.assertEqual(self.importer.rows["accounts"][1][2], -1)
+    self.assertEqual([ email for (email, _) in self.importer.generated_keys ],
+        [u"tim@apple.com", u"admin@apple.com"])
+
+    self.assertEqual(self.importer.apply(self.cursor), [3])
+    self.cursor.execute("SELECT team, name FROM players WHERE id = 25")
+    self.assertEqual(list(self.cursor), [(9, u"jobs")])
+
+  def test_errors(self):
+    cases = [
+      ("teams", dict(name="twitter"), u'A team named "twitter" already exists'),
+      ("teams", dict(id=1, name="New"), "Team 1 already exists"),
+      ("teams", dict(name="New", color="red"), "Unknown columns: color"),
+      ("players", dict(team="Nowhere", name="x"), u'No such team "Nowhere" for team'),
+      ("players", dict(team=6, name="Implausible"), u'Twitter already has a player named "Implausible"'),
+      ("players", dict(team=6, name="y", active=2), "active must be 0 or 1"),
+      ("accounts", dict(email="ADMIN@day9.tv", team=1), u"An account for ADMIN@day9.tv already exists"),
+      ("accounts", dict(email="new@x.com", team=1,
+        auth_key="34ddbd51701efa370aba7d7a9d05cf5ac43ba82c"), "auth_key is already in use"),
+      ("matches", dict(week=1, match_number=5, home_team=1, away_team=2,
+        main_ref_team=3, backup_ref_team=4), "Amazon already plays in week 1"),
+      ("matches", dict(week=3, match_number=1, home_team=1, away_team=2,
+        main_ref_team=1, backup_ref_team=4), "A team cannot referee its own match"),
+      ("matches", dict(week="x", match_number=1), "No value for home_team"),
+      ("coaches", dict(name="x"), "Unknown kind 'coaches'"),
+      ]
+    for kind, row, message in cases:
+      self.assertEqual(self.add(kind, row), message)
+    self.assertEqual(self.importer.counts(), dict.fromkeys(bulk_import.KINDS, 0))
+
+
+class MainTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db_path = os.path.join(self.tmp_dir, "ahgl.sq3")
+    conn = sqlite3.connect(self.db_path)
+    for fname in ["./schema.sql", "./test_data.sql"]:
+      with open(fname) as handle:
+        conn.executescript(handle.read())
+    conn.close()
+    self.stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    shutil.rmtree(self.tmp_dir)
+
+  def write_file(self, name, data):
+    path = os.path.join(self.tmp_dir, name)
+    with open(path, "w") as handle:
+      handle.write(data)
+    return path
+
+  def query(self, sql):
+    conn = sqlite3.connect(self.db_path)
+    try:
+      return list(conn.execute(sql))
+    finally:
+      conn.close()
+
+  def test_import_bumps_week_versions(self):
+    matches = self.write_file("matches.csv",
+        "week,match_number,home_team,away_team,main_ref_team,backup_ref_team\n"
+        "3,1,Amazon,Dropbox,Facebook,Google\n")
+    self.assertEqual(bulk_import.main(["bulk_import.py", self.db_path, matches]), 0)
+    self.assertEqual(self.query("SELECT week, version FROM week_versions"), [(3, 1)])
+    self.assertIn("Imported 0 teams, 0 players, 0 accounts, 1 matches", sys.stdout.getvalue())
+
+  def test_errors_import_nothing(self):
+    teams = self.write_file("teams.jsonl", '{"name": "Apple"}\n{"name": "Apple"}\n')
+    self.assertEqual(bulk_import.main(["bulk_import.py", self.db_path, teams]), 1)
+    self.assertEqual(self.query("SELECT COUNT(*) FROM teams"), [(8,)])
+    self.assertIn("1 errors; nothing imported", sys.stdout.getvalue())
+
+  def test_dry_run(self):
+    teams = self.write_file("teams.jsonl", '{"name": "Apple"}\n')
+    self.assertEqual(bulk_import.main(["bulk_import.py", "--dry-run", self.db_path, teams]), 0)
+    self.assertEqual(self.query("SELECT COUNT(*) FROM teams"), [(8,)])
+
+
+if __name__ == "__main__":
+  unittest.main()
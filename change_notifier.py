@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Wake waiting event streams when a week's data changes.
+#
+# A WeekNotifier tracks the week_versions of one database.  Writers in this
+# process call publish() after committing, which wakes waiters at once.
+# Changes made by other processes are picked up by a single poller thread
+# per database, which runs only while something is waiting: it checks
+# PRAGMA data_version (which changes whenever another connection commits)
+# every poll_interval seconds and only re-reads week_versions when it has.
+# However many streams are open, they cost the database one cheap query per
+# interval.
+import os
+import time
+import urllib
+import sqlite3
+import threading
+
+
+class WeekNotifier(object):
+
+  def __init__(self, path, poll_interval=1.0):
+    self.path = path
+    self.poll_interval = poll_interval
+    # week -> (version, kind of the last change)
+    self.versions = {}
+    self._cond = threading.Condition()
+    self._listeners = 0
+    self._poller = None
+
+  def current(self, week):
+    with self._cond:
+      return self.versions.get(week, (0, None))
+
+  def publish(self, week, version, kind):
+    with self._cond:
+      self._update(week, version, kind)
+
+  def _update(self, week, version, kind):
+    if version > self.versions.get(week, (0, None))[0]:
+      self.versions[week] = (version, kind)
+      self._cond.notify_all()
+
+  # Block until the week's version is past `version` or `timeout` seconds
+  # have passed, and return the week's (version, kind).
+  def wait(self, week, version, timeout):
+    deadline = time.time() + timeout
+    with self._cond:
+      self._listeners += 1
+      try:
+        if self._poller is None:
+          self._poller = threading.Thread(target=self._poll, name="week-notifier")
+          self._poller.daemon = True
+          self._poller.start()
+        while self.versions.get(week, (0, None))[0] <= version:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._cond.wait(remaining)
+        return self.versions.get(week, (0, None))
+      finally:
+        self._listeners -= 1
+
+  def _poll(self):
+    conn = sqlite3.connect("file:%s?mode=ro" % urllib.quote(os.path.abspath(self.path)),
+        check_same_thread=False)
+    try:
+      data_version = None
+      while True:
+        with self._cond:
+          if not self._listeners:
+            self._poller = None
+            return
+        current = conn.execute("PRAGMA data_version").fetchone()[0]
+        if current != data_version:
+          data_version = current
+          rows = conn.execute("SELECT week, version FROM week_versions").fetchall()
+          with self._cond:
+            for week, version in rows:
+              self._update(week, version, "change")
+        time.sleep(self.poll_interval)
+    except Exception:
+      with self._cond:
+        self._poller = None
+      raise
+    finally:
+      conn.close()
@@ -3,8 +3,12 @@ import ahgl_admin
 
 DATA_DIR = './data'
 SEASON = '2'
+AUTO_MIGRATE = True
+# Needs the threaded server below.
+EVENTS_ENABLED = True
 
 if __name__ == '__main__':
   ahgl_admin.app.config.from_object(__name__)
   ahgl_admin.app.secret_key = 'AHGL'
-  ahgl_admin.app.run(debug=True)
+  # Event streams hold a thread each while they wait.
+  ahgl_admin.app.run(debug=True, threaded=True)
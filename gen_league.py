@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Generate synthetic leagues for scale testing.
+#
+# Produces schema-valid databases with teams, accounts, rosters (including
+# benched players and roster turnover between seasons), a schedule with
+# referee assignments, weekly maps, lineups, referees, set results, ace
+# matches and replay blobs of random size in the replay store.  The output
+# depends only on the options and --seed.
+#
+#   ./gen_league.py OUT_DIR                    # OUT_DIR/ahgl.sq3, OUT_DIR/replays
+#   ./gen_league.py --seasons 4 --teams 32 --weeks 10 OUT_DIR
+#                                              # OUT_DIR/<season>/ahgl.sq3, shared OUT_DIR/replays
+import sys
+import os
+import random
+import sqlite3
+import optparse
+import cStringIO
+
+import league_stats
+import replay_store
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+MAP_POOL = [
+  "Antiga Shipyard", "Backwater Gulch", "Cloud Kingdom", "Daybreak",
+  "Entombed Valley", "Metalopolis", "Ohana", "Shakuras Plateau",
+  "Shattered Temple", "Tal'Darim Altar", "Typhon Peaks", "Xel'Naga Caverns",
+  ]
+
+_SYLLABLES = ["ka", "zer", "ling", "pro", "to", "mar", "ine", "vo", "id", "rax",
+    "hy", "dra", "sen", "try", "bane", "ul", "tra", "lisk", "zea", "lot"]
+
+
+def random_bytes(rand, size):
+  if not size:
+    return ""
+  return ("%0*x" % (size * 2, rand.getrandbits(size * 8))).decode("hex")
+
+
+def player_name(rand):
+  return "".join(rand.choice(_SYLLABLES) for _ in range(rand.randint(2, 3))).capitalize()
+
+
+def round_robin(teams, week):
+  # Circle method: team 0 stays put and the rest rotate one step a week.
+  teams = list(teams)
+  if len(teams) % 2:
+    teams.append(None)
+  rest = teams[1:]
+  shift = (week - 1) % len(rest)
+  rotated = [teams[0]] + rest[-shift:] + rest[:-shift] if shift else teams
+  half = len(rotated) // 2
+  pairs = zip(rotated[:half], reversed(rotated[half:]))
+  return [ (h, a) if week % 2 else (a, h) for (h, a) in pairs if h is not None and a is not None ]
+
+
+class LeagueGenerator(object):
+
+  def __init__(self, rand, store, teams=16, weeks=8, roster_size=9,
+      min_replay_size=20 * 1024, max_replay_size=400 * 1024, open_weeks=0,
+      replay_probability=0.9, forfeit_probability=0.02):
+    self.rand = rand
+    self.store = store
+    self.num_teams = teams
+    self.num_weeks = weeks
+    self.roster_size = roster_size
+    self.min_replay_size = min_replay_size
+    self.max_replay_size = max_replay_size
+    self.open_weeks = open_weeks
+    self.replay_probability = replay_probability
+    self.forfeit_probability = forfeit_probability
+    # Players carried between seasons: team slot -> [(name, char_code, race)]
+    self.veterans = {}
+
+  def replay(self):
+    # Replay sizes are skewed towards short games.
+    span = self.max_replay_size - self.min_replay_size
+    size = self.min_replay_size + int(span * self.rand.random() ** 2)
+    return self.store.add_stream(cStringIO.StringIO(random_bytes(self.rand, size)))
+
+  def roster(self, slot):
+    rand = self.rand
+    players = [ p for p in self.veterans.get(slot, []) if rand.random() < 0.8 ]
+    while len(players) < self.roster_size:
+      players.append((player_name(rand), str(rand.randint(100, 999)) if rand.random() < 0.95 else None,
+          rand.choice("TZPPZTR")))
+    self.veterans[slot] = players
+    return players
+
+  def generate(self, db_path):
+    rand = self.rand
+    conn = sqlite3.connect(db_path)
+    with open(SCHEMA_PATH) as handle:
+      conn.executescript(handle.read())
+
+    teams = []
+    players = {}
+    player_rows = []
+    next_pid = 1
+    for slot in range(1, self.num_teams + 1):
+      teams.append((slot, "Team %s" % player_name(rand), "Captain %s" % player_name(rand)))
+      players[slot] = []
+      for num, (name, char_code, race) in enumerate(self.roster(slot)):
+        # About one in five rostered players sits on the bench.
+        active = 0 if num >= self.roster_size - max(1, self.roster_size // 5) else 1
+        player_rows.append((next_pid, slot, active, name, char_code))
+        if active:
+          players[slot].append((next_pid, race))
+        next_pid += 1
+    conn.executemany("INSERT INTO teams VALUES (?,?,?)", teams)
+    conn.executemany("INSERT INTO players VALUES (?,?,?,?,?)", player_rows)
+    conn.executemany("INSERT INTO accounts VALUES (?,?,?,?)",
+        [ (1, "admin@example.com", -1, "%040x" % rand.getrandbits(160)) ] +
+        [ (slot + 1, "captain%d@example.com" % slot, slot, "%040x" % rand.getrandbits(160))
+          for slot in range(1, self.num_teams + 1) ])
+    conn.executemany("INSERT INTO mapnames VALUES (?,?)", list(enumerate(MAP_POOL, 1)))
+
+    team_ids = range(1, self.num_teams + 1)
+    open_matches = []
+    for week in range(1, self.num_weeks + 1):
+      pairs = round_robin(team_ids, week)
+      for setnum, mapid in enumerate(rand.sample(range(1, len(MAP_POOL) + 1), 5), 1):
+        conn.execute("INSERT INTO maps VALUES (?,?,?)", (week, setnum, mapid))
+      for match, (home, away) in enumerate(pairs, 1):
+        refs = rand.sample([ t for t in team_ids if t not in (home, away) ] or [home, away], 2)
+        conn.execute("INSERT INTO matches VALUES (?,?,?,?,?,?)",
+            (week, match, home, away, refs[0], refs[1]))
+        lineups = {}
+        for team in (home, away):
+          picks = rand.sample(players[team], min(5, len(players[team])))
+          lineups[team] = picks
+          conn.executemany("INSERT INTO lineup VALUES (?,?,?,?,?)", [
+              (week, team, setnum, pid, race if rand.random() < 0.9 else rand.choice("TZP"))
+              for setnum, (pid, race) in enumerate(picks[:4], 1) ])
+          conn.execute("INSERT INTO referees VALUES (?,?,?)",
+              (week, team, "%s ref" % player_name(rand)))
+        if week > self.num_weeks - self.open_weeks:
+          open_matches.append((week, match))
+          continue
+        self.generate_result(conn, week, match, home, away, lineups)
+      conn.execute("INSERT INTO week_versions VALUES (?,?)", (week, 1))
+
+    league_stats.rebuild(conn.cursor())
+    conn.commit()
+    conn.close()
+    return dict(teams=self.num_teams, weeks=self.num_weeks,
+        players=next_pid - 1, open_matches=open_matches)
+
+  def generate_result(self, conn, week, match, home, away, lineups):
+    rand = self.rand
+    sets_home = sets_away = 0
+    rows = []
+    for setnum in range(1, 6):
+      if sets_home == 3 or sets_away == 3:
+        rows.append((week, match, setnum, 0, 0, 0, None))
+        continue
+      home_won = rand.random() < 0.55
+      sets_home += home_won
+      sets_away += not home_won
+      forfeit = int(rand.random() < self.forfeit_probability)
+      rephash = None
+      if not forfeit and rand.random() < self.replay_probability:
+        rephash = self.replay()
+      rows.append((week, match, setnum, int(home_won), int(not home_won), forfeit, rephash))
+      if setnum == 5:
+        (hp, hrace), (ap, arace) = lineups[home][-1], lineups[away][-1]
+        conn.execute("INSERT INTO ace_matches VALUES (?,?,?,?,?,?)",
+            (week, match, hp, ap, hrace, arace))
+    conn.executemany("INSERT INTO set_results VALUES (?,?,?,?,?,?,?)", rows)
+
+
+def generate_league(out_dir, seasons=1, seed=1, **kwds):
+  rand = random.Random(seed)
+  store = replay_store.ReplayStore(os.path.join(out_dir, "replays"))
+  generator = LeagueGenerator(rand, store, **kwds)
+  results = {}
+  for season in range(1, seasons + 1):
+    season_dir = out_dir if seasons == 1 else os.path.join(out_dir, str(season))
+    if not os.path.isdir(season_dir):
+      os.makedirs(season_dir)
+    db_path = os.path.join(season_dir, "ahgl.sq3")
+    if os.path.exists(db_path):
+      raise Exception("%s already exists" % db_path)
+    results[str(season)] = generator.generate(db_path)
+  return results
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options] OUT_DIR")
+  parser.add_option("--seasons", type="int", default=1)
+  parser.add_option("--teams", type="int", default=16)
+  parser.add_option("--weeks", type="int", default=8)
+  parser.add_option("--roster-size", type="int", default=9)
+  parser.add_option("--open-weeks", type="int", default=0,
+      help="leave the last N weeks of each season without results")
+  parser.add_option("--min-replay-size", type="int", default=20 * 1024)
+  parser.add_option("--max-replay-size", type="int", default=400 * 1024)
+  parser.add_option("--seed", type="int", default=1)
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 1:
+    parser.error("expected one output directory")
+  if options.teams < 2:
+    parser.error("need at least two teams")
+  if options.roster_size < 5:
+    parser.error("need at least five players per team")
+
+  results = generate_league(args[0],
+      seasons = options.seasons,
+      seed = options.seed,
+      teams = options.teams,
+      weeks = options.weeks,
+      roster_size = options.roster_size,
+      open_weeks = options.open_weeks,
+      min_replay_size = options.min_replay_size,
+      max_replay_size = options.max_replay_size,
+      )
+  for season, info in sorted(results.items()):
+    sys.stdout.write("season %s: %d teams, %d players, %d weeks\n"
+        % (season, info["teams"], info["players"], info["weeks"]))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
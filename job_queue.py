@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Durable job queue kept in the league database's jobs table.
+#
+# Jobs are enqueued in the same transaction as the rows they follow up on,
+# so they exist exactly when those rows do.  Workers (see ahgl_worker.py)
+# claim one job at a time in a short write transaction, and renew the
+# claim's lease while they run it.  A job whose worker died is claimed
+# again once its lease runs out, and a failed job is retried with
+# exponential backoff until it runs out of attempts, so handlers must be
+# safe to run more than once.  Only the worker holding a job can renew or
+# finish it, so a worker that lost its lease cannot overwrite the outcome
+# of the attempt that took over.
+#
+# These functions take a cursor and leave transactions to the caller.
+import time
+import json
+import collections
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+Job = collections.namedtuple("Job", ["id", "kind", "args", "attempts", "worker"])
+
+
+# Returns the new job's id, or None when `unique` and an identical job is
+# already waiting to run.
+def enqueue(cursor, kind, args, delay=0, unique=False):
+  now = time.time()
+  args = json.dumps(args, sort_keys=True)
+  if unique:
+    cursor.execute(
+        "SELECT id FROM jobs WHERE status = ? AND kind = ? AND args = ? LIMIT 1",
+        (PENDING, kind, args))
+    if list(cursor):
+      return None
+  cursor.execute(
+      "INSERT INTO jobs(kind, args, status, attempts, run_after, created) "
+      "VALUES (?,?,?,0,?,?) "
+      , (kind, args, PENDING, now + delay, now))
+  return cursor.lastrowid
+
+
+# Mark the next runnable job as running for `worker`, leased to it for
+# `lease` seconds, and return it, or None.
+def claim(cursor, worker, lease):
+  now = time.time()
+  cursor.execute(
+      "SELECT id, kind, args, attempts FROM jobs "
+      "WHERE status = ? AND run_after <= ? "
+      "ORDER BY run_after, id LIMIT 1"
+      , (PENDING, now))
+  rows = list(cursor)
+  if not rows:
+    cursor.execute(
+        "SELECT id, kind, args, attempts FROM jobs "
+        "WHERE status = ? AND lease_until <= ? "
+        "ORDER BY lease_until LIMIT 1"
+        , (RUNNING, now))
+    rows = list(cursor)
+  if not rows:
+    return None
+  job_id, kind, args, attempts = rows[0]
+  cursor.execute(
+      "UPDATE jobs SET status = ?, attempts = ?, started = ?, finished = NULL, worker = ?, "
+      "lease_until = ? WHERE id = ?"
+      , (RUNNING, attempts + 1, now, worker, now + lease, job_id))
+  return Job(job_id, kind, json.loads(args), attempts + 1, worker)
+
+
+def _update_held(cursor, job, assignments, params):
+  cursor.execute("UPDATE jobs SET " + assignments + " WHERE id = ? AND worker = ? AND status = ?",
+      params + (job.id, job.worker, RUNNING))
+  return cursor.rowcount == 1
+
+
+# Extend the job's lease to `lease` seconds from now.  Returns False if the
+# worker no longer holds the job.
+def renew(cursor, job, lease):
+  return _update_held(cursor, job, "lease_until = ?", (time.time() + lease,))
+
+
+# Returns False, changing nothing, if the worker no longer holds the job.
+def complete(cursor, job):
+  return _update_held(cursor, job, "status = ?, finished = ?, error = NULL",
+      (DONE, time.time()))
+
+
+# Record a failed attempt; the job runs again after retry_delay * 2 **
+# (attempts - 1) seconds, unless it has had max_attempts already.  Returns
+# False, changing nothing, if the worker no longer holds the job.
+def fail(cursor, job, error, max_attempts, retry_delay):
+  now = time.time()
+  if job.attempts >= max_attempts:
+    return _update_held(cursor, job, "status = ?, finished = ?, error = ?",
+        (FAILED, now, error))
+  return _update_held(cursor, job, "status = ?, run_after = ?, error = ?",
+      (PENDING, now + retry_delay * 2 ** (job.attempts - 1), error))
+
+
+# Give a failed job a fresh set of attempts.  Returns whether it was failed.
+def retry(cursor, job_id):
+  cursor.execute(
+      "UPDATE jobs SET status = ?, attempts = 0, run_after = ? WHERE id = ? AND status = ?",
+      (PENDING, time.time(), job_id, FAILED))
+  return cursor.rowcount == 1
+
+
+# {(kind, status): count}
+def counts(cursor):
+  cursor.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status")
+  return dict(((kind, status), count) for (kind, status, count) in cursor)
+
+
+def recent(cursor, limit, status=None):
+  query = ("SELECT id, kind, args, status, attempts, created, started, finished, worker, error "
+      "FROM jobs ")
+  params = ()
+  if status is not None:
+    query += "WHERE status = ? "
+    params = (status,)
+  cursor.execute(query + "ORDER BY id DESC LIMIT ?", params + (limit,))
+  return list(cursor)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import time
+import sqlite3
+import unittest
+
+import job_queue
+
+
+class JobQueueTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = sqlite3.connect(":memory:")
+    with open("./schema.sql") as handle:
+      self.conn.executescript(handle.read())
+    self.cursor = self.conn.cursor()
+
+  def tearDown(self):
+    self.conn.close()
+
+  def status(self, job_id):
+    self.cursor.execute("SELECT status, attempts, error FROM jobs WHERE id = ?", (job_id,))
+    return list(self.cursor)[0]
+
+  def expire_lease(self, job_id):
+    self.cursor.execute("UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() - 1, job_id))
+
+  def test_claim_order(self):
+    later = job_queue.enqueue(self.cursor, "a", dict(n=1), delay=60)
+    first = job_queue.enqueue(self.cursor, "a", dict(n=2))
+    second = job_queue.enqueue(self.cursor, "b", dict(n=3))
+    job = job_queue.claim(self.cursor, "w1", 60)
+    self.assertEqual(job, job_queue.Job(first, "a", dict(n=2), 1, "w1"))
+    self.assertEqual(job_queue.claim(self.cursor, "w1", 60).id, second)
+    # The delayed job is not due, and the others are leased.
+    self.assertEqual(job_queue.claim(self.cursor, "w1", 60), None)
+    self.assertEqual(self.status(later)[0], job_queue.PENDING)
+
+  def test_unique(self):
+    job_id = job_queue.enqueue(self.cursor, "a", dict(x=1, y=2), unique=True)
+    self.assertEqual(job_queue.enqueue(self.cursor, "a", dict(y=2, x=1), unique=True), None)
+    self.assertNotEqual(job_queue.enqueue(self.cursor, "a", dict(x=1, y=3), unique=True), None)
+    # Once the first has started, a new one is queued behind it.
+    job_queue.claim(self.cursor, "w1", 60)
+    self.assertNotEqual(job_queue.enqueue(self.cursor, "a", dict(x=1, y=2), unique=True), None)
+    self.assertEqual(job_queue.counts(self.cursor),
+        {("a", job_queue.RUNNING): 1, ("a", job_queue.PENDING): 2})
+    self.assertEqual(self.status(job_id)[0], job_queue.RUNNING)
+
+  def test_complete(self):
+    job_queue.enqueue(self.cursor, "a", {})
+    job = job_queue.claim(self.cursor, "w1", 60)
+    self.assertTrue(job_queue.complete(self.cursor, job))
+    self.assertEqual(self.status(job.id), (job_queue.DONE, 1, None))
+    self.assertEqual(job_queue.claim(self.cursor, "w1", 60), None)
+
+  def test_fail_and_retry(self):
+    job_queue.enqueue(self.cursor, "a", {})
+    job = job_queue.claim(self.cursor, "w1", 60)
+    self.assertTrue(job_queue.fail(self.cursor, job, "boom", 2, 30))
+    self.assertEqual(self.status(job.id), (job_queue.PENDING, 1, "boom"))
+    # Not due until the retry delay has passed.
+    self.assertEqual(job_queue.claim(self.cursor, "w1", 60), None)
+    self.cursor.execute("UPDATE jobs SET run_after = 0")
+    job = job_queue.claim(self.cursor, "w1", 60)
+    self.assertEqual(job.attempts, 2)
+    self.assertTrue(job_queue.fail(self.cursor, job, "boom again", 2, 30))
+    self.assertEqual(self.status(job.id), (job_queue.FAILED, 2, "boom again"))
+
+    self.assertFalse(job_queue.retry(self.cursor, job.id + 1))
+    self.assertTrue(job_queue.retry(self.cursor, job.id))
+    self.assertEqual(job_queue.claim(self.cursor, "w1", 60).attempts, 1)
+
+  def test_expired_lease_is_claimed_again(self):
+    job_queue.enqueue(self.cursor, "a", {})
+    first = job_queue.claim(self.cursor, "w1", 60)
+    self.assertEqual(job_queue.claim(self.cursor, "w2", 60), None)
+    self.expire_lease(first.id)
+    second = job_queue.claim(self.cursor, "w2", 60)
+    self.assertEqual((second.id, second.attempts, second.worker), (first.id, 2, "w2"))
+
+    # The first worker can no longer renew, complete or fail the job.
+    self.assertFalse(job_queue.renew(self.cursor, first, 60))
+    self.assertFalse(job_queue.fail(self.cursor, first, "busy", 5, 30))
+    self.assertFalse(job_queue.complete(self.cursor, first))
+    self.assertEqual(self.status(first.id), (job_queue.RUNNING, 2, None))
+    self.assertTrue(job_queue.complete(self.cursor, second))
+    self.assertFalse(job_queue.fail(self.cursor, first, "late", 5, 30))
+    self.assertEqual(self.status(first.id), (job_queue.DONE, 2, None))
+
+  def test_renew(self):
+    job_queue.enqueue(self.cursor, "a", {})
+    job = job_queue.claim(self.cursor, "w1", 60)
+    self.expire_lease(job.id)
+    self.assertTrue(job_queue.renew(self.cursor, job, 60))
+    self.assertEqual(job_queue.claim(self.cursor, "w2", 60), None)
+
+  def test_recent(self):
+    for n in range(3):
+      job_queue.enqueue(self.cursor, "a", dict(n=n))
+    job = job_queue.claim(self.cursor, "w1", 60)
+    job_queue.fail(self.cursor, job, "boom", 1, 30)
+    self.assertEqual([ row[0] for row in job_queue.recent(self.cursor, 2) ], [3, 2])
+    self.assertEqual([ row[0] for row in job_queue.recent(self.cursor, 10, job_queue.FAILED) ],
+        [job.id])
+
+
+if __name__ == "__main__":
+  unittest.main()
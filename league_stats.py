@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# Materialized season standings and player statistics.
+#
+# team_standings holds each team's match and set record and ace record, and
+# player_stats each player's wins and losses overall ("all"), against each
+# race ("vs_race"), on each map ("map") and in ace matches ("ace").
+# submit_result applies one match's contribution inside its own
+# transaction (apply_match); rebuild() recomputes everything from the
+# results tables, and check() reports where the tables disagree with a
+# fresh computation.  Forfeited sets count towards the teams' records but
+# not the players'.
+#
+#   ./league_stats.py check data/ahgl.sq3
+#   ./league_stats.py rebuild data/ahgl.sq3
+import sys
+import os
+import sqlite3
+import optparse
+import collections
+
+
+TEAM_COLUMNS = ("matches_won", "matches_lost", "sets_won", "sets_lost", "aces_won", "aces_lost")
+
+
+# One match's contribution to the tables:
+#   ({team: {column: count}}, {(player, category, key): [wins, losses]})
+#   sets: {set_number: (home_winner, away_winner, forfeit)}
+#   lineups: {(team, set_number): (player, race)} for the week
+#   maps: {set_number: mapname} for the week
+#   ace: (home_player, away_player, home_race, away_race) or None
+def match_deltas(home, away, sets, lineups, maps, ace):
+  teams = { home: dict.fromkeys(TEAM_COLUMNS, 0), away: dict.fromkeys(TEAM_COLUMNS, 0) }
+  players = collections.defaultdict(lambda: [0, 0])
+  home_sets = away_sets = 0
+  for setnum, (home_won, away_won, forfeit) in sorted(sets.items()):
+    if not (home_won or away_won):
+      continue
+    home_sets += bool(home_won)
+    away_sets += bool(away_won)
+    if setnum == 5:
+      teams[home]["aces_won" if home_won else "aces_lost"] += 1
+      teams[away]["aces_won" if away_won else "aces_lost"] += 1
+      if ace is None:
+        continue
+      home_player, away_player, home_race, away_race = ace
+    else:
+      if (home, setnum) not in lineups or (away, setnum) not in lineups:
+        continue
+      home_player, home_race = lineups[home, setnum]
+      away_player, away_race = lineups[away, setnum]
+    if forfeit:
+      continue
+    for player, won, opponent_race in (
+        (home_player, home_won, away_race), (away_player, away_won, home_race)):
+      outcome = 0 if won else 1
+      players[player, "all", ""][outcome] += 1
+      players[player, "vs_race", opponent_race][outcome] += 1
+      if setnum in maps:
+        players[player, "map", maps[setnum]][outcome] += 1
+      if setnum == 5:
+        players[player, "ace", ""][outcome] += 1
+
+  teams[home]["sets_won"] += home_sets
+  teams[home]["sets_lost"] += away_sets
+  teams[away]["sets_won"] += away_sets
+  teams[away]["sets_lost"] += home_sets
+  if home_sets != away_sets:
+    winner, loser = (home, away) if home_sets > away_sets else (away, home)
+    teams[winner]["matches_won"] += 1
+    teams[loser]["matches_lost"] += 1
+  return teams, dict(players)
+
+
+def _add_deltas(total_teams, total_players, teams, players):
+  for team, counts in teams.items():
+    row = total_teams.setdefault(team, dict.fromkeys(TEAM_COLUMNS, 0))
+    for column, count in counts.items():
+      row[column] += count
+  for key, (wins, losses) in players.items():
+    row = total_players.setdefault(key, [0, 0])
+    row[0] += wins
+    row[1] += losses
+
+
+def apply_deltas(cursor, teams, players):
+  cursor.executemany("INSERT OR IGNORE INTO team_standings(team) VALUES (?)",
+      [ (team,) for team in teams ])
+  cursor.executemany(
+      "UPDATE team_standings SET "
+      + ", ".join("%s = %s + ?" % (column, column) for column in TEAM_COLUMNS)
+      + " WHERE team = ?"
+      , [ tuple(counts[column] for column in TEAM_COLUMNS) + (team,)
+        for team, counts in teams.items() ])
+  cursor.executemany(
+      "INSERT OR IGNORE INTO player_stats(player, category, key) VALUES (?,?,?)",
+      list(players))
+  cursor.executemany(
+      "UPDATE player_stats SET wins = wins + ?, losses = losses + ? "
+      "WHERE player = ? AND category = ? AND key = ?"
+      , [ (wins, losses) + key for key, (wins, losses) in players.items() ])
+
+
+# Add one match's result to the tables.  Call in the transaction that
+# inserted the result.
+def apply_match(cursor, week, match):
+  cursor.execute("SELECT home_team, away_team FROM matches WHERE week = ? AND match_number = ?",
+      (week, match))
+  home, away = list(cursor)[0]
+  cursor.execute(
+      "SELECT set_number, home_winner, away_winner, forfeit "
+      "FROM set_results WHERE week = ? AND match_number = ?", (week, match))
+  sets = dict((row[0], tuple(row[1:])) for row in cursor)
+  cursor.execute(
+      "SELECT team, set_number, player, race FROM lineup "
+      "WHERE week = ? AND team IN (?,?)", (week, home, away))
+  lineups = dict(((team, setnum), (player, race)) for (team, setnum, player, race) in cursor)
+  cursor.execute(
+      "SELECT set_number, mapname FROM maps JOIN mapnames ON mapid = mapnames.id "
+      "WHERE week = ?", (week,))
+  maps = dict(cursor)
+  cursor.execute(
+      "SELECT home_player, away_player, home_race, away_race FROM ace_matches "
+      "WHERE week = ? AND match_number = ?", (week, match))
+  aces = list(cursor)
+  teams, players = match_deltas(home, away, sets, lineups, maps, aces[0] if aces else None)
+  apply_deltas(cursor, teams, players)
+
+
+# The tables' contents computed from scratch: ({team: {column: count}},
+# {(player, category, key): [wins, losses]}).
+def compute(cursor):
+  cursor.execute(
+      "SELECT week, match_number, set_number, home_winner, away_winner, forfeit FROM set_results")
+  results = {}
+  for (week, match, setnum, home_won, away_won, forfeit) in cursor:
+    results.setdefault((week, match), {})[setnum] = (home_won, away_won, forfeit)
+  cursor.execute("SELECT week, match_number, home_team, away_team FROM matches")
+  matches = dict(((week, match), (home, away)) for (week, match, home, away) in cursor)
+  lineups = {}
+  cursor.execute("SELECT week, team, set_number, player, race FROM lineup")
+  for (week, team, setnum, player, race) in cursor:
+    lineups.setdefault(week, {})[team, setnum] = (player, race)
+  maps = {}
+  cursor.execute(
+      "SELECT week, set_number, mapname FROM maps JOIN mapnames ON mapid = mapnames.id")
+  for (week, setnum, mapname) in cursor:
+    maps.setdefault(week, {})[setnum] = mapname
+  cursor.execute(
+      "SELECT week, match_number, home_player, away_player, home_race, away_race FROM ace_matches")
+  aces = dict(((row[0], row[1]), tuple(row[2:])) for row in cursor)
+
+  teams = {}
+  players = {}
+  for (week, match), sets in sorted(results.items()):
+    if (week, match) not in matches:
+      continue
+    home, away = matches[week, match]
+    _add_deltas(teams, players, *match_deltas(home, away, sets,
+        lineups.get(week, {}), maps.get(week, {}), aces.get((week, match))))
+  return teams, players
+
+
+def rebuild(cursor):
+  cursor.execute("DELETE FROM team_standings")
+  cursor.execute("DELETE FROM player_stats")
+  teams, players = compute(cursor)
+  apply_deltas(cursor, teams, players)
+
+
+# Differences between the tables and a fresh computation, as strings.
+def check(cursor):
+  expected_teams, expected_players = compute(cursor)
+  cursor.execute("SELECT team, " + ", ".join(TEAM_COLUMNS) + " FROM team_standings")
+  actual_teams = dict((row[0], dict(zip(TEAM_COLUMNS, row[1:]))) for row in cursor)
+  cursor.execute("SELECT player, category, key, wins, losses FROM player_stats")
+  actual_players = dict((tuple(row[:3]), list(row[3:])) for row in cursor)
+
+  problems = []
+  zero_team = dict.fromkeys(TEAM_COLUMNS, 0)
+  for team in sorted(set(expected_teams) | set(actual_teams)):
+    expected = expected_teams.get(team, zero_team)
+    actual = actual_teams.get(team, zero_team)
+    if expected != actual:
+      problems.append("team %s: have %r, expected %r" % (team, actual, expected))
+  for key in sorted(set(expected_players) | set(actual_players)):
+    expected = expected_players.get(key, [0, 0])
+    actual = actual_players.get(key, [0, 0])
+    if expected != actual:
+      problems.append("player %s %s %s: have %d-%d, expected %d-%d"
+          % (key + tuple(actual) + tuple(expected)))
+  return problems
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog check|rebuild DATABASE")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 2 or args[0] not in ("check", "rebuild"):
+    parser.error("expected 'check DATABASE' or 'rebuild DATABASE'")
+  command, path = args
+  if not os.path.exists(path):
+    parser.error("no such database: %s" % path)
+
+  conn = sqlite3.connect(path)
+  conn.isolation_level = None
+  try:
+    # Hold the write lock so no result lands between reading and writing.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      cursor = conn.cursor()
+      if command == "rebuild":
+        rebuild(cursor)
+      problems = check(cursor)
+      conn.execute("COMMIT" if command == "rebuild" else "ROLLBACK")
+    except:
+      conn.execute("ROLLBACK")
+      raise
+  finally:
+    conn.close()
+
+  for problem in problems:
+    sys.stdout.write(problem + "\n")
+  sys.stdout.write("%d problems\n" % len(problems))
+  return 1 if problems else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import sqlite3
+import unittest
+
+import league_stats
+
+
+HOME, AWAY = 6, 8
+
+LINEUPS = {
+  (HOME, 1): (1, "P"), (HOME, 2): (2, "Z"), (HOME, 3): (3, "P"), (HOME, 4): (4, "P"),
+  (AWAY, 1): (7, "Z"), (AWAY, 2): (8, "P"), (AWAY, 3): (9, "Z"), (AWAY, 4): (10, "Z"),
+  }
+
+MAPS = {1: "Xel'Naga Caverns", 2: "Tal'Darim Altar", 3: "Backwater Gulch", 4: "Metalopolis",
+  5: "Shattered Temple"}
+
+
+def team_row(**counts):
+  row = dict.fromkeys(league_stats.TEAM_COLUMNS, 0)
+  row.update(counts)
+  return row
+
+
+class MatchDeltasTest(unittest.TestCase):
+
+  def test_three_one(self):
+    sets = {1: (1, 0, 0), 2: (0, 1, 0), 3: (1, 0, 0), 4: (1, 0, 0), 5: (0, 0, 0)}
+    teams, players = league_stats.match_deltas(HOME, AWAY, sets, LINEUPS, MAPS, None)
+    self.assertEqual(teams, {
+      HOME: team_row(matches_won=1, sets_won=3, sets_lost=1),
+      AWAY: team_row(matches_lost=1, sets_won=1, sets_lost=3),
+      })
+    self.assertEqual(players[1, "all", ""], [1, 0])
+    self.assertEqual(players[1, "vs_race", "Z"], [1, 0])
+    self.assertEqual(players[7, "map", "Xel'Naga Caverns"], [0, 1])
+    self.assertEqual(players[8, "all", ""], [1, 0])
+    self.assertEqual(players[2, "vs_race", "P"], [0, 1])
+    self.assertNotIn((1, "ace", ""), players)
+
+  def test_ace_and_forfeit(self):
+    sets = {1: (1, 0, 1), 2: (0, 1, 0), 3: (1, 0, 0), 4: (0, 1, 0), 5: (0, 1, 0)}
+    ace = (5, 11, "T", "R")
+    teams, players = league_stats.match_deltas(HOME, AWAY, sets, LINEUPS, MAPS, ace)
+    self.assertEqual(teams, {
+      HOME: team_row(matches_lost=1, sets_won=2, sets_lost=3, aces_lost=1),
+      AWAY: team_row(matches_won=1, sets_won=3, sets_lost=2, aces_won=1),
+      })
+    # The forfeited set counts for the teams but not for the players.
+    self.assertNotIn((1, "all", ""), players)
+    self.assertNotIn((7, "all", ""), players)
+    self.assertEqual(players[11, "ace", ""], [1, 0])
+    self.assertEqual(players[11, "vs_race", "T"], [1, 0])
+    self.assertEqual(players[5, "map", "Shattered Temple"], [0, 1])
+
+  def test_missing_lineup(self):
+    sets = {1: (1, 0, 0), 2: (1, 0, 0), 3: (1, 0, 0)}
+    lineups = dict((key, value) for (key, value) in LINEUPS.items() if key[0] == HOME)
+    teams, players = league_stats.match_deltas(HOME, AWAY, sets, lineups, MAPS, None)
+    self.assertEqual(teams[HOME], team_row(matches_won=1, sets_won=3))
+    self.assertEqual(players, {})
+
+
+class RebuildTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = sqlite3.connect(":memory:")
+    for fname in ["./schema.sql", "./test_data.sql", "./test_lineup.sql"]:
+      with open(fname) as handle:
+        self.conn.executescript(handle.read())
+    self.conn.executemany("INSERT INTO maps(week, set_number, mapid) VALUES (1,?,?)",
+        [(1, 7), (2, 5), (3, 1), (4, 2), (5, 4)])
+    self.cursor = self.conn.cursor()
+
+  def tearDown(self):
+    self.conn.close()
+
+  def add_result(self, match, winners):
+    self.cursor.executemany(
+        "INSERT INTO set_results(week, match_number, set_number, home_winner, away_winner, "
+        "forfeit, replay_hash) VALUES (1,?,?,?,?,0,NULL)",
+        [ (match, setnum, int(winner == "home"), int(winner == "away"))
+          for setnum, winner in enumerate(winners, 1) ])
+
+  def test_apply_match_agrees_with_rebuild(self):
+    self.add_result(1, ["home", "away", "home", "home", None])
+    league_stats.apply_match(self.cursor, 1, 1)
+    self.add_result(2, ["away", "away", "away", None, None])
+    league_stats.apply_match(self.cursor, 1, 2)
+    self.assertEqual(league_stats.check(self.cursor), [])
+
+    self.cursor.execute("SELECT matches_won, sets_won, sets_lost FROM team_standings WHERE team = 6")
+    self.assertEqual(list(self.cursor), [(1, 3, 1)])
+    self.cursor.execute("SELECT matches_lost, sets_lost FROM team_standings WHERE team = 3")
+    self.assertEqual(list(self.cursor), [(1, 3)])
+
+  def test_check_and_rebuild(self):
+    self.add_result(1, ["home", "away", "home", "home", None])
+    problems = league_stats.check(self.cursor)
+    self.assertIn("team 6: have", problems[0])
+    league_stats.rebuild(self.cursor)
+    self.assertEqual(league_stats.check(self.cursor), [])
+    league_stats.rebuild(self.cursor)
+    self.cursor.execute("SELECT wins, losses FROM player_stats WHERE player = 1 AND category = 'all'")
+    self.assertEqual(list(self.cursor), [(1, 0)])
+
+
+if __name__ == "__main__":
+  unittest.main()
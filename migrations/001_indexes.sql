@@ -0,0 +1,15 @@
+-- Indexes for the lookups made by the lineup, result, roster and replay
+-- routes, and the per-week version counters used by the page caches.
+
+CREATE INDEX IF NOT EXISTS accounts_team ON accounts (team);
+CREATE INDEX IF NOT EXISTS players_team ON players (team, active, name);
+CREATE INDEX IF NOT EXISTS matches_home_team ON matches (week, home_team, match_number);
+CREATE INDEX IF NOT EXISTS matches_away_team ON matches (week, away_team, match_number);
+CREATE INDEX IF NOT EXISTS lineup_player ON lineup (player, week, team, set_number);
+CREATE INDEX IF NOT EXISTS ace_matches_home_player ON ace_matches (home_player, week, match_number);
+CREATE INDEX IF NOT EXISTS ace_matches_away_player ON ace_matches (away_player, week, match_number);
+
+CREATE TABLE IF NOT EXISTS week_versions (
+  week INTEGER PRIMARY KEY,
+  version INTEGER
+);
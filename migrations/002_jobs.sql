@@ -0,0 +1,18 @@
+-- Durable queue of post-submission work for ahgl_worker.py (see
+-- job_queue.py).  status is pending, running, done or failed.
+
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY,
+  kind TEXT NOT NULL,
+  args TEXT NOT NULL,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_after REAL NOT NULL,
+  created REAL NOT NULL,
+  started REAL,
+  finished REAL,
+  worker TEXT,
+  error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after);
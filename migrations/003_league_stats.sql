@@ -0,0 +1,22 @@
+-- Materialized standings and player statistics (see league_stats.py).
+-- ahgl_migrate fills them from the existing results in the same
+-- transaction.
+
+CREATE TABLE IF NOT EXISTS team_standings (
+  team INTEGER PRIMARY KEY,
+  matches_won INTEGER NOT NULL DEFAULT 0,
+  matches_lost INTEGER NOT NULL DEFAULT 0,
+  sets_won INTEGER NOT NULL DEFAULT 0,
+  sets_lost INTEGER NOT NULL DEFAULT 0,
+  aces_won INTEGER NOT NULL DEFAULT 0,
+  aces_lost INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS player_stats (
+  player INTEGER,
+  category TEXT,
+  key TEXT,
+  wins INTEGER NOT NULL DEFAULT 0,
+  losses INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (player, category, key)
+);
@@ -0,0 +1,7 @@
+-- Job leases that the running worker renews (see job_queue.renew), rather
+-- than a fixed time from when the job started.  Jobs already running get
+-- the lease they had under the default JOB_LEASE_SECONDS.
+
+ALTER TABLE jobs ADD COLUMN lease_until REAL;
+
+UPDATE jobs SET lease_until = started + 600 WHERE status = 'running';
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Content-addressed storage for uploaded replays.
+#
+# Replays are stored as <root>/ab/cd/<sha1>.SC2Replay, where ab and cd are
+# the first two pairs of hex digits of the hash, so no directory grows past
+# a few hundred entries.  Older deployments kept every replay directly in
+# DATA_DIR; lookups fall back to that layout, and
+#
+#   ./replay_store.py migrate DATA_DIR [--root REPLAY_DIR]
+#
+# moves those files into the new layout, verifying each hash on the way.
+import sys
+import os
+import re
+import errno
+import shutil
+import hashlib
+import tempfile
+import optparse
+import multiprocessing
+
+
+CHUNK_SIZE = 64 * 1024
+SUFFIX = ".SC2Replay"
+
+_HASH_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+class ReplayTooLarge(Exception):
+  pass
+
+
+def is_replay_hash(rephash):
+  return bool(_HASH_RE.match(rephash))
+
+
+def _makedirs(path):
+  try:
+    os.makedirs(path)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+
+
+def hash_file(path):
+  digest = hashlib.sha1()
+  with open(path, "rb") as handle:
+    while True:
+      data = handle.read(CHUNK_SIZE)
+      if not data:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+
+class ReplayStore(object):
+
+  def __init__(self, root, legacy_root=None):
+    self.root = root
+    self.legacy_root = legacy_root
+
+  def path(self, rephash):
+    return os.path.join(self.root, rephash[0:2], rephash[2:4], rephash + SUFFIX)
+
+  def legacy_path(self, rephash):
+    if self.legacy_root is None:
+      return None
+    return os.path.join(self.legacy_root, rephash + SUFFIX)
+
+  def lookup(self, rephash):
+    for path in (self.path(rephash), self.legacy_path(rephash)):
+      if path and os.path.exists(path):
+        return path
+    return None
+
+  # Copy a stream into the store in fixed-size chunks, hashing as it goes,
+  # and return its hash.  The data is written under a temporary name and
+  # renamed into place, so a replay is either absent or complete.
+  def add_stream(self, stream, max_size=None):
+    _makedirs(self.root)
+    digest = hashlib.sha1()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".upload")
+    try:
+      # mkstemp creates 0600 files; a fronting server may need to read these.
+      os.fchmod(fd, 0o644)
+      with os.fdopen(fd, "wb") as handle:
+        while True:
+          data = stream.read(CHUNK_SIZE)
+          if not data:
+            break
+          size += len(data)
+          if max_size and size > max_size:
+            raise ReplayTooLarge()
+          digest.update(data)
+          handle.write(data)
+        handle.flush()
+        os.fsync(handle.fileno())
+      rephash = digest.hexdigest()
+      if self.lookup(rephash):
+        os.unlink(tmp_path)
+      else:
+        self._install(tmp_path, rephash)
+    except:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+      raise
+    return rephash
+
+  def _install(self, src, rephash):
+    dest = self.path(rephash)
+    _makedirs(os.path.dirname(dest))
+    os.rename(src, dest)
+
+  # Move one flat-layout replay into the sharded layout.  Returns a status
+  # string; files whose contents do not match their name are left alone.
+  def migrate_one(self, rephash, verify=True):
+    src = self.legacy_path(rephash)
+    dest = self.path(rephash)
+    if os.path.exists(dest):
+      if not verify or hash_file(dest) == rephash:
+        os.unlink(src)
+        return "duplicate"
+      return "corrupt-dest"
+    if verify and hash_file(src) != rephash:
+      return "corrupt"
+    _makedirs(os.path.dirname(dest))
+    try:
+      os.rename(src, dest)
+    except OSError as err:
+      if err.errno != errno.EXDEV:
+        raise
+      # Store on another filesystem: copy, check the copy, then remove.
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".upload")
+      os.close(fd)
+      shutil.copyfile(src, tmp_path)
+      os.chmod(tmp_path, 0o644)
+      if verify and hash_file(tmp_path) != rephash:
+        os.unlink(tmp_path)
+        return "copy-failed"
+      os.rename(tmp_path, dest)
+      os.unlink(src)
+    return "moved"
+
+  def legacy_hashes(self):
+    if self.legacy_root is None:
+      return []
+    hashes = []
+    for fname in os.listdir(self.legacy_root):
+      if fname.endswith(SUFFIX) and is_replay_hash(fname[:-len(SUFFIX)]):
+        hashes.append(fname[:-len(SUFFIX)])
+    return hashes
+
+
+def _migrate_worker(args):
+  root, legacy_root, rephash, verify = args
+  store = ReplayStore(root, legacy_root)
+  try:
+    return rephash, store.migrate_one(rephash, verify)
+  except (IOError, OSError) as err:
+    return rephash, "error: %s" % err
+
+
+def migrate(store, processes=None, verify=True, log=None):
+  hashes = store.legacy_hashes()
+  counts = {}
+  if not hashes:
+    return counts
+  pool = multiprocessing.Pool(processes)
+  try:
+    work = [ (store.root, store.legacy_root, rephash, verify) for rephash in hashes ]
+    for rephash, status in pool.imap_unordered(_migrate_worker, work, 16):
+      counts[status] = counts.get(status, 0) + 1
+      if log and status not in ("moved", "duplicate"):
+        log("%s: %s" % (rephash, status))
+  finally:
+    pool.close()
+    pool.join()
+  return counts
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog migrate DATA_DIR [options]")
+  parser.add_option("--root",
+      help="replay store directory (default DATA_DIR/replays)")
+  parser.add_option("--processes", type="int",
+      help="number of worker processes (default: one per CPU)")
+  parser.add_option("--no-verify", dest="verify", action="store_false", default=True,
+      help="skip checking each file's SHA-1 against its name")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 2 or args[0] != "migrate":
+    parser.error("expected 'migrate DATA_DIR'")
+  data_dir = args[1]
+
+  def log(msg):
+    sys.stdout.write(msg + "\n")
+
+  store = ReplayStore(options.root or os.path.join(data_dir, "replays"), data_dir)
+  counts = migrate(store, options.processes, options.verify, log)
+  for status, count in sorted(counts.items()):
+    log("%s: %d" % (status, count))
+  return 1 if set(counts) - set(["moved", "duplicate"]) else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import cStringIO
+
+import replay_store
+
+
+class ReplayStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.legacy_root = os.path.join(self.tmp_dir, "data")
+    os.mkdir(self.legacy_root)
+    self.store = replay_store.ReplayStore(os.path.join(self.tmp_dir, "replays"), self.legacy_root)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_legacy(self, data, rephash=None):
+    rephash = rephash or hashlib.sha1(data).hexdigest()
+    with open(self.store.legacy_path(rephash), "wb") as handle:
+      handle.write(data)
+    return rephash
+
+  def test_add_stream(self):
+    data = os.urandom(3 * replay_store.CHUNK_SIZE + 17)
+    rephash = self.store.add_stream(cStringIO.StringIO(data))
+    self.assertEqual(rephash, hashlib.sha1(data).hexdigest())
+    path = self.store.lookup(rephash)
+    self.assertEqual(path, os.path.join(self.store.root, rephash[:2], rephash[2:4],
+        rephash + ".SC2Replay"))
+    with open(path, "rb") as handle:
+      self.assertEqual(handle.read(), data)
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+    # Adding the same contents again keeps the one copy.
+    self.assertEqual(self.store.add_stream(cStringIO.StringIO(data)), rephash)
+    self.assertEqual(os.listdir(self.store.root), [rephash[:2]])
+
+  def test_too_large(self):
+    stream = cStringIO.StringIO("x" * 1000)
+    self.assertRaises(replay_store.ReplayTooLarge, self.store.add_stream, stream, 999)
+    self.assertEqual(os.listdir(self.store.root), [])
+
+  def test_lookup(self):
+    self.assertEqual(self.store.lookup("0" * 40), None)
+    rephash = self.write_legacy("legacy")
+    self.assertEqual(self.store.lookup(rephash), self.store.legacy_path(rephash))
+    self.assertFalse(replay_store.is_replay_hash("../" + rephash[3:]))
+    self.assertFalse(replay_store.is_replay_hash(rephash.upper()))
+
+  def test_migrate(self):
+    moved = self.write_legacy("moved")
+    duplicate = self.store.add_stream(cStringIO.StringIO("duplicate"))
+    self.write_legacy("duplicate")
+    corrupt = self.write_legacy("corrupt", "1" * 40)
+
+    counts = replay_store.migrate(self.store, processes=2)
+    self.assertEqual(counts, dict(moved=1, duplicate=1, corrupt=1))
+    for rephash in (moved, duplicate):
+      self.assertEqual(self.store.lookup(rephash), self.store.path(rephash))
+      self.assertFalse(os.path.exists(self.store.legacy_path(rephash)))
+    self.assertEqual(self.store.lookup(corrupt), self.store.legacy_path(corrupt))
+    self.assertEqual(self.store.legacy_hashes(), [corrupt])
+
+
+if __name__ == "__main__":
+  unittest.main()
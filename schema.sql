@@ -1,3 +1,12 @@
+-- Schema for a new database.  Changes to an existing database go in
+-- migrations/, and schema_version below records the last one included here.
+
+CREATE TABLE schema_version (
+  version INTEGER
+);
+
+INSERT INTO schema_version VALUES (4);
+
 CREATE TABLE teams (
   id INTEGER PRIMARY KEY,
   name TEXT,
@@ -13,6 +22,8 @@ CREATE TABLE accounts (
   UNIQUE (auth_key)
 );
 
+CREATE INDEX accounts_team ON accounts (team);
+
 CREATE TABLE players (
   id INTEGER PRIMARY KEY,
   team INTEGER,
@@ -21,6 +32,8 @@ CREATE TABLE players (
   char_code TEXT
 );
 
+CREATE INDEX players_team ON players (team, active, name);
+
 CREATE TABLE mapnames (
   id INTEGER PRIMARY KEY,
   mapname TEXT
@@ -36,6 +49,9 @@ CREATE TABLE matches (
   PRIMARY KEY (week, match_number)
 );
 
+CREATE INDEX matches_home_team ON matches (week, home_team, match_number);
+CREATE INDEX matches_away_team ON matches (week, away_team, match_number);
+
 CREATE TABLE maps (
   week INTEGER,
   set_number INTEGER,
@@ -52,6 +68,8 @@ CREATE TABLE lineup (
   PRIMARY KEY (week, team, set_number)
 );
 
+CREATE INDEX lineup_player ON lineup (player, week, team, set_number);
+
 CREATE TABLE referees (
   week INTEGER,
   team INTEGER,
@@ -69,6 +87,9 @@ CREATE TABLE ace_matches (
   PRIMARY KEY (week, match_number)
 );
 
+CREATE INDEX ace_matches_home_player ON ace_matches (home_player, week, match_number);
+CREATE INDEX ace_matches_away_player ON ace_matches (away_player, week, match_number);
+
 CREATE TABLE set_results (
   week INTEGER,
   match_number INTEGER,
@@ -79,3 +100,44 @@ CREATE TABLE set_results (
   replay_hash TEXT,
   PRIMARY KEY (week, match_number, set_number)
 );
+
+CREATE TABLE week_versions (
+  week INTEGER PRIMARY KEY,
+  version INTEGER
+);
+
+CREATE TABLE jobs (
+  id INTEGER PRIMARY KEY,
+  kind TEXT NOT NULL,
+  args TEXT NOT NULL,
+  status TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_after REAL NOT NULL,
+  created REAL NOT NULL,
+  started REAL,
+  finished REAL,
+  worker TEXT,
+  error TEXT,
+  lease_until REAL
+);
+
+CREATE INDEX jobs_status ON jobs (status, run_after);
+
+CREATE TABLE team_standings (
+  team INTEGER PRIMARY KEY,
+  matches_won INTEGER NOT NULL DEFAULT 0,
+  matches_lost INTEGER NOT NULL DEFAULT 0,
+  sets_won INTEGER NOT NULL DEFAULT 0,
+  sets_lost INTEGER NOT NULL DEFAULT 0,
+  aces_won INTEGER NOT NULL DEFAULT 0,
+  aces_lost INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE player_stats (
+  player INTEGER,
+  category TEXT,
+  key TEXT,
+  wins INTEGER NOT NULL DEFAULT 0,
+  losses INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (player, category, key)
+);
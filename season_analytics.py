@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# Map-balance and race-matchup reports over set results, using NumPy.
+#
+# load_games() reads every played set of a season with one joined query
+# into a GameTable of integer-coded columns: one entry per game, with the
+# home and away player, their races, the map, the week and which side won.
+# Reports are then grouped counts over those arrays (np.bincount on a
+# combined group code), so they cost the same whatever the grouping.
+# Forfeited and unplayed sets are left out.  Several seasons can be
+# combined with GameTable.concatenate.
+#
+#   ./season_analytics.py data/ahgl.sq3
+#   ./season_analytics.py --report matchups-by-map --json s1/ahgl.sq3 s2/ahgl.sq3
+import sys
+import json
+import sqlite3
+import optparse
+
+import numpy
+
+
+RACES = "TZPR"
+
+
+class GameTable(object):
+
+  def __init__(self, season, week, home_player, away_player, home_race, away_race,
+      map_code, home_won, map_names):
+    self.season = season
+    self.week = week
+    self.home_player = home_player
+    self.away_player = away_player
+    self.home_race = home_race
+    self.away_race = away_race
+    self.map_code = map_code
+    self.home_won = home_won
+    # map_code -> name
+    self.map_names = map_names
+
+  def __len__(self):
+    return len(self.week)
+
+  @classmethod
+  def concatenate(cls, tables):
+    # Re-code the maps by name, since each season numbers them itself.
+    map_names = sorted(set(name for table in tables for name in table.map_names))
+    index = dict((name, code) for (code, name) in enumerate(map_names))
+    map_codes = []
+    for table in tables:
+      recode = numpy.array([ index[name] for name in table.map_names ] or [0], dtype=numpy.int32)
+      map_codes.append(recode[table.map_code])
+    def join(column):
+      return numpy.concatenate([ getattr(table, column) for table in tables ])
+    return cls(join("season"), join("week"), join("home_player"), join("away_player"),
+        join("home_race"), join("away_race"), numpy.concatenate(map_codes), join("home_won"),
+        map_names)
+
+
+# Every played set as (week, home_player, away_player, home_race,
+# away_race, map, home_won).  Sets 1-4 take the players from the lineups,
+# set 5 from the ace match.
+GAMES_QUERY = (
+    "SELECT s.week, hl.player, al.player, "
+    "INSTR('TZPR', hl.race) - 1, INSTR('TZPR', al.race) - 1, "
+    "IFNULL(mp.mapid, 0), s.home_winner "
+    "FROM set_results s "
+    "JOIN matches m ON m.week = s.week AND m.match_number = s.match_number "
+    "JOIN lineup hl ON hl.week = s.week AND hl.team = m.home_team AND hl.set_number = s.set_number "
+    "JOIN lineup al ON al.week = s.week AND al.team = m.away_team AND al.set_number = s.set_number "
+    "LEFT JOIN maps mp ON mp.week = s.week AND mp.set_number = s.set_number "
+    "WHERE s.set_number < 5 AND NOT s.forfeit AND (s.home_winner OR s.away_winner) "
+    "UNION ALL "
+    "SELECT s.week, a.home_player, a.away_player, "
+    "INSTR('TZPR', a.home_race) - 1, INSTR('TZPR', a.away_race) - 1, "
+    "IFNULL(mp.mapid, 0), s.home_winner "
+    "FROM set_results s "
+    "JOIN ace_matches a ON a.week = s.week AND a.match_number = s.match_number "
+    "LEFT JOIN maps mp ON mp.week = s.week AND mp.set_number = s.set_number "
+    "WHERE s.set_number = 5 AND NOT s.forfeit AND (s.home_winner OR s.away_winner) "
+    )
+
+
+def load_games(conn, season=0):
+  cursor = conn.cursor()
+  try:
+    cursor.execute("SELECT id, mapname FROM mapnames ORDER BY id")
+    mapnames = [(0, "(unknown)")] + list(cursor)
+    cursor.execute(GAMES_QUERY)
+    rows = cursor.fetchall()
+  finally:
+    cursor.close()
+
+  data = numpy.array(rows, dtype=numpy.int32).reshape(len(rows), 7)
+  # Map ids may be sparse; code them densely in mapnames order.
+  mapids = numpy.array([ mapid for (mapid, _) in mapnames ], dtype=numpy.int32)
+  code_of = numpy.zeros(max(mapids.max(), data[:, 5].max() if len(rows) else 0) + 1,
+      dtype=numpy.int32)
+  code_of[mapids] = numpy.arange(len(mapids), dtype=numpy.int32)
+  map_code = code_of[data[:, 5]]
+  return GameTable(
+      numpy.full(len(rows), season, dtype=numpy.int32),
+      data[:, 0], data[:, 1], data[:, 2], data[:, 3], data[:, 4],
+      map_code, data[:, 6].astype(bool), [ name for (_, name) in mapnames ])
+
+
+# Counts and wins per group, for groups 0..size-1.
+def _grouped(codes, wins, size):
+  games = numpy.bincount(codes, minlength=size)
+  won = numpy.bincount(codes, weights=wins, minlength=size).astype(numpy.int64)
+  return games, won
+
+
+def _rate(won, games):
+  return float(won) / games if games else None
+
+
+# Win rate of each race against each other race on each map, from the
+# first race's side; mirror matches and unknown races are skipped.
+def matchups_by_map(games):
+  valid = (games.home_race >= 0) & (games.away_race >= 0) & (games.home_race != games.away_race)
+  home_race = games.home_race[valid]
+  away_race = games.away_race[valid]
+  first = numpy.minimum(home_race, away_race)
+  second = numpy.maximum(home_race, away_race)
+  winner_race = numpy.where(games.home_won[valid], home_race, away_race)
+  nraces = len(RACES)
+  codes = (games.map_code[valid] * nraces + first) * nraces + second
+  played, won = _grouped(codes, winner_race == first, len(games.map_names) * nraces * nraces)
+  rows = []
+  for code in numpy.flatnonzero(played):
+    map_code, rest = divmod(int(code), nraces * nraces)
+    race1, race2 = divmod(rest, nraces)
+    rows.append(dict(map=games.map_names[map_code],
+        matchup="%sv%s" % (RACES[race1], RACES[race2]),
+        games=int(played[code]), wins=int(won[code]), win_rate=_rate(won[code], played[code])))
+  return rows
+
+
+# Home side's win rate per season and week.
+def home_advantage_by_week(games):
+  if not len(games):
+    return []
+  nweeks = int(games.week.max()) + 1
+  codes = games.season * nweeks + games.week
+  played, won = _grouped(codes, games.home_won, (int(games.season.max()) + 1) * nweeks)
+  rows = []
+  for code in numpy.flatnonzero(played):
+    season, week = divmod(int(code), nweeks)
+    rows.append(dict(season=season, week=week, games=int(played[code]),
+        home_wins=int(won[code]), home_win_rate=_rate(won[code], played[code])))
+  return rows
+
+
+# Each race's win rate in non-mirror games, overall.
+def race_win_rates(games):
+  valid = (games.home_race >= 0) & (games.away_race >= 0) & (games.home_race != games.away_race)
+  races = numpy.concatenate([games.home_race[valid], games.away_race[valid]])
+  wins = numpy.concatenate([games.home_won[valid], ~games.home_won[valid]])
+  played, won = _grouped(races, wins, len(RACES))
+  return [ dict(race=RACES[race], games=int(played[race]), wins=int(won[race]),
+      win_rate=_rate(won[race], played[race])) for race in numpy.flatnonzero(played) ]
+
+
+REPORTS = [
+  ("race-win-rates", race_win_rates),
+  ("matchups-by-map", matchups_by_map),
+  ("home-advantage-by-week", home_advantage_by_week),
+  ]
+
+
+def run_reports(games, names=None):
+  return [ (name, func(games)) for (name, func) in REPORTS if not names or name in names ]
+
+
+def format_report(name, rows):
+  lines = [name]
+  if not rows:
+    lines.append("  (no games)")
+  else:
+    columns = sorted(rows[0])
+    lines.append("  " + " ".join("%14s" % column for column in columns))
+    for row in rows:
+      lines.append("  " + " ".join(
+          "%14s" % ("-" if row[column] is None else
+            "%.3f" % row[column] if isinstance(row[column], float) else row[column])
+          for column in columns))
+  return "\n".join(lines)
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options] DATABASE...")
+  parser.add_option("--report", action="append", dest="reports",
+      choices=[ name for (name, _) in REPORTS ],
+      help="report to run (repeatable; default all)")
+  parser.add_option("--json", action="store_true", help="print the reports as JSON")
+  options, args = parser.parse_args(argv[1:])
+  if not args:
+    parser.error("no databases given")
+
+  # Databases are numbered as seasons in the order given.
+  tables = []
+  for season, path in enumerate(args, 1):
+    conn = sqlite3.connect(path)
+    try:
+      tables.append(load_games(conn, season))
+    finally:
+      conn.close()
+  games = GameTable.concatenate(tables)
+
+  reports = run_reports(games, options.reports)
+  if options.json:
+    json.dump(dict(reports), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+  else:
+    sys.stdout.write("%d games\n\n" % len(games))
+    sys.stdout.write("\n\n".join(format_report(name, rows) for (name, rows) in reports) + "\n")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import cStringIO
+
+try:
+  import numpy
+  import season_analytics
+except ImportError:
+  numpy = season_analytics = None
+
+
+# Twitter (home) against Zynga in week 1, with the maps of
+# WEEK_1_MAPS: sets 1 and 3 won by home Protoss against away Zerg, set 2 by
+# away Protoss against home Zerg, set 4 forfeited and the ace won by home
+# Terran against away Zerg.
+WEEK_1_MAPS = [7, 5, 1, 2, 4]
+RESULTS = [(1, 1, 0, 0), (2, 0, 1, 0), (3, 1, 0, 0), (4, 1, 0, 1), (5, 1, 0, 0)]
+
+
+def make_season(path=":memory:"):
+  conn = sqlite3.connect(path)
+  for fname in ["./schema.sql", "./test_data.sql", "./test_lineup.sql"]:
+    with open(fname) as handle:
+      conn.executescript(handle.read())
+  conn.executemany("INSERT INTO maps(week, set_number, mapid) VALUES (1,?,?)",
+      list(enumerate(WEEK_1_MAPS, 1)))
+  conn.executemany(
+      "INSERT INTO set_results(week, match_number, set_number, home_winner, away_winner, "
+      "forfeit, replay_hash) VALUES (1,1,?,?,?,?,NULL)", RESULTS)
+  conn.execute("INSERT INTO ace_matches VALUES (1,1,5,11,'T','Z')")
+  conn.commit()
+  return conn
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class LoadGamesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = make_season()
+
+  def tearDown(self):
+    self.conn.close()
+
+  def test_coding(self):
+    games = season_analytics.load_games(self.conn, 3)
+    self.assertEqual(len(games), 4)
+    order = numpy.argsort(games.home_player)
+    def column(name):
+      return getattr(games, name)[order].tolist()
+    self.assertEqual(column("season"), [3, 3, 3, 3])
+    self.assertEqual(column("week"), [1, 1, 1, 1])
+    self.assertEqual(column("home_player"), [1, 2, 3, 5])
+    self.assertEqual(column("away_player"), [7, 8, 9, 11])
+    # Races are coded as positions in RACES.
+    self.assertEqual(column("home_race"), [2, 1, 2, 0])
+    self.assertEqual(column("away_race"), [1, 2, 1, 1])
+    self.assertEqual(column("home_won"), [True, False, True, True])
+    self.assertEqual([ games.map_names[code] for code in column("map_code") ],
+        ["Xel'Naga Caverns", "Tal'Darim Altar", "Backwater Gulch", "Shattered Temple"])
+    self.assertEqual(games.map_names[0], "(unknown)")
+
+  def test_sparse_map_ids(self):
+    self.conn.execute("UPDATE mapnames SET id = id * 10")
+    self.conn.execute("UPDATE maps SET mapid = mapid * 10")
+    self.conn.execute("DELETE FROM maps WHERE set_number = 5")
+    games = season_analytics.load_games(self.conn)
+    names = sorted(games.map_names[code] for code in games.map_code)
+    self.assertEqual(names,
+        ["(unknown)", "Backwater Gulch", "Tal'Darim Altar", "Xel'Naga Caverns"])
+
+  def test_empty(self):
+    self.conn.execute("DELETE FROM set_results")
+    games = season_analytics.load_games(self.conn)
+    self.assertEqual(len(games), 0)
+    self.assertEqual(season_analytics.run_reports(games),
+        [("race-win-rates", []), ("matchups-by-map", []), ("home-advantage-by-week", [])])
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class ReportsTest(unittest.TestCase):
+
+  def setUp(self):
+    conn = make_season()
+    try:
+      self.games = season_analytics.load_games(conn, 1)
+    finally:
+      conn.close()
+
+  def test_race_win_rates(self):
+    self.assertEqual(season_analytics.race_win_rates(self.games), [
+      dict(race="T", games=1, wins=1, win_rate=1.0),
+      dict(race="Z", games=4, wins=0, win_rate=0.0),
+      dict(race="P", games=3, wins=3, win_rate=1.0),
+      ])
+
+  def test_matchups_by_map(self):
+    # Counted from the side of the race first in RACES.
+    self.assertEqual(season_analytics.matchups_by_map(self.games), [
+      dict(map="Backwater Gulch", matchup="ZvP", games=1, wins=0, win_rate=0.0),
+      dict(map="Shattered Temple", matchup="TvZ", games=1, wins=1, win_rate=1.0),
+      dict(map="Tal'Darim Altar", matchup="ZvP", games=1, wins=0, win_rate=0.0),
+      dict(map="Xel'Naga Caverns", matchup="ZvP", games=1, wins=0, win_rate=0.0),
+      ])
+
+  def test_home_advantage_by_week(self):
+    self.assertEqual(season_analytics.home_advantage_by_week(self.games), [
+      dict(season=1, week=1, games=4, home_wins=3, home_win_rate=0.75),
+      ])
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class SeasonsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.paths = [ os.path.join(self.tmp_dir, "s%d.sq3" % n) for n in (1, 2) ]
+    make_season(self.paths[0]).close()
+    # The second season numbers its maps the other way round and played
+    # set 1 on Daybreak, which the first never used.  Its set 3 was home
+    # Zerg against away Protoss, so its ZvP on Backwater Gulch was a Zerg win.
+    conn = make_season(self.paths[1])
+    conn.execute("UPDATE mapnames SET id = 100 - id")
+    conn.execute("UPDATE maps SET mapid = 100 - mapid")
+    conn.execute("INSERT INTO mapnames VALUES (50, 'Daybreak')")
+    conn.execute("UPDATE maps SET mapid = 50 WHERE set_number = 1")
+    conn.execute("UPDATE lineup SET race = 'Z' WHERE week = 1 AND team = 6 AND set_number = 3")
+    conn.execute("UPDATE lineup SET race = 'P' WHERE week = 1 AND team = 8 AND set_number = 3")
+    conn.commit()
+    conn.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def load(self):
+    tables = []
+    for season, path in enumerate(self.paths, 1):
+      conn = sqlite3.connect(path)
+      try:
+        tables.append(season_analytics.load_games(conn, season))
+      finally:
+        conn.close()
+    return season_analytics.GameTable.concatenate(tables)
+
+  def test_maps_matched_by_name(self):
+    games = self.load()
+    self.assertEqual(len(games), 8)
+    self.assertEqual(games.map_names[:3], ["(unknown)", "Backwater Gulch", "Daybreak"])
+    rows = season_analytics.matchups_by_map(games)
+    self.assertEqual([ (row["map"], row["matchup"], row["games"], row["wins"]) for row in rows ], [
+      ("Backwater Gulch", "ZvP", 2, 1),
+      ("Daybreak", "ZvP", 1, 0),
+      ("Shattered Temple", "TvZ", 2, 2),
+      ("Tal'Darim Altar", "ZvP", 2, 0),
+      ("Xel'Naga Caverns", "ZvP", 1, 0),
+      ])
+    self.assertEqual([ (row["season"], row["week"], row["home_wins"])
+        for row in season_analytics.home_advantage_by_week(games) ], [(1, 1, 3), (2, 1, 3)])
+
+  def test_main(self):
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+      self.assertEqual(season_analytics.main(["season_analytics.py", "--json",
+          "--report", "race-win-rates"] + self.paths), 0)
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(json.loads(output)["race-win-rates"], [
+      dict(race="T", games=2, wins=2, win_rate=1.0),
+      dict(race="Z", games=8, wins=1, win_rate=0.125),
+      dict(race="P", games=6, wins=5, win_rate=5 / 6.0),
+      ])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# Export a whole season as one zip archive: a snapshot of the database,
+# the rendered standings, lineup and result pages (under pages/, linking to
+# replays/), and every replay referenced from set_results (as
+# replays/<hash>.SC2Replay).
+#
+# An export of OUT.zip is prepared in OUT.zip.work/.  The database is
+# snapshotted there first with VACUUM INTO, which copies one consistent
+# read transaction without holding up writers, and the pages are rendered
+# from that snapshot, so the whole archive shows the same moment of the
+# season.  The archive is then written to OUT.zip.part, replays being
+# copied from the replay store a chunk at a time; only the snapshot and
+# pages ever take space besides the archive itself.  After each member its
+# central directory entry is appended to OUT.zip.progress, so an
+# interrupted export carries on after the last member recorded there.  The
+# finished archive is renamed to OUT.zip and the working files removed.
+# OUT.zip.lock is held while an export runs, so only one process works on
+# it at a time.
+#
+# Admins start exports from /_exports, which queues an export_season job
+# for ahgl_worker.py; this script does the same directly.
+#
+#   ./season_export.py CONFIG OUT.zip [--season SEASON]
+import sys
+import os
+import json
+import errno
+import fcntl
+import shutil
+import optparse
+import contextlib
+
+import flask
+
+import ahgl_admin
+import zipstream
+
+
+app = ahgl_admin.app
+
+
+class ExportBusy(Exception):
+  pass
+
+
+# Copy the database behind conn to path, which must not exist yet.
+def snapshot_database(conn, path):
+  conn.execute("VACUUM INTO ?", (path,))
+
+
+def replay_hashes(conn):
+  cursor = conn.cursor()
+  try:
+    cursor.execute(
+        "SELECT DISTINCT replay_hash FROM set_results "
+        "WHERE replay_hash IS NOT NULL ORDER BY replay_hash")
+    return [ row[0] for row in cursor ]
+  finally:
+    cursor.close()
+
+
+# Point this request's get_db() at the snapshot for the duration.
+@contextlib.contextmanager
+def reading_snapshot(path):
+  g = flask.g
+  saved = (getattr(g, "db", None), getattr(g, "db_pool", None))
+  pool = ahgl_admin.ConnectionPool(path, 1, [], read_only=True)
+  g.db_pool = pool
+  g.db = pool.acquire()
+  try:
+    yield
+  finally:
+    pool.release(g.db)
+    pool.close()
+    g.db, g.db_pool = saved
+
+
+# Take the snapshot, render the pages and list the archive's (path,
+# arcname) members, all in work_dir.  Needs a request context for the
+# season.  The member list is written last, so a work_dir that has one is
+# complete and is reused as it is.
+def prepare(work_dir, log=None):
+  members_path = os.path.join(work_dir, "members.json")
+  if os.path.exists(members_path):
+    with open(members_path) as handle:
+      return [ tuple(member) for member in json.load(handle) ]
+
+  if os.path.exists(work_dir):
+    shutil.rmtree(work_dir)
+  pages_dir = os.path.join(work_dir, "pages")
+  os.makedirs(pages_dir)
+  snapshot = os.path.join(work_dir, "ahgl.sq3")
+  snapshot_database(ahgl_admin.get_db(), snapshot)
+
+  prefix = "AHGL_S%s" % ahgl_admin.get_season_name()
+  members = [(snapshot, prefix + "/ahgl.sq3")]
+  with reading_snapshot(snapshot):
+    with contextlib.closing(ahgl_admin.get_db().cursor()) as cursor:
+      cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
+      weeks = [ row[0] for row in cursor ]
+    pages = [("standings.html", ahgl_admin.standings_page)]
+    for week in weeks:
+      pages.append(("lineup-week-%d.html" % week,
+          lambda week=week: ahgl_admin.show_lineup_week.render(week, archived=True)))
+      pages.append(("result-week-%d.html" % week,
+          lambda week=week: ahgl_admin.show_result_week.render(week, archived=True)))
+    for name, render in pages:
+      body = render()
+      if isinstance(body, unicode):
+        body = body.encode("utf-8")
+      path = os.path.join(pages_dir, name)
+      with open(path, "wb") as handle:
+        handle.write(body)
+      members.append((path, prefix + "/pages/" + name))
+    hashes = replay_hashes(ahgl_admin.get_db())
+
+  store = ahgl_admin.get_replay_store()
+  for rephash in hashes:
+    path = store.lookup(rephash)
+    if not path:
+      if log:
+        log("Missing replay %s" % rephash)
+      continue
+    members.append((os.path.abspath(path), prefix + "/replays/%s.SC2Replay" % rephash))
+
+  with open(members_path + ".tmp", "w") as handle:
+    json.dump(members, handle)
+  os.rename(members_path + ".tmp", members_path)
+  return members
+
+
+_PROGRESS_FIELDS = ("name", "method", "dtime", "date", "offset", "crc", "csize", "usize")
+
+
+# Restore zstream to the end of the last member recorded in the progress
+# file, and return the byte length of the intact records.  A record cut
+# short by a crash ends the list.
+def _load_progress(handle, zstream):
+  good = 0
+  for line in handle:
+    if not line.endswith("\n"):
+      break
+    try:
+      record = json.loads(line)
+    except ValueError:
+      break
+    entry = zipstream.ZipEntry(record["name"].encode("utf-8"), record["method"],
+        record["dtime"], record["date"], record["offset"])
+    entry.crc, entry.csize, entry.usize = record["crc"], record["csize"], record["usize"]
+    zstream.entries.append(entry)
+    zstream.offset = record["end"]
+    good += len(line)
+  return good
+
+
+def _open_for_update(path):
+  try:
+    return open(path, "r+b")
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+  return open(path, "w+b")
+
+
+# Write the (path, arcname) members to out_path, carrying on from a
+# previous partial attempt if there was one.
+def write_archive(out_path, members, compression="stored", log=None):
+  part_path = out_path + ".part"
+  zstream = zipstream.ZipStream(compression, allow_zip64=True)
+  with _open_for_update(out_path + ".progress") as progress:
+    progress.truncate(_load_progress(progress, zstream))
+    progress.seek(0, os.SEEK_END)
+    done = set(entry.name for entry in zstream.entries)
+    if done and log:
+      log("Resuming after %d members (%d bytes)" % (len(done), zstream.offset))
+
+    with _open_for_update(part_path) as out:
+      out.seek(zstream.offset)
+      out.truncate()
+      for path, arcname in members:
+        if arcname.encode("utf-8") in done:
+          continue
+        for chunk in zstream.add_file(path, arcname):
+          out.write(chunk)
+        # The member must be on disk before the record that says it is.
+        out.flush()
+        os.fsync(out.fileno())
+        entry = zstream.entries[-1]
+        record = dict((field, getattr(entry, field)) for field in _PROGRESS_FIELDS)
+        record["name"] = entry.name.decode("utf-8")
+        record["end"] = zstream.offset
+        progress.write(json.dumps(record, sort_keys=True) + "\n")
+        progress.flush()
+      for chunk in zstream.finish():
+        out.write(chunk)
+      out.flush()
+      os.fsync(out.fileno())
+  os.rename(part_path, out_path)
+  os.unlink(out_path + ".progress")
+  return len(zstream.entries), zstream.offset
+
+
+# Export the request's season to out_path, unless it is there already.
+# Raises ExportBusy if another process is exporting to the same path.
+def export_season(out_path, compression="stored", log=None):
+  with _open_for_update(out_path + ".lock") as lock:
+    try:
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as err:
+      if err.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      raise ExportBusy("%s is being written by another process" % out_path)
+    if not os.path.exists(out_path):
+      work_dir = out_path + ".work"
+      members = prepare(work_dir, log)
+      write_archive(out_path, members, compression, log)
+      shutil.rmtree(work_dir)
+    os.unlink(out_path + ".lock")
+  return os.path.getsize(out_path)
+
+
+# (members written, members in all or None, bytes written) for an export
+# in progress at out_path, or None if there is none.
+def export_progress(out_path):
+  if not os.path.exists(out_path + ".lock"):
+    return None
+  written = total = None
+  try:
+    with open(out_path + ".progress") as handle:
+      written = sum(1 for line in handle if line.endswith("\n"))
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+  try:
+    with open(os.path.join(out_path + ".work", "members.json")) as handle:
+      total = len(json.load(handle))
+  except (IOError, ValueError):
+    pass
+  try:
+    size = os.path.getsize(out_path + ".part")
+  except OSError:
+    size = 0
+  return written or 0, total, size
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog CONFIG OUT.zip [options]")
+  parser.add_option("--season", help="archived season to export (default: the current one)")
+  parser.add_option("--compression",
+      help="stored, deflate[:LEVEL] or adaptive[:LEVEL] (default: EXPORT_COMPRESSION)")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 2:
+    parser.error("expected a config file and an output file")
+  config, out_path = args
+  app.config.from_pyfile(os.path.abspath(config))
+  compression = options.compression or app.config["EXPORT_COMPRESSION"]
+  try:
+    zipstream.parse_compression(compression)
+  except ValueError as err:
+    parser.error(str(err))
+
+  def log(message):
+    sys.stderr.write(message + "\n")
+  with ahgl_admin.season_context(options.season):
+    if options.season is not None and not os.path.exists(
+        os.path.join(ahgl_admin.get_data_dir(), "ahgl.sq3")):
+      parser.error("no such season: %s" % options.season)
+    try:
+      size = export_season(os.path.abspath(out_path), compression, log)
+    except ExportBusy as err:
+      log(str(err))
+      return 1
+  sys.stdout.write("Wrote %s (%d bytes)\n" % (out_path, size))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Per-request SQL instrumentation for sqlite3 connections.
+#
+# TracingConnection hands out TracingCursors, which record every statement
+# they run into the connection's current RequestTrace: the SQL, the number
+# of bound parameters, wall time (including the time spent stepping through
+# result rows) and the number of rows returned.  A trace also groups
+# statements by shape, which makes loops that issue the same query once per
+# row (N+1 patterns) stand out.
+import re
+import time
+import sqlite3
+
+
+def statement_shape(sql):
+  return re.sub(r"\s+", " ", sql).strip()
+
+
+class QueryRecord(object):
+  __slots__ = ["sql", "binds", "seconds", "rows", "many"]
+
+  def __init__(self, sql, binds, many):
+    self.sql = sql
+    self.binds = binds
+    self.seconds = 0.0
+    self.rows = 0
+    self.many = many
+
+
+class RequestTrace(object):
+
+  def __init__(self, label):
+    self.label = label
+    self.started = time.time()
+    self.queries = []
+
+  def total_seconds(self):
+    return sum(query.seconds for query in self.queries)
+
+  def total_rows(self):
+    return sum(query.rows for query in self.queries)
+
+  # Statement shapes run at least `threshold` times, most frequent first.
+  def repeated(self, threshold):
+    counts = {}
+    for query in self.queries:
+      shape = statement_shape(query.sql)
+      counts[shape] = counts.get(shape, 0) + 1
+    return sorted([ (count, text) for (text, count) in counts.items() if count >= threshold ],
+        reverse=True)
+
+  def slow(self, threshold_seconds):
+    return [ query for query in self.queries if query.seconds >= threshold_seconds ]
+
+  def summary(self, repeat_threshold):
+    return "queries=%d; time=%.2fms; rows=%d; repeated=%d" % (
+        len(self.queries), self.total_seconds() * 1000, self.total_rows(),
+        len(self.repeated(repeat_threshold)))
+
+  def report(self, repeat_threshold):
+    lines = [ "%s %s" % (self.label, self.summary(repeat_threshold)) ]
+    for query in self.queries:
+      lines.append("  %8.3fms %5d rows %3d binds%s  %s" % (
+          query.seconds * 1000, query.rows, query.binds,
+          " (many)" if query.many else "", statement_shape(query.sql)))
+    for count, shape in self.repeated(repeat_threshold):
+      lines.append("  REPEATED x%d: %s" % (count, shape))
+    return "\n".join(lines)
+
+
+class TracingCursor(sqlite3.Cursor):
+
+  _record = None
+
+  def _run(self, method, sql, params, many):
+    trace = getattr(self.connection, "trace", None)
+    if trace is None:
+      self._record = None
+      return method(self, sql, params)
+    if many:
+      params = list(params)
+      binds = sum(len(row) for row in params)
+    else:
+      binds = len(params)
+    record = self._record = QueryRecord(sql, binds, many)
+    trace.queries.append(record)
+    start = time.time()
+    try:
+      return method(self, sql, params)
+    finally:
+      record.seconds += time.time() - start
+
+  def execute(self, sql, params=()):
+    return self._run(sqlite3.Cursor.execute, sql, params, False)
+
+  def executemany(self, sql, params):
+    return self._run(sqlite3.Cursor.executemany, sql, params, True)
+
+  def _fetch(self, method, *args):
+    record = self._record
+    if record is None:
+      return method(self, *args)
+    start = time.time()
+    try:
+      result = method(self, *args)
+    finally:
+      record.seconds += time.time() - start
+    if isinstance(result, list):
+      record.rows += len(result)
+    elif result is not None:
+      record.rows += 1
+    return result
+
+  def next(self):
+    return self._fetch(sqlite3.Cursor.next)
+
+  def fetchone(self):
+    return self._fetch(sqlite3.Cursor.fetchone)
+
+  def fetchmany(self, *args):
+    return self._fetch(sqlite3.Cursor.fetchmany, *args)
+
+  def fetchall(self):
+    return self._fetch(sqlite3.Cursor.fetchall)
+
+
+class TracingConnection(sqlite3.Connection):
+
+  trace = None
+
+  def cursor(self, factory=TracingCursor):
+    return sqlite3.Connection.cursor(self, factory)
@@ -10,6 +10,7 @@ import unittest
 import urllib2
 import zipfile
 import cStringIO
+import SocketServer
 import wsgiref.simple_server
 import selenium.webdriver
 from selenium.webdriver.support.ui import WebDriverWait
@@ -32,6 +33,11 @@ def get_test_replay_file():
 
 TEST_REPLAY_SHA1 = '4e1243bd22c66e76c2ba9eddc1f91394e57f9f83'
 
+# Lineup and result pages hold an event stream open, so requests made
+# while the browser is on one need a thread of their own.
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+
 class AhglAdminSiteBrowserTest(unittest.TestCase):
 
   def setUp(self):
@@ -41,7 +47,8 @@ class AhglAdminSiteBrowserTest(unittest.TestCase):
     ahgl_admin.app.config['DATA_DIR'] = self.data_dir
     ahgl_admin.app.config['SEASON'] = '2'
     ahgl_admin.app.secret_key = 'AHGL'
-    self.httpd = wsgiref.simple_server.make_server('', 0, ahgl_admin.app.wsgi_app)
+    self.httpd = wsgiref.simple_server.make_server('', 0, ahgl_admin.app.wsgi_app,
+        server_class=ThreadingWSGIServer)
     self.base_url = 'http://localhost:%d/' % self.httpd.server_address[1]
     threading.Thread(target=self.httpd.serve_forever).start()
     print self.data_dir  # TODO: drop
@@ -277,6 +284,17 @@ class AhglAdminSiteBrowserTest(unittest.TestCase):
     with contextlib.closing(urllib2.urlopen(replay_link)) as handle:
       self.assertEqual(hashlib.sha1(handle.read()).hexdigest(), TEST_REPLAY_SHA1)
 
+    request = urllib2.Request(replay_link, headers={'If-None-Match': '"%s"' % TEST_REPLAY_SHA1})
+    with self.assertRaises(urllib2.HTTPError) as cm:
+      urllib2.urlopen(request)
+    self.assertEqual(cm.exception.code, 304)
+
+    request = urllib2.Request(replay_link, headers={'Range': 'bytes=1-2'})
+    with contextlib.closing(urllib2.urlopen(request)) as handle:
+      self.assertEqual(handle.getcode(), 206)
+      with open(get_test_replay_file(), 'rb') as replay:
+        self.assertEqual(handle.read(), replay.read()[1:3])
+
     replay_pack_link = wd.find_element_by_link_text('Replay Pack').get_attribute('href')
 
     with contextlib.closing(urllib2.urlopen(replay_pack_link)) as handle:
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# Per-week version counters in the week_versions table.
+#
+# Every write to a week's maps, lineups, results or schedule bumps the
+# week's version in the same transaction.  The page and snapshot caches
+# (ahgl_admin), the event streams (change_notifier) and the API's ETags
+# all compare versions instead of the data itself, so anything that writes
+# week data, in the app or in a script, must bump through here.
+
+
+# Returns the week's new version.
+def bump(cursor, week):
+  cursor.execute("INSERT OR IGNORE INTO week_versions(week, version) VALUES (?,0)", (week,))
+  cursor.execute("UPDATE week_versions SET version = version + 1 WHERE week = ?", (week,))
+  return get(cursor, week)
+
+
+# 0 for a week that has never been written.
+def get(cursor, week):
+  cursor.execute("SELECT version FROM week_versions WHERE week = ?", (week,))
+  rows = list(cursor)
+  return rows[0][0] if rows else 0
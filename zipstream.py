@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Write ZIP archives as a stream of chunks, without a seekable output.
+#
+# Every member is written with a data descriptor (general purpose flag bit 3)
+# so the CRC and sizes can follow the data, which means a member never has
+# to be held in memory or rewritten once its contents are known.  The
+# resulting archives are readable by zipfile and the usual unzip tools.
+# The state needed to finish an archive is just `entries` and `offset`, so
+# a writer that saves them can carry on an interrupted archive later (see
+# season_export).
+import struct
+import time
+import os
+import zlib
+import zipfile
+import collections
+
+
+CHUNK_SIZE = 64 * 1024
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_VERSION = 20
+_VERSION_ZIP64 = 45
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+_ZIP64_EXTRA_OFFSET = struct.Struct("<HHQ")
+_ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+
+_MAX_SIZE = 0xffffffff
+_MAX_ENTRIES = 0xffff
+
+# Adaptive compression stores a member unless deflating its first chunk
+# saves at least this fraction of the size.  Replays are MPQ archives whose
+# contents are already compressed, so deflate usually gains very little.
+ADAPTIVE_MIN_SAVING = 0.05
+
+
+# How members are compressed, from a spec string:
+#   "stored"            no compression
+#   "deflate[:LEVEL]"   always deflate (zlib level 1-9, default 6)
+#   "adaptive[:LEVEL]"  deflate a sample of each member; store it if the
+#                       sample does not shrink by ADAPTIVE_MIN_SAVING
+CompressionPolicy = collections.namedtuple("CompressionPolicy", ["name", "level"])
+
+
+def parse_compression(spec):
+  if isinstance(spec, CompressionPolicy):
+    return spec
+  parts = spec.split(":")
+  name = parts[0]
+  if name not in ("stored", "deflate", "adaptive") or len(parts) > 2:
+    raise ValueError("Invalid compression policy %r" % spec)
+  level = 6
+  if len(parts) == 2:
+    if name == "stored":
+      raise ValueError("Invalid compression policy %r" % spec)
+    try:
+      level = int(parts[1])
+    except ValueError:
+      raise ValueError("Invalid compression level in %r" % spec)
+    if not 1 <= level <= 9:
+      raise ValueError("Invalid compression level in %r" % spec)
+  return CompressionPolicy(name, level)
+
+
+def _dos_time(mtime):
+  tm = time.localtime(mtime)
+  if tm.tm_year < 1980:
+    tm = time.localtime(315532800)
+  date = (tm.tm_year - 1980) << 9 | tm.tm_mon << 5 | tm.tm_mday
+  dtime = tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2
+  return dtime, date
+
+
+class ZipEntry(object):
+  def __init__(self, name, method, dtime, date, offset):
+    self.name = name
+    self.method = method
+    self.dtime = dtime
+    self.date = date
+    self.offset = offset
+    self.crc = 0
+    self.csize = 0
+    self.usize = 0
+
+
+# With allow_zip64, archives may grow past 4GB and 65535 members: members
+# starting beyond 4GB get their offset in a ZIP64 extra field, and the end
+# of the archive gets ZIP64 records.  Each member must still be under 4GB.
+class ZipStream(object):
+
+  def __init__(self, compression="deflate", chunk_size=CHUNK_SIZE, allow_zip64=False):
+    self.policy = parse_compression(compression)
+    self.chunk_size = chunk_size
+    self.allow_zip64 = allow_zip64
+    self.entries = []
+    self.offset = 0
+
+  def _emit(self, data):
+    self.offset += len(data)
+    if self.offset > _MAX_SIZE and not self.allow_zip64:
+      raise zipfile.LargeZipFile("Archive would require ZIP64 extensions")
+    return data
+
+  def add_file(self, path, arcname):
+    with open(path, "rb") as handle:
+      for chunk in self.add_stream(handle, arcname, os.fstat(handle.fileno()).st_mtime):
+        yield chunk
+
+  def _choose_method(self, sample):
+    if self.policy.name == "stored":
+      return zipfile.ZIP_STORED
+    if self.policy.name == "adaptive" and sample:
+      compressor = zlib.compressobj(self.policy.level, zlib.DEFLATED, -15)
+      csize = len(compressor.compress(sample)) + len(compressor.flush())
+      if csize > len(sample) * (1 - ADAPTIVE_MIN_SAVING):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+  def add_stream(self, handle, arcname, mtime=None):
+    if isinstance(arcname, unicode):
+      arcname = arcname.encode("utf-8")
+    dtime, date = _dos_time(time.time() if mtime is None else mtime)
+    # The method goes in the local header, so read the first chunk before
+    # writing it and let the policy look at it.
+    data = handle.read(self.chunk_size)
+    entry = ZipEntry(arcname, self._choose_method(data), dtime, date, self.offset)
+
+    yield self._emit(_LOCAL_HEADER.pack(
+      0x04034b50, _VERSION, _FLAG_DATA_DESCRIPTOR, entry.method,
+      dtime, date, 0, 0, 0, len(arcname), 0) + arcname)
+
+    if entry.method == zipfile.ZIP_DEFLATED:
+      compressor = zlib.compressobj(self.policy.level, zlib.DEFLATED, -15)
+    else:
+      compressor = None
+
+    while data:
+      entry.crc = zlib.crc32(data, entry.crc) & 0xffffffff
+      entry.usize += len(data)
+      if compressor:
+        data = compressor.compress(data)
+      if data:
+        entry.csize += len(data)
+        yield self._emit(data)
+      data = handle.read(self.chunk_size)
+    if compressor:
+      data = compressor.flush()
+      entry.csize += len(data)
+      yield self._emit(data)
+
+    if entry.usize > _MAX_SIZE:
+      raise zipfile.LargeZipFile("Member would require ZIP64 extensions")
+
+    yield self._emit(_DATA_DESCRIPTOR.pack(
+      0x08074b50, entry.crc, entry.csize, entry.usize))
+    self.entries.append(entry)
+
+  def finish(self):
+    cd_offset = self.offset
+    for entry in self.entries:
+      version, offset, extra = _VERSION, entry.offset, ""
+      if entry.offset >= _MAX_SIZE:
+        version, offset = _VERSION_ZIP64, _MAX_SIZE
+        extra = _ZIP64_EXTRA_OFFSET.pack(0x0001, 8, entry.offset)
+      yield self._emit(_CENTRAL_HEADER.pack(
+        0x02014b50, version, version, _FLAG_DATA_DESCRIPTOR, entry.method,
+        entry.dtime, entry.date, entry.crc, entry.csize, entry.usize,
+        len(entry.name), len(extra), 0, 0, 0, 0o100644 << 16, offset) + entry.name + extra)
+    cd_size = self.offset - cd_offset
+    count = len(self.entries)
+    if count >= _MAX_ENTRIES or cd_offset >= _MAX_SIZE or cd_size >= _MAX_SIZE:
+      if not self.allow_zip64:
+        raise zipfile.LargeZipFile("Archive would require ZIP64 extensions")
+      end64_offset = self.offset
+      yield self._emit(_ZIP64_END_RECORD.pack(
+        0x06064b50, _ZIP64_END_RECORD.size - 12, _VERSION_ZIP64, _VERSION_ZIP64, 0, 0,
+        count, count, cd_size, cd_offset))
+      yield self._emit(_ZIP64_END_LOCATOR.pack(0x07064b50, 0, end64_offset, 1))
+      count = min(count, _MAX_ENTRIES)
+      cd_size = min(cd_size, _MAX_SIZE)
+      cd_offset = min(cd_offset, _MAX_SIZE)
+    yield self._emit(_END_RECORD.pack(
+      0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+# Yield the chunks of an archive of (path, arcname) members.
+def iter_zip(members, **kwds):
+  zstream = ZipStream(**kwds)
+  for path, arcname in members:
+    for chunk in zstream.add_file(path, arcname):
+      yield chunk
+  for chunk in zstream.finish():
+    yield chunk
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+import cStringIO
+
+import zipstream
+
+
+def read_zip(data):
+  return zipfile.ZipFile(cStringIO.StringIO(data))
+
+
+class ParseCompressionTest(unittest.TestCase):
+
+  def test_specs(self):
+    self.assertEqual(zipstream.parse_compression("stored"), ("stored", 6))
+    self.assertEqual(zipstream.parse_compression("deflate"), ("deflate", 6))
+    self.assertEqual(zipstream.parse_compression("adaptive:1"), ("adaptive", 1))
+    for spec in ("gzip", "stored:1", "deflate:0", "deflate:x", "deflate:1:2"):
+      self.assertRaises(ValueError, zipstream.parse_compression, spec)
+
+
+class ZipStreamTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_file(self, name, data):
+    path = os.path.join(self.tmp_dir, name)
+    with open(path, "wb") as handle:
+      handle.write(data)
+    return path
+
+  def test_round_trip(self):
+    members = {
+      "a/text.txt": "hello world\n" * 1000,
+      "b/random.bin": os.urandom(200 * 1024),
+      "empty": "",
+      }
+    for compression in ("stored", "deflate", "adaptive"):
+      paths = [ (self.write_file(str(num), data), name)
+          for num, (name, data) in enumerate(sorted(members.items())) ]
+      data = "".join(zipstream.iter_zip(paths, compression=compression, chunk_size=4096))
+      zfile = read_zip(data)
+      self.assertEqual(zfile.testzip(), None)
+      self.assertEqual(sorted(zfile.namelist()), sorted(members))
+      for name, contents in members.items():
+        self.assertEqual(zfile.read(name), contents)
+
+  def test_adaptive_stores_incompressible_members(self):
+    zstream = zipstream.ZipStream("adaptive")
+    text = self.write_file("text", "abc" * 10000)
+    noise = self.write_file("noise", os.urandom(10000))
+    data = "".join(list(zstream.add_file(text, "text")) + list(zstream.add_file(noise, "noise"))
+        + list(zstream.finish()))
+    methods = dict((info.filename, info.compress_type) for info in read_zip(data).infolist())
+    self.assertEqual(methods, dict(text=zipfile.ZIP_DEFLATED, noise=zipfile.ZIP_STORED))
+
+  def test_offset_past_4gb_needs_zip64(self):
+    path = self.write_file("member", "contents")
+    zstream = zipstream.ZipStream("stored")
+    zstream.offset = 5 << 30
+    with self.assertRaises(zipfile.LargeZipFile):
+      list(zstream.add_file(path, "member"))
+
+  def test_zip64_offsets(self):
+    # Start the archive past 4GB in a sparse file, as if earlier members
+    # had filled it, and check zipfile finds the member through the ZIP64
+    # records.
+    path = self.write_file("member", "contents")
+    out_path = os.path.join(self.tmp_dir, "out.zip")
+    zstream = zipstream.ZipStream("deflate", allow_zip64=True)
+    zstream.offset = 5 << 30
+    with open(out_path, "wb") as out:
+      out.seek(zstream.offset)
+      for chunk in zstream.add_file(path, "member"):
+        out.write(chunk)
+      for chunk in zstream.finish():
+        out.write(chunk)
+    zfile = zipfile.ZipFile(out_path)
+    self.assertEqual(zfile.getinfo("member").header_offset, 5 << 30)
+    self.assertEqual(zfile.read("member"), "contents")
+
+  def test_zip64_entry_count(self):
+    zstream = zipstream.ZipStream("stored", allow_zip64=True)
+    chunks = []
+    for num in range(0xffff + 1):
+      chunks.extend(zstream.add_stream(cStringIO.StringIO("x"), "%d" % num, 0))
+    chunks.extend(zstream.finish())
+    zfile = read_zip("".join(chunks))
+    self.assertEqual(len(zfile.infolist()), 0xffff + 1)
+    self.assertEqual(zfile.read("65535"), "x")
+
+  def test_entry_count_limit_without_zip64(self):
+    zstream = zipstream.ZipStream("stored")
+    for num in range(0xffff):
+      for _ in zstream.add_stream(cStringIO.StringIO(""), "%d" % num, 0):
+        pass
+    with self.assertRaises(zipfile.LargeZipFile):
+      list(zstream.finish())
+
+
+if __name__ == "__main__":
+  unittest.main()